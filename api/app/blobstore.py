@@ -0,0 +1,53 @@
+import os
+import time
+
+from loguru import logger
+
+from . import settings
+from .redis_client import db
+
+
+def blob_path(upload_folder, image_name):
+    """
+    Location of an uploaded image: two levels of folders named after the
+    first hex digits of its hash, e.g.
+    uploads/0a/7c/0a7c757a80f2c5b13fa7a2a47a683593.jpeg, so no folder
+    grows too large. Must match the ML service (model/blobstore.py).
+
+    Parameters
+    ----------
+    upload_folder : str
+        Folder where uploads are stored.
+    image_name : str
+        Image name, its MD5 hash and extension.
+
+    Returns
+    -------
+    str
+    """
+    return os.path.join(upload_folder, image_name[:2], image_name[2:4], image_name)
+
+
+async def touch(image_name, size):
+    """
+    Records an upload in the access time and size index the ML service
+    garbage collector works from. Failing here is only logged, the image
+    is indexed again when a worker loads it.
+
+    Parameters
+    ----------
+    image_name : str
+        Image name, its MD5 hash and extension.
+    size : int
+        Image size in bytes.
+    """
+    try:
+        pipe = db.pipeline(transaction=False)
+        pipe.zadd(settings.UPLOAD_ATIME_KEY, {image_name: time.time()})
+        # Sizes never change, the total only grows for new images
+        pipe.hsetnx(settings.UPLOAD_SIZE_KEY, image_name, size)
+        _, added = await pipe.execute()
+        if added:
+            await db.incrby(settings.UPLOAD_TOTAL_KEY, size)
+    except Exception as e:
+        logger.error(f"Error indexing upload {image_name}: {e}")
@@ -1,19 +1,90 @@
 import os
-from typing import List
+from typing import Dict, List
 
 from app import db
 from app import settings as config
-from app import utils
+from app import timing, utils
 from app.auth.jwt import get_current_user
-from app.model.schema import PredictRequest, PredictResponse
-from app.model.services import model_predict
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
+from app.model.schema import (
+    BatchPredictItem,
+    BatchPredictResponse,
+    JobResponse,
+    PredictRequest,
+    PredictResponse,
+    StageLatency,
+)
+from app.model.services import (
+    admit,
+    get_cached_prediction,
+    get_job,
+    latency_stats,
+    model_predict,
+    model_predict_batch,
+    submit_job,
+)
+from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile, status
 from sqlalchemy.orm import Session
 from loguru import logger
 
 router = APIRouter(tags=["Model"], prefix="/model")
 
 
+async def hash_file(file):
+    """
+    Hashes an upload before the prediction cache is checked, reading it
+    only once. With `settings.IMAGE_TRANSPORT` "disk" it is hashed and
+    stored in a single streaming pass, an image already stored is not
+    re-written. Otherwise uploads up to `settings.INLINE_MAX_BYTES`, sent
+    with the job, are read in memory and larger ones stored, or only
+    hashed in chunks when `settings.IMAGE_PRERESIZE` sends them resized
+    with the job instead.
+
+    Returns
+    -------
+    tuple(str, bytes, bool)
+        New filename based in md5 file hash, the content read in memory
+        (None otherwise) and whether the file is already stored.
+    """
+    if config.IMAGE_TRANSPORT != "disk":
+        if config.IMAGE_PRERESIZE:
+            return await utils.get_file_hash(file), None, False
+        upload = await utils.read_upload(file, config.INLINE_MAX_BYTES)
+        if upload is not None:
+            file_hash, content = upload
+            return file_hash, content, False
+    return await utils.save_file(file, config.UPLOAD_FOLDER), None, True
+
+
+async def stage_file(file, content, stored):
+    """
+    Hands an upload hashed with `hash_file()` to the model service once it
+    is known not to be cached: it is sent along with the job (see
+    `settings.IMAGE_TRANSPORT`) or stored in the upload folder. With
+    `settings.IMAGE_PRERESIZE` the image sent is resized to the model
+    input size here, so cache hits never pay for decoding it.
+
+    Returns
+    -------
+    bytes
+        Content to send with the job, None if the model service reads the
+        file from the upload folder.
+    """
+    if config.IMAGE_TRANSPORT != "disk":
+        if config.IMAGE_PRERESIZE:
+            try:
+                return await utils.read_resized(
+                    file, config.MODEL_INPUT_SIZE, config.DECODE_DRAFT_FACTOR
+                )
+            except Exception as e:
+                # Sent as is, the ML service reports it as not loadable
+                logger.warning(f"Could not resize {file.filename}: {e}")
+        if content is not None:
+            return content
+    if not stored:
+        await utils.save_file(file, config.UPLOAD_FOLDER)
+    return None
+
+
 @router.post("/predict")
 async def predict(file: UploadFile, current_user=Depends(get_current_user)):
     logger.info(f"Predicting image: {file.filename}")
@@ -37,27 +108,162 @@ async def predict(file: UploadFile, current_user=Depends(get_current_user)):
             logger.error(f"File type is not supported: {file.filename}")
             raise HTTPException(status_code=400, detail="File type is not supported.")
         
-        file_hash = await utils.get_file_hash(file)
+        # Read once, hashed while stored or kept in memory to be sent with
+        # the job (see `hash_file()`)
+        file_hash, content, stored = await hash_file(file)
+        timing.mark("receive")
         logger.debug(f"File hash: {file_hash}")
-        
-        await file.seek(0)
-        file_path = os.path.join(config.UPLOAD_FOLDER, file_hash)
-        logger.debug(f"Saving file to: {file_path}")
-        
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-        
-        logger.info("File saved, sending to model service")
-        prediction, score = await model_predict(file_hash)
+
+        # Repeated images are answered straight from the prediction cache,
+        # without queueing a job
+        cached = await get_cached_prediction(file_hash)
+        timing.mark("cache")
+        if cached is not None:
+            logger.info(f"Prediction found in cache for {file_hash}")
+            prediction, score, stage = cached
+        else:
+            # Shed load before queueing a job that would be answered too late
+            await admit()
+            timing.mark("admit")
+            content = await stage_file(file, content, stored)
+            logger.info("File saved, sending to model service")
+            prediction, score, stage = await model_predict(file_hash, content)
+            timing.mark("model")
         logger.info(f"Got prediction: {prediction}, score: {score}")
-        
+
         rpse["prediction"] = prediction
         rpse["score"] = score
+        rpse["stage"] = stage
         rpse["image_file_name"] = file_hash
         rpse["success"] = True
-        
+
         return PredictResponse(**rpse)
-        
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Error in predict endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/predict/batch")
+async def predict_batch(
+    files: List[UploadFile] = File(...), current_user=Depends(get_current_user)
+):
+    logger.info(f"Predicting {len(files)} images")
+    if len(files) > config.BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files, at most {config.BATCH_MAX_FILES} are allowed.",
+        )
+    for file in files:
+        if not utils.allowed_file(file.filename):
+            logger.error(f"File type is not supported: {file.filename}")
+            raise HTTPException(status_code=400, detail="File type is not supported.")
+
+    try:
+        file_hashes = []
+        uploads = {}
+        for file in files:
+            file_hash, content, stored = await hash_file(file)
+            file_hashes.append(file_hash)
+            uploads.setdefault(file_hash, (file, content, stored))
+        timing.mark("receive")
+
+        # Cached images are answered directly, the rest is sent to the
+        # model service as a single grouped job
+        predictions = {}
+        for file_hash in dict.fromkeys(file_hashes):
+            cached = await get_cached_prediction(file_hash)
+            if cached is not None:
+                predictions[file_hash] = cached
+        timing.mark("cache")
+        pending = [h for h in dict.fromkeys(file_hashes) if h not in predictions]
+        # The content of cached images is not needed anymore
+        uploads = {file_hash: uploads[file_hash] for file_hash in pending}
+        if pending:
+            await admit(len(pending))
+            timing.mark("admit")
+            contents = {}
+            for file_hash in pending:
+                content = await stage_file(*uploads.pop(file_hash))
+                if content is not None:
+                    contents[file_hash] = content
+            logger.info(f"Sending {len(pending)} images to model service")
+            results = await model_predict_batch(pending, contents)
+            timing.mark("model")
+            predictions.update(zip(pending, results))
+
+        items = []
+        for file_hash in file_hashes:
+            prediction, score, stage = predictions[file_hash]
+            items.append(
+                BatchPredictItem(
+                    success=prediction is not None,
+                    prediction=prediction,
+                    score=score,
+                    stage=stage,
+                    image_file_name=file_hash,
+                )
+            )
+        return BatchPredictResponse(
+            success=all(item.success for item in items), predictions=items
+        )
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error in predict batch endpoint: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_job(file: UploadFile, current_user=Depends(get_current_user)):
+    logger.info(f"Submitting job for image: {file.filename}")
+    if not utils.allowed_file(file.filename):
+        logger.error(f"File type is not supported: {file.filename}")
+        raise HTTPException(status_code=400, detail="File type is not supported.")
+
+    try:
+        file_hash = await utils.save_file(file, config.UPLOAD_FOLDER)
+        job_id = await submit_job(file_hash, current_user.email)
+        logger.info(f"Job {job_id} submitted for {file_hash}")
+        return JobResponse(job_id=job_id, status="queued", image_file_name=file_hash)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error in create job endpoint: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def read_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=config.JOB_MAX_WAIT),
+    current_user=Depends(get_current_user),
+):
+    job, output = await get_job(job_id, current_user.email, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    if output is None or output.get("status") == "expired":
+        return JobResponse(
+            job_id=job_id,
+            status="queued" if output is None else "expired",
+            image_file_name=job["image_file_name"],
+        )
+    return JobResponse(
+        job_id=job_id,
+        status="done",
+        prediction=output["prediction"],
+        score=output["score"],
+        stage=output.get("stage"),
+        image_file_name=job["image_file_name"],
+    )
+
+
+@router.get("/latency", response_model=Dict[str, StageLatency])
+async def read_latency(current_user=Depends(get_current_user)):
+    # Aggregated over every API process, see `timing.STAGES` for the stages
+    return await latency_stats()
@@ -1,3 +1,5 @@
+from typing import Dict, List, Optional
+
 from pydantic import BaseModel
 
 
@@ -9,4 +11,36 @@ class PredictResponse(BaseModel):
     success: bool
     prediction: str
     score: float
+    stage: Optional[str]
+    image_file_name: str
+
+
+class BatchPredictItem(BaseModel):
+    success: bool
+    prediction: Optional[str]
+    score: Optional[float]
+    stage: Optional[str]
     image_file_name: str
+
+
+class BatchPredictResponse(BaseModel):
+    success: bool
+    predictions: List[BatchPredictItem]
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    prediction: Optional[str]
+    score: Optional[float]
+    stage: Optional[str]
+    image_file_name: Optional[str]
+
+
+class StageLatency(BaseModel):
+    count: int
+    mean_ms: float
+    p50_ms: Optional[float]
+    p95_ms: Optional[float]
+    p99_ms: Optional[float]
+    buckets: Dict[str, int]
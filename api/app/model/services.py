@@ -1,79 +1,846 @@
+import asyncio
 import json
+import math
 import time
+from multiprocessing import shared_memory
 from uuid import uuid4
+from fastapi import HTTPException, status
 from loguru import logger
-import redis
 
-from .. import settings
+from .. import settings, timing
+from ..redis_client import db
 
-# TODO
-# Connect to Redis and assign to variable `db``
-# Make use of settings.py module to get Redis settings like host, port, etc.
-db = redis.Redis(
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB_ID,
-    host=settings.REDIS_IP,
-)
 
+class ResultListener:
+    """
+    Subscribes once per API process to the channel where the ML service
+    publishes its results, and resolves the futures of the requests
+    waiting for each job ID.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.waiters = {}
+        self.task = None
+        self.loop = None
+        self.subscribed = None
+
+    def start(self):
+        """
+        Starts the listening task on the running event loop, unless it is
+        already running there.
+        """
+        loop = asyncio.get_running_loop()
+        if self.task is not None and not self.task.done() and self.loop is loop:
+            return
+        self.loop = loop
+        self.subscribed = asyncio.Event()
+        self.task = loop.create_task(self.listen())
+
+    async def ready(self):
+        """
+        Waits until the channel subscription is active so a job queued
+        afterwards can't be answered before we listen. Gives up after
+        `settings.API_RESULT_FALLBACK_INTERVAL` seconds, when waiting
+        requests start reading the result key anyway.
+        """
+        self.start()
+        try:
+            await asyncio.wait_for(
+                self.subscribed.wait(), settings.API_RESULT_FALLBACK_INTERVAL
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Not subscribed to {self.channel} yet")
+
+    def subscribe(self, job_id):
+        """
+        Returns a future that will be resolved with the job output once the
+        ML service publishes it. Must be called, and `ready()` awaited,
+        before the job is queued so the result can't be missed.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job_id, set()).add(future)
+        return future
+
+    def unsubscribe(self, job_id, future):
+        futures = self.waiters.get(job_id)
+        if futures is None:
+            return
+        futures.discard(future)
+        if not futures:
+            del self.waiters[job_id]
 
-async def model_predict(image_name):
-    print(f"Processing image {image_name}...")
+    def dispatch(self, data):
+        """
+        Hands a published message to the futures waiting for its job ID.
+        """
+        output = json.loads(data)
+        for future in self.waiters.get(output["id"], ()):
+            if not future.done():
+                future.set_result(output)
+
+    async def listen(self):
+        while True:
+            pubsub = db.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                self.subscribed.set()
+                logger.info(f"Listening for results on {self.channel}")
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0
+                    )
+                    if message is not None:
+                        self.dispatch(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Waiting requests fall back to reading the result key
+                logger.error(f"Results listener failed, reconnecting: {e}")
+                await asyncio.sleep(settings.API_RESULT_FALLBACK_INTERVAL)
+            finally:
+                self.subscribed.clear()
+                await pubsub.reset()
+
+
+listener = ResultListener(settings.REDIS_RESULTS_CHANNEL)
+
+
+async def wait_for_result(job_id, future, timeout=None):
     """
-    Receives an image name and queues the job into Redis.
-    Will loop until getting the answer from our ML service.
+    Waits for the output of a job. The result normally arrives pushed
+    through `future`; every `settings.API_RESULT_FALLBACK_INTERVAL` seconds
+    the result key is also checked in case the message was missed.
+
+    Parameters
+    ----------
+    job_id : str
+        ID of the job being waited on.
+    future : asyncio.Future
+        Future returned by `listener.subscribe(job_id)`.
+    timeout : float, optional
+        Maximum number of seconds to wait, forever if None.
+
+    Returns
+    -------
+    dict or None
+        Job output as sent by the ML service, None if `timeout` expired.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        interval = settings.API_RESULT_FALLBACK_INTERVAL
+        if deadline is not None:
+            interval = min(interval, deadline - loop.time())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(interval, 0))
+        except asyncio.TimeoutError:
+            pass
+
+        # Fallback: attempt to get model predictions using job_id
+        output = await db.get(job_id)
+        if output is not None:
+            return json.loads(output.decode("utf-8"))
+        if deadline is not None and loop.time() >= deadline:
+            return None
+
+
+# Live worker stats, cached for settings.WORKER_CHECK_INTERVAL seconds
+worker_stats = {"value": None, "expires": 0.0}
+
+
+async def live_workers():
+    """
+    Capacity and throughput of the live ML workers, summed from the
+    heartbeats they keep in Redis. Workers whose heartbeat expired are
+    dropped from the registry.
+
+    Returns
+    -------
+    dict
+        "capacity": images taken per forward pass, 0 if no worker is
+        alive, and "throughput": images processed per second.
+    """
+    now = time.monotonic()
+    if worker_stats["value"] is not None and now < worker_stats["expires"]:
+        return worker_stats["value"]
+
+    workers = [w.decode("utf-8") for w in await db.zrange(settings.WORKERS_KEY, 0, -1)]
+    heartbeats = []
+    if workers:
+        heartbeats = await db.mget([settings.READY_PREFIX + w for w in workers])
+        dead = [w for w, heartbeat in zip(workers, heartbeats) if heartbeat is None]
+        if dead:
+            logger.warning(f"Removing ML workers without heartbeat: {dead}")
+            await db.zrem(settings.WORKERS_KEY, *dead)
+    heartbeats = [json.loads(h) for h in heartbeats if h is not None]
+    stats = {
+        "capacity": sum(h["capacity"] for h in heartbeats),
+        "throughput": sum(h.get("throughput", 0) for h in heartbeats),
+    }
+
+    worker_stats.update(value=stats, expires=now + settings.WORKER_CHECK_INTERVAL)
+    return stats
+
+
+async def check_workers():
+    """
+    Fails fast with 503 Service Unavailable when no ML worker is alive to
+    take a new job, instead of queueing a job nobody will answer.
+    """
+    workers = await live_workers()
+    if workers["capacity"] <= 0:
+        logger.error("No ML workers alive, rejecting request")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Model service unavailable, try again later.",
+        )
+
+
+def job_images(job_data):
+    """
+    Number of images of a job, grouped jobs carry several.
+    """
+    return len(job_data.get("image_names", [job_data.get("image_name")]))
+
+
+def push_job(pipe, payload, images=1):
+    """
+    Queues a job with `settings.QUEUE_TRANSPORT` on a Redis pipeline, and
+    adds its images to the count in `settings.QUEUED_IMAGES_KEY` that
+    admission control reads. The ML service takes them off once it
+    answers the job.
+
+    Parameters
+    ----------
+    pipe : redis.client.Pipeline
+        Pipeline, the first result of the commands added here is the
+        stream message ID (list length with the list transport).
+    payload : str
+        JSON job payload.
+    images : int
+        Number of images of the job.
+    """
+    if settings.QUEUE_TRANSPORT == "stream":
+        pipe.xadd(
+            settings.REDIS_STREAM,
+            {"job": payload},
+            maxlen=settings.STREAM_MAXLEN,
+            approximate=True,
+        )
+    else:
+        pipe.lpush(settings.REDIS_QUEUE, payload)
+    pipe.incrby(settings.QUEUED_IMAGES_KEY, images)
+
+
+async def remove_job(payload, queued, images=1):
+    """
+    Takes back a job queued with `push_job()` if no ML worker got it yet,
+    along with its images in the queued count. Stream jobs a worker
+    already read are deleted too, but left in the count for the worker to
+    take off when it answers them.
+
+    Parameters
+    ----------
+    payload : str
+        JSON job payload.
+    queued : bytes or int
+        Stream message ID, or list length, `push_job()` queued it with.
+    images : int
+        Number of images of the job.
+    """
+    if settings.QUEUE_TRANSPORT == "stream":
+        # In a transaction, no worker can read the job in between
+        pipe = db.pipeline()
+        pipe.xpending_range(
+            settings.REDIS_STREAM,
+            settings.REDIS_STREAM_GROUP,
+            min=queued,
+            max=queued,
+            count=1,
+        )
+        pipe.xdel(settings.REDIS_STREAM, queued)
+        pending, removed = await pipe.execute()
+        removed = removed and not pending
+    else:
+        removed = await db.lrem(settings.REDIS_QUEUE, 1, payload)
+    if removed:
+        await db.decrby(settings.QUEUED_IMAGES_KEY, images)
+
+
+async def queued_images():
+    """
+    Number of images waiting for the ML service or being processed, from
+    the count kept in `settings.QUEUED_IMAGES_KEY` (see `push_job()`).
+    """
+    queued = await db.get(settings.QUEUED_IMAGES_KEY)
+    return max(int(queued or 0), 0)
+
+
+async def admit(images=1):
+    """
+    Admission control. Estimates how long new images would wait for the
+    ML service, from the images already queued and the throughput of the
+    live workers, and rejects the request when the estimate is over
+    `settings.ADMISSION_MAX_WAIT` seconds so accepted requests keep a
+    bounded latency.
+
+    Parameters
+    ----------
+    images : int
+        Number of images the request would send to the ML service.
+
+    Raises
+    ------
+    HTTPException
+        503 with a Retry-After header, in seconds, telling when the queue
+        should be back under the limit.
+    """
+    if settings.ADMISSION_MAX_WAIT <= 0:
+        return
+    workers = await live_workers()
+    if workers["throughput"] <= 0:
+        # No measure yet, `check_workers()` still rejects if nobody is alive
+        return
+    queued = await queued_images()
+    wait = (queued + images) / workers["throughput"]
+    if wait > settings.ADMISSION_MAX_WAIT:
+        retry_after = max(math.ceil(wait - settings.ADMISSION_MAX_WAIT), 1)
+        logger.warning(
+            f"Rejecting request, estimated wait {wait:.1f}s with {queued} images queued"
+        )
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Model service overloaded, try again later.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+async def get_cached_prediction(image_name):
+    """
+    Looks up a previous prediction for this image in Redis, so repeated
+    uploads can be answered without going through the ML service. A hit
+    refreshes the prediction TTL and marks it as recently used in the
+    cache index, so hot images are the last ones evicted.
+
+    Parameters
+    ----------
+    image_name : str
+        Name for the image uploaded by the user (content hash).
+
+    Returns
+    -------
+    prediction, score, stage : tuple(str, float, str) or None
+        Cached prediction and the model stage that answered (None if it
+        wasn't recorded), or None if there is none.
+    """
+    try:
+        key = f"{settings.CACHE_PREFIX}:{image_name}"
+        cached = await db.getex(key, ex=settings.CACHE_TTL)
+        pipe = db.pipeline(transaction=False)
+        if cached is None:
+            pipe.hincrby(settings.CACHE_STATS_KEY, "misses", 1)
+        else:
+            pipe.hincrby(settings.CACHE_STATS_KEY, "hits", 1)
+            # Only updated if still indexed, evicted entries are gone
+            pipe.zadd(settings.CACHE_INDEX_KEY, {image_name: time.time()}, xx=True)
+        await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error reading prediction cache: {e}")
+        return None
+    if cached is None:
+        return None
+    cached = json.loads(cached)
+    return cached["class"], cached["score"], cached.get("stage")
+
+
+# Jobs being processed by this API process, by image name. Concurrent
+# requests for the same image share the same task instead of queueing
+# their own job.
+inflight = {}
+
+
+def job_deadline(timeout):
+    """
+    Enqueue time and absolute deadline, as Unix timestamps, for a job
+    payload. The ML service drops jobs whose deadline passed instead of
+    running them for a client that already gave up.
+
+    Parameters
+    ----------
+    timeout : float
+        Seconds the job stays useful.
+
+    Returns
+    -------
+    dict
+        "enqueued_at" and "deadline" fields of the job payload.
+    """
+    now = time.time()
+    return {"enqueued_at": now, "deadline": now + timeout}
+
+
+async def stage_images(job_id, contents):
+    """
+    Hands image bytes to the ML service with `settings.IMAGE_TRANSPORT`,
+    so it decodes them from memory instead of reading the upload folder.
+    With "redis" each image is stored in its own key, expiring with the
+    job; with "shm" in a POSIX shared memory segment holding the content
+    size as 8 little-endian bytes followed by the content. Must match the
+    ML service (`read_images()` in ml_service.py).
+
+    Parameters
+    ----------
+    job_id : str
+        ID of the job the images are sent with.
+    contents : dict
+        Image content by image name.
+
+    Returns
+    -------
+    dict
+        "image_transport" and "image_refs", the key or segment name of
+        each image, fields of the job payload.
+    """
+    refs = {}
+    if settings.IMAGE_TRANSPORT == "shm":
+        for index, (image_name, content) in enumerate(contents.items()):
+            ref = f"{settings.SHM_PREFIX}{job_id}-{index}"
+            segment = shared_memory.SharedMemory(
+                name=ref, create=True, size=len(content) + 8
+            )
+            segment.buf[:8] = len(content).to_bytes(8, "little")
+            segment.buf[8 : len(content) + 8] = content
+            segment.close()
+            refs[image_name] = ref
+    else:
+        pipe = db.pipeline(transaction=False)
+        for image_name, content in contents.items():
+            ref = f"{settings.IMAGE_PREFIX}{job_id}:{image_name}"
+            pipe.set(ref, content, ex=math.ceil(settings.API_REQUEST_TIMEOUT))
+            refs[image_name] = ref
+        await pipe.execute()
+    return {"image_transport": settings.IMAGE_TRANSPORT, "image_refs": refs}
+
+
+async def release_images(job_data):
+    """
+    Frees the image bytes staged for a job by `stage_images()`, once its
+    output arrived or nobody waits for it anymore.
+    """
+    refs = list(job_data.get("image_refs", {}).values())
+    if not refs:
+        return
+    try:
+        if job_data["image_transport"] == "shm":
+            for ref in refs:
+                try:
+                    segment = shared_memory.SharedMemory(name=ref)
+                except FileNotFoundError:
+                    continue
+                segment.close()
+                segment.unlink()
+        else:
+            await db.delete(*refs)
+    except Exception as e:
+        logger.error(f"Error releasing images of job {job_data['id']}: {e}")
+
+
+async def run_job(job_data, contents=None, timeout=None):
+    """
+    Sends a job to the model service using Redis and waits for its output
+    for at most `settings.API_REQUEST_TIMEOUT` seconds.
+
+    Parameters
+    ----------
+    job_data : dict
+        Job payload, its "id" is used to track the result.
+    contents : dict, optional
+        Content of the images not stored in the upload folder, by image
+        name, sent along with the job (see `stage_images()`).
+    timeout : float, optional
+        Seconds to wait instead of `settings.API_REQUEST_TIMEOUT`, what is
+        left of the request time budget.
+
+    Returns
+    -------
+    dict
+        Job output as sent by the ML service.
+
+    Raises
+    ------
+    HTTPException
+        503 if no ML worker is alive, 504 if the output didn't arrive in
+        time or the ML service dropped the job as expired.
+    """
+    await check_workers()
+    job_id = job_data["id"]
+    if contents:
+        job_data.update(await stage_images(job_id, contents))
+    job_data["timestamps"] = timing.job_timestamps()
+    payload = json.dumps(job_data)
+    logger.info(f"Job data: {job_data}")
+
+    # Start listening for the result before the job is queued so a fast
+    # answer can't be missed
+    future = listener.subscribe(job_id)
+    try:
+        await listener.ready()
+        pipe = db.pipeline(transaction=False)
+        push_job(pipe, payload, job_images(job_data))
+        queued, _ = await pipe.execute()
+        if timeout is None:
+            timeout = settings.API_REQUEST_TIMEOUT
+        output = await wait_for_result(job_id, future, timeout=timeout)
+    finally:
+        listener.unsubscribe(job_id, future)
+        await release_images(job_data)
+
+    if output is None or output.get("status") == "expired":
+        # Nobody is waiting anymore, take the job back if it's still queued
+        logger.error(f"Job {job_id} timed out")
+        if output is None:
+            await remove_job(payload, queued, job_images(job_data))
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Model service did not answer in time.",
+        )
+    return output
+
+
+async def join_inflight_job(image_name, timeout):
+    """
+    Waits for a job queued by another API process for the same image, if
+    there is one. Uses the marker left in Redis by `queue_job()`.
 
     Parameters
     ----------
     image_name : str
         Name for the image uploaded by the user.
+    timeout : float
+        Seconds to wait at most, on top of the marker TTL.
 
     Returns
     -------
-    prediction, score : tuple(str, float)
-        Model predicted class as a string and the corresponding confidence
-        score as a number.
+    dict or None
+        Job output, or None if no job is in flight for this image, it
+        didn't finish in time or the ML service dropped it as expired.
     """
-    prediction = None
-    score = None
+    job_id = await db.get(settings.INFLIGHT_PREFIX + image_name)
+    if job_id is None:
+        return None
+    job_id = job_id.decode("utf-8")
+    logger.info(f"Waiting for in-flight job {job_id} for image {image_name}")
+    future = listener.subscribe(job_id)
+    try:
+        await listener.ready()
+        timeout = min(timeout, settings.INFLIGHT_TTL)
+        output = await wait_for_result(job_id, future, timeout=timeout)
+    finally:
+        listener.unsubscribe(job_id, future)
+    if output is not None and output.get("status") == "expired":
+        # Queued too long ago for its own client, ours may still be served
+        logger.warning(f"In-flight job {job_id} expired")
+        return None
+    return output
+
+
+async def queue_job(image_name, content=None):
+    """
+    Queues a job for this image into Redis, unless another API process
+    already did, and waits until getting the answer from our ML service.
+
+    Parameters
+    ----------
+    image_name : str
+        Name for the image uploaded by the user.
+    content : bytes, optional
+        Image content, if it wasn't stored in the upload folder.
+
+    Returns
+    -------
+    dict
+        Job output as sent by the ML service.
+
+    Raises
+    ------
+    HTTPException
+        504 if no output arrived within `settings.API_REQUEST_TIMEOUT`
+        seconds, waiting for another process included.
+    """
+    # A single time budget covers joining another job and running our own
+    deadline = time.time() + settings.API_REQUEST_TIMEOUT
 
     # Assign an unique ID for this job and add it to the queue.
     # We need to assing this ID because we must be able to keep track
     # of this particular job across all the services
-    # TODO
     job_id = uuid4().hex
 
+    # Mark the image as in flight so other API processes wait for this job
+    # instead of queueing their own. The marker expires in case we die.
+    inflight_key = settings.INFLIGHT_PREFIX + image_name
+    owner = await db.set(inflight_key, job_id, nx=True, ex=settings.INFLIGHT_TTL)
+    if not owner:
+        output = await join_inflight_job(image_name, deadline - time.time())
+        if output is not None:
+            return output
+        if deadline - time.time() <= 0:
+            logger.error(f"In-flight job for image {image_name} timed out")
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Model service did not answer in time.",
+            )
+        await db.set(inflight_key, job_id, ex=settings.INFLIGHT_TTL)
+
     # Create a dict with the job data we will send through Redis having the
     # following shape:
     # {
     #    "id": str,
     #    "image_name": str,
+    #    "enqueued_at": float,
+    #    "deadline": float,
     # }
-    # TODO
-    # job_data = {"id": job_id, "image_name": image_name}
-    job_data = [job_id, image_name]
-    logger.info(f"Job data: {job_data}")
-    # Send the job to the model service using Redis
-    # Hint: Using Redis `lpush()` function should be enough to accomplish this.
-    # TODO
-    db.lpush(settings.REDIS_QUEUE, json.dumps(job_data))
-    # Loop until we received the response from our ML model
-    while True:
-        # Attempt to get model predictions using job_id
-        # Hint: Investigate how can we get a value using a key from Redis
-        # TODO
-        output = db.get(job_id)
+    # plus "image_transport" and "image_refs" if the image is sent along
+    job_data = {
+        "id": job_id,
+        "image_name": image_name,
+        **job_deadline(deadline - time.time()),
+    }
+    contents = None if content is None else {image_name: content}
+    try:
+        return await run_job(job_data, contents, timeout=deadline - time.time())
+    finally:
+        current = await db.get(inflight_key)
+        if current is not None and current.decode("utf-8") == job_id:
+            await db.delete(inflight_key)
+
+
+async def model_predict(image_name, content=None):
+    """
+    Receives an image name and queues the job into Redis.
+    Will wait until getting the answer from our ML service.
+    Concurrent calls for the same image, in this or any other API process,
+    share a single job.
+
+    Parameters
+    ----------
+    image_name : str
+        Name for the image uploaded by the user.
+    content : bytes, optional
+        Image content, if it wasn't stored in the upload folder (see
+        `settings.IMAGE_TRANSPORT`).
+
+    Returns
+    -------
+    prediction, score, stage : tuple(str, float, str)
+        Model predicted class as a string, the corresponding confidence
+        score as a number and the model stage that answered, None if the
+        ML service didn't say.
+    """
+    logger.info(f"Processing image {image_name}...")
+
+    task = inflight.get(image_name)
+    if task is None:
+        task = asyncio.ensure_future(queue_job(image_name, content))
+        inflight[image_name] = task
 
-        # Check if the text was correctly processed by our ML model
-        # Don't modify the code below, it should work as expected
+        def forget(task):
+            if inflight.get(image_name) is task:
+                del inflight[image_name]
+
+        task.add_done_callback(forget)
+    else:
+        logger.info(f"Joining in-flight job for image {image_name}")
+
+    # Shielded so a client going away doesn't cancel the job for the others
+    output = await asyncio.shield(task)
+    timing.add_worker_stages(output)
+    return output["prediction"], output["score"], output.get("stage")
+
+
+async def model_predict_batch(image_names, contents=None):
+    """
+    Receives several image names and queues them into Redis as a single
+    grouped job, so the ML service runs them in one forward pass.
+
+    Parameters
+    ----------
+    image_names : list(str)
+        Names for the images uploaded by the user.
+    contents : dict, optional
+        Content of the images not stored in the upload folder, by image
+        name.
+
+    Returns
+    -------
+    list(tuple(str, float, str))
+        One (prediction, score, stage) tuple per image, in the same order
+        as `image_names`.
+    """
+    logger.info(f"Processing {len(image_names)} images...")
+    job_data = {
+        "id": uuid4().hex,
+        "image_names": list(image_names),
+        **job_deadline(settings.API_REQUEST_TIMEOUT),
+    }
+    output = await run_job(job_data, contents)
+    timing.add_worker_stages(output)
+    return [
+        (item["prediction"], item["score"], item.get("stage"))
+        for item in output["predictions"]
+    ]
+
+
+async def submit_job(image_name, owner):
+    """
+    Queues a job for this image into Redis and returns right away. The
+    job is tracked for `settings.RESULT_TTL` seconds so its result can be
+    fetched later with `get_job()`.
+
+    Parameters
+    ----------
+    image_name : str
+        Name for the image uploaded by the user.
+    owner : str
+        Email of the user submitting the job.
+
+    Returns
+    -------
+    str
+        ID of the new job.
+    """
+    job_id = uuid4().hex
+    job = {"owner": owner, "image_file_name": image_name}
+    pipe = db.pipeline(transaction=False)
+    pipe.set(settings.JOB_PREFIX + job_id, json.dumps(job), ex=settings.RESULT_TTL)
+
+    cached = await get_cached_prediction(image_name)
+    if cached is not None:
+        # Nothing to queue, the result is available straight away
+        prediction, score, stage = cached
+        output = {"prediction": prediction, "score": score}
+        if stage is not None:
+            output["stage"] = stage
+        pipe.set(job_id, json.dumps(output), ex=settings.RESULT_TTL)
+    else:
+        await check_workers()
+        # Once the job key expires nobody can read the result anymore
+        job_data = {
+            "id": job_id,
+            "image_name": image_name,
+            **job_deadline(settings.RESULT_TTL),
+        }
+        logger.info(f"Job data: {job_data}")
+        push_job(pipe, json.dumps(job_data))
+    await pipe.execute()
+    return job_id
+
+
+async def get_job(job_id, owner, wait=0):
+    """
+    Returns a job submitted with `submit_job()` and its output, if the ML
+    service already sent it. The owner is checked before waiting, so other
+    users can't hold a request open on a job they can't see.
+
+    Parameters
+    ----------
+    job_id : str
+        ID of the job.
+    owner : str
+        Email of the user asking for the job.
+    wait : float
+        Seconds to wait for the output if it's not available yet.
+
+    Returns
+    -------
+    job, output : tuple(dict, dict)
+        Job data (None if the job is unknown, expired or submitted by
+        another user) and its output (None if still pending).
+    """
+    job = await db.get(settings.JOB_PREFIX + job_id)
+    if job is None:
+        return None, None
+    job = json.loads(job)
+    if job["owner"] != owner:
+        return None, None
+
+    if wait <= 0:
+        output = await db.get(job_id)
+        return job, None if output is None else json.loads(output)
+
+    future = listener.subscribe(job_id)
+    try:
+        await listener.ready()
+        output = await db.get(job_id)
         if output is not None:
-            output = json.loads(output.decode("utf-8"))
-            prediction = output["prediction"]
-            score = output["score"]
+            return job, json.loads(output)
+        return job, await wait_for_result(job_id, future, timeout=wait)
+    finally:
+        listener.unsubscribe(job_id, future)
 
-            db.delete(job_id)
-            break
 
-        # Sleep some time waiting for model results
-        time.sleep(settings.API_SLEEP)
+async def record_latency(stages):
+    """
+    Adds the stage durations of a request to the latency histograms kept
+    in Redis, shared by all the API processes. Failing here is only
+    logged.
+
+    Parameters
+    ----------
+    stages : dict
+        Duration in milliseconds by stage name.
+    """
+    try:
+        pipe = db.pipeline(transaction=False)
+        for stage, ms in stages.items():
+            key = settings.LATENCY_PREFIX + stage
+            bucket = next((b for b in settings.LATENCY_BUCKETS if ms <= b), "+Inf")
+            pipe.hincrby(key, str(bucket), 1)
+            pipe.hincrby(key, "count", 1)
+            pipe.hincrbyfloat(key, "sum", ms)
+        await pipe.execute()
+    except Exception as e:
+        logger.error(f"Error recording latency: {e}")
+
+
+async def latency_stats():
+    """
+    Summary of the latency histograms of every stage.
+
+    Returns
+    -------
+    dict
+        By stage: number of requests, mean and p50, p95 and p99 latency in
+        milliseconds (the upper bound of their bucket, None past the last
+        one), and the cumulative number of requests under each bucket
+        upper bound.
+    """
+    pipe = db.pipeline(transaction=False)
+    for stage in timing.STAGES:
+        pipe.hgetall(settings.LATENCY_PREFIX + stage)
+    histograms = await pipe.execute()
 
-    return prediction, score
+    stats = {}
+    for stage, histogram in zip(timing.STAGES, histograms):
+        histogram = {k.decode("utf-8"): v for k, v in histogram.items()}
+        count = int(histogram.get("count", 0))
+        if not count:
+            continue
+        buckets, seen = {}, 0
+        for upper in settings.LATENCY_BUCKETS + ["+Inf"]:
+            seen += int(histogram.get(str(upper), 0))
+            buckets[str(upper)] = seen
+        quantiles = {}
+        for name, quantile in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            upper = next(
+                (u for u, n in buckets.items() if n >= quantile * count), "+Inf"
+            )
+            quantiles[name] = None if upper == "+Inf" else float(upper)
+        stats[stage] = {
+            "count": count,
+            "mean_ms": round(float(histogram["sum"]) / count, 2),
+            **quantiles,
+            "buckets": buckets,
+        }
+    return stats
@@ -0,0 +1,14 @@
+import redis.asyncio as redis
+
+from . import settings
+
+# Connection shared by the modules of the API talking to Redis. All the
+# requests served by this worker share the same connection pool, so
+# waiting for a prediction never blocks the event loop.
+pool = redis.ConnectionPool(
+    port=settings.REDIS_PORT,
+    db=settings.REDIS_DB_ID,
+    host=settings.REDIS_IP,
+    max_connections=settings.REDIS_MAX_CONNECTIONS,
+)
+db = redis.Redis(connection_pool=pool)
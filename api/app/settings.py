@@ -13,6 +13,30 @@ API_DEBUG = True
 # We will store images uploaded by the user on this folder
 UPLOAD_FOLDER = "uploads/"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Uploads are sharded by hash prefix (see blobstore.py), their last
+# access time, size and the total of sizes are indexed for the ML service
+# garbage collector, must match its settings
+UPLOAD_ATIME_KEY = "uploads:atime"
+UPLOAD_SIZE_KEY = "uploads:size"
+UPLOAD_TOTAL_KEY = "uploads:bytes"
+# How /model/predict and /model/predict/batch hand images to the ML
+# service: "disk" (the upload folder, on a volume shared with it),
+# "redis" (bytes stored under IMAGE_PREFIX + job ID + image name while the
+# job runs) or "shm" (POSIX shared memory segments, named SHM_PREFIX + job
+# ID + index, when co-located with the ML service and sharing its IPC
+# namespace). Only images up to INLINE_MAX_BYTES skip the disk, larger
+# ones and the jobs submitted through /model/jobs are still stored there.
+IMAGE_TRANSPORT = os.getenv("IMAGE_TRANSPORT", "disk")
+INLINE_MAX_BYTES = int(os.getenv("INLINE_MAX_BYTES", 2**20))
+IMAGE_PREFIX = "image:"
+SHM_PREFIX = "ml_image-"
+# With IMAGE_TRANSPORT "redis" or "shm", IMAGE_PRERESIZE makes the API
+# decode uploads itself and send the ML service a lossless PNG at the
+# model input size, whatever the size of the original. Decoding must match
+# the ML service (model/decode.py and its DECODE_DRAFT_FACTOR setting).
+IMAGE_PRERESIZE = os.getenv("IMAGE_PRERESIZE", "false").lower() in ("1", "true", "yes")
+MODEL_INPUT_SIZE = (224, 224)
+DECODE_DRAFT_FACTOR = int(os.getenv("DECODE_DRAFT_FACTOR", 2))
 
 # REDIS settings
 # Queue name
@@ -23,9 +47,78 @@ REDIS_PORT = 6379
 REDIS_DB_ID = 0
 # Host IP
 REDIS_IP = os.getenv("REDIS_IP", "redis")
-# Sleep parameters which manages the
-# interval between requests to our redis queue
-API_SLEEP = 0.05
+# Job transport to the ML service, must match its settings: "list"
+# (LPUSH on REDIS_QUEUE) or "stream" (XADD on REDIS_STREAM, capped to about
+# STREAM_MAXLEN entries, consumed by the REDIS_STREAM_GROUP group which
+# deletes the jobs it finishes)
+QUEUE_TRANSPORT = os.getenv("QUEUE_TRANSPORT", "list")
+REDIS_STREAM = "service_stream"
+REDIS_STREAM_GROUP = "ml_service"
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 100000))
+# Images of the jobs queued or being processed, added when a job is pushed
+# and subtracted when the ML service answers it or the job is taken back
+QUEUED_IMAGES_KEY = "queue:images"
+# Size of the connection pool shared by all requests of an API worker
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 512))
+# Prediction cache written by the ML service, must match its settings: the
+# namespace depends on the model version, the inference backend and the
+# model cascade
+MODEL_NAME = "resnet50"
+MODEL_VERSION = os.getenv("MODEL_VERSION", "1")
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "false").lower() in ("1", "true", "yes")
+CASCADE_MODEL = "mobilenet_v2"
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", 0.9))
+CACHE_PREFIX = f"prediction:{MODEL_NAME}:{MODEL_VERSION}:{INFERENCE_BACKEND}"
+if CASCADE_ENABLED:
+    CACHE_PREFIX += f":{CASCADE_MODEL}-{CASCADE_THRESHOLD}"
+# Hits refresh the TTL of a prediction and its last use in the
+# CACHE_INDEX_KEY sorted set, from which the least recently used ones are
+# evicted. Hits and misses are only counted here, in CACHE_STATS_KEY.
+CACHE_TTL = int(os.getenv("CACHE_TTL", 7 * 24 * 3600))
+CACHE_INDEX_KEY = f"{CACHE_PREFIX}:_index"
+CACHE_STATS_KEY = "prediction_cache:stats"
+# Maximum number of images accepted by /model/predict/batch
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 32))
+# Channel where the ML service publishes job results
+REDIS_RESULTS_CHANNEL = "service_results"
+# Results are pushed through REDIS_RESULTS_CHANNEL, the result key is
+# only read every API_RESULT_FALLBACK_INTERVAL seconds in case a message
+# was missed
+API_RESULT_FALLBACK_INTERVAL = 1.0
+# Seconds job results are kept by the ML service, also used for the
+# jobs submitted through /model/jobs
+RESULT_TTL = int(os.getenv("RESULT_TTL", 300))
+# Jobs submitted through /model/jobs are tracked under JOB_PREFIX + job ID,
+# clients may long-poll for their result up to JOB_MAX_WAIT seconds
+JOB_PREFIX = "job:"
+JOB_MAX_WAIT = 30
+# Concurrent uploads of the same image share one job. The job queued for
+# an image is advertised to other API processes under INFLIGHT_PREFIX +
+# image name for at most INFLIGHT_TTL seconds.
+INFLIGHT_PREFIX = "inflight:"
+INFLIGHT_TTL = 30
+# ML workers register in the sorted set WORKERS_KEY and keep the key
+# READY_PREFIX + worker ID alive while they take jobs, must match the ML
+# service settings. Requests are rejected with 503 when no worker is
+# alive, the live capacity being read at most every WORKER_CHECK_INTERVAL
+# seconds.
+WORKERS_KEY = "ml_service:workers"
+READY_PREFIX = "ml_service:ready:"
+WORKER_CHECK_INTERVAL = 1.0
+# Seconds a request waits for the ML service before failing with 504
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", 30))
+# Admission control: the queue wait of a new prediction is estimated from
+# the queued images and the throughput the workers advertise. Above
+# ADMISSION_MAX_WAIT seconds the request is rejected with 503 and a
+# Retry-After header, 0 accepts everything.
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", 10))
+# Latency of each stage of the model endpoints (see timing.py), returned
+# in the Server-Timing header and aggregated into histograms kept in the
+# Redis hashes LATENCY_PREFIX + stage, with one counter per bucket upper
+# bound in LATENCY_BUCKETS (milliseconds) and "+Inf"
+LATENCY_PREFIX = "latency:"
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
 
 # Database settings
 DATABASE_USERNAME = os.getenv("POSTGRES_USER")
@@ -0,0 +1,101 @@
+import time
+from contextvars import ContextVar
+
+# Stages measured by the ML service, between two of the timestamps it
+# returns with a job output. "queue" and "deliver" compare the clocks of
+# the API and the ML service hosts.
+WORKER_STAGES = [
+    ("queue", "enqueued", "dequeued"),
+    ("decode_wait", "dequeued", "decode_start"),
+    ("decode", "decode_start", "decoded"),
+    ("batch_wait", "decoded", "infer_start"),
+    ("inference", "infer_start", "inferred"),
+    ("publish", "inferred", "published"),
+    ("deliver", "published", "answered"),
+]
+
+# Stages timed in the API by the model endpoints
+API_STAGES = ["receive", "cache", "admit", "model"]
+
+STAGES = API_STAGES + [stage for stage, _, _ in WORKER_STAGES] + ["total"]
+
+
+class RequestTiming:
+    """
+    Timeline of a request: how long each stage took, in milliseconds. The
+    API stages are timed with `mark()`, the ML service ones are read from
+    the timestamps it returns with the job output.
+    """
+
+    def __init__(self):
+        self.received = time.time()
+        self.last = self.received
+        self.stages = {}
+
+    def mark(self, stage):
+        """
+        Ends `stage`, timed from the end of the previous one.
+        """
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self.last) * 1000
+        self.last = now
+
+    def add_worker_stages(self, timestamps):
+        """
+        Adds the ML service stages from the timestamps of a job output.
+
+        Parameters
+        ----------
+        timestamps : dict
+            Unix timestamps by name, see `WORKER_STAGES`.
+        """
+        timestamps = {**timestamps, "answered": time.time()}
+        for stage, start, end in WORKER_STAGES:
+            if start in timestamps and end in timestamps:
+                # Clocks of different hosts may disagree a little
+                duration = max(timestamps[end] - timestamps[start], 0.0)
+                self.stages[stage] = duration * 1000
+
+    def finish(self):
+        self.stages["total"] = (time.time() - self.received) * 1000
+
+    def header(self):
+        """
+        Value of the Server-Timing response header.
+        """
+        return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in self.stages.items())
+
+
+# Timeline of the request being served, set by the middleware in main.py
+request_timing = ContextVar("request_timing", default=None)
+
+
+def mark(stage):
+    """
+    Ends a stage of the current request, if it is being timed.
+    """
+    timing = request_timing.get()
+    if timing is not None:
+        timing.mark(stage)
+
+
+def add_worker_stages(output):
+    """
+    Adds the ML service stages of a job output to the current request, if
+    it is being timed.
+    """
+    timing = request_timing.get()
+    if timing is not None and "timestamps" in output:
+        timing.add_worker_stages(output["timestamps"])
+
+
+def job_timestamps():
+    """
+    API timestamps sent with a job payload, returned by the ML service
+    with its own added.
+    """
+    timing = request_timing.get()
+    timestamps = {"enqueued": time.time()}
+    if timing is not None:
+        timestamps["received"] = timing.received
+    return timestamps
@@ -1,5 +1,15 @@
 import hashlib
+import io
 import os
+import tempfile
+
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+from . import blobstore
+
+# Size of the chunks uploads are read, hashed and written in
+CHUNK_SIZE = 64 * 1024
 
 
 def allowed_file(filename):
@@ -51,9 +61,180 @@ async def get_file_hash(file):
 
     # Add original file extension
     md5_hash = hashlib.md5()
-    contents = await file.read()
-    md5_hash.update(contents)
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        md5_hash.update(chunk)
     file_extension = os.path.splitext(file.filename)[1]
     await file.seek(0)
     return md5_hash.hexdigest() + file_extension
-    # return hashlib.md5(file.filename).hexdigest() + os.path.splitext(file)[1]
+
+
+def store_stream(stream, filename, upload_folder):
+    """
+    Copies a file object into `upload_folder` under its content address
+    (see `blobstore.blob_path()`), hashing it while it is written. Data
+    goes to a temporary file in the same folder first and is atomically
+    renamed once the hash is known, so readers never see a partial file.
+    If the content is already stored the temporary file is simply dropped.
+
+    Parameters
+    ----------
+    stream : file-like object
+        Binary stream positioned at the beginning of the content.
+    filename : str
+        Original filename, used for its extension.
+    upload_folder : str
+        Folder where uploads are stored.
+
+    Returns
+    -------
+    str
+        New filename based in md5 file hash.
+    """
+    md5_hash = hashlib.md5()
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                md5_hash.update(chunk)
+                f.write(chunk)
+        file_hash = md5_hash.hexdigest() + os.path.splitext(filename)[1]
+        file_path = blobstore.blob_path(upload_folder, file_hash)
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return file_hash
+
+
+async def save_file(file, upload_folder):
+    """
+    Stores an uploaded file in `upload_folder` named after its MD5 hash,
+    reading it only once and in chunks, so memory use doesn't depend on
+    the image size. The copy runs in the thread pool to keep the event
+    loop free. The upload is then recorded in the blob store index.
+
+    Parameters
+    ----------
+    file : fastapi.UploadFile
+        File sent by user.
+    upload_folder : str
+        Folder where uploads are stored.
+
+    Returns
+    -------
+    str
+        New filename based in md5 file hash.
+    """
+    await file.seek(0)
+    file_hash = await run_in_threadpool(
+        store_stream, file.file, file.filename, upload_folder
+    )
+    size = os.path.getsize(blobstore.blob_path(upload_folder, file_hash))
+    await blobstore.touch(file_hash, size)
+    return file_hash
+
+
+async def read_upload(file, max_bytes):
+    """
+    Reads a small upload in memory and hashes it, for the image transports
+    that hand the bytes to the ML service instead of storing them on disk.
+
+    Parameters
+    ----------
+    file : fastapi.UploadFile
+        File sent by user.
+    max_bytes : int
+        Largest upload read in memory.
+
+    Returns
+    -------
+    tuple(str, bytes) or None
+        New filename based in md5 file hash and the file content, or None
+        if the file is larger than `max_bytes`, in which case it must be
+        stored with `save_file()`.
+    """
+    await file.seek(0)
+    content = await file.read(max_bytes + 1)
+    await file.seek(0)
+    if len(content) > max_bytes:
+        return None
+    file_extension = os.path.splitext(file.filename)[1]
+    return hashlib.md5(content).hexdigest() + file_extension, content
+
+
+def resize_stream(stream, target_size, draft_factor):
+    """
+    Decodes an image at `target_size`, exactly as the ML service does
+    (model/decode.py): JPEG files decoded at reduced scale while at least
+    `draft_factor` times the target size, RGB conversion and nearest
+    neighbour resize. The result is encoded as PNG, lossless so the ML
+    service gets the same pixels it would have decoded itself.
+
+    Parameters
+    ----------
+    stream : file-like object
+        Binary stream positioned at the beginning of the content.
+    target_size : tuple(int, int)
+        Model input (height, width).
+    draft_factor : int
+        Minimum ratio between the decoded and the target size, 0 disables
+        reduced decoding.
+
+    Returns
+    -------
+    bytes
+        The resized image as PNG.
+    """
+    height, width = target_size
+    with Image.open(stream) as img:
+        if draft_factor and img.format == "JPEG":
+            img.draft("RGB", (width * draft_factor, height * draft_factor))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.NEAREST)
+        output = io.BytesIO()
+        # Fast compression, the PNG only lives while the job runs
+        img.save(output, format="PNG", compress_level=1)
+    return output.getvalue()
+
+
+async def read_resized(file, target_size, draft_factor):
+    """
+    Resizes an upload to the model input size with `resize_stream()`, in
+    the thread pool so decoding large images doesn't block the event loop.
+    Only meant for images missing from the prediction cache, the upload
+    is hashed beforehand.
+
+    Parameters
+    ----------
+    file : fastapi.UploadFile
+        File sent by user.
+    target_size : tuple(int, int)
+        Model input (height, width).
+    draft_factor : int
+        Minimum ratio between the decoded and the target size.
+
+    Returns
+    -------
+    bytes
+        The resized image as PNG.
+    """
+    await file.seek(0)
+    try:
+        return await run_in_threadpool(
+            resize_stream, file.file, target_size, draft_factor
+        )
+    finally:
+        await file.seek(0)
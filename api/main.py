@@ -1,14 +1,33 @@
+from app import timing
 from app.auth import router as auth_router
 from app.feedback import router as feedback_router
 from app.model import router as model_router
+from app.model.services import record_latency
 from app.user import router as user_router
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
+from starlette.background import BackgroundTask
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 app = FastAPI(title="Image Prediction API", version="0.0.1")
 
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    # Endpoints mark the end of their stages on the request timeline, which
+    # is returned in the Server-Timing header and added to the histograms
+    # once the response is sent, so the Redis round trip isn't part of it
+    request_timing = timing.RequestTiming()
+    timing.request_timing.set(request_timing)
+    response = await call_next(request)
+    if request_timing.stages:
+        request_timing.finish()
+        response.headers["Server-Timing"] = request_timing.header()
+        response.background = BackgroundTask(record_latency, request_timing.stages)
+    return response
+
+
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
     if exc.status_code == 404:
@@ -22,7 +41,8 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
         )
     return JSONResponse(
         status_code=exc.status_code,
-        content={"detail": str(exc.detail)}
+        content={"detail": str(exc.detail)},
+        headers=getattr(exc, "headers", None),
     )
 
 app.include_router(auth_router.router)
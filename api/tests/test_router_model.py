@@ -1,12 +1,27 @@
+from io import BytesIO
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from app.auth.jwt import get_current_user
 from app.model.schema import PredictResponse
-from fastapi import UploadFile
+from fastapi import HTTPException, UploadFile
 from fastapi.testclient import TestClient
 from httpx import AsyncClient
+from app.model import services
 from main import app
+from PIL import Image
+
+
+@pytest.fixture(autouse=True)
+def admit():
+    with patch("app.model.router.admit", new_callable=AsyncMock) as mock_admit:
+        yield mock_admit
+
+
+@pytest.fixture(autouse=True)
+def record_latency():
+    with patch("main.record_latency", new_callable=AsyncMock) as mock_record_latency:
+        yield mock_record_latency
 
 
 @pytest.mark.asyncio
@@ -23,12 +38,12 @@ async def test_predict():
 
     app.dependency_overrides[get_current_user] = lambda: mock_current_user
 
-    with patch("app.model.router.utils.get_file_hash", return_value="fakehash123"):
+    with patch("app.model.router.utils.save_file", return_value="fakehash123"):
         with patch(
             "app.model.router.model_predict", new_callable=AsyncMock
         ) as mock_model_predict:
             with patch("app.model.router.os.path.exists", return_value=False):
-                mock_model_predict.return_value = ("cat", 0.95)
+                mock_model_predict.return_value = ("cat", 0.95, "resnet50")
                 with patch("builtins.open", new_callable=MagicMock):
                     async with AsyncClient(app=app, base_url="http://test") as ac:
                         response = await ac.post(
@@ -52,6 +67,48 @@ async def test_predict():
                         assert response_data["image_file_name"] == "fakehash123"
 
 
+@pytest.mark.asyncio
+async def test_predict_server_timing(record_latency):
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    async def model_predict(image_name, content):
+        services.timing.add_worker_stages(
+            {"timestamps": {"enqueued": 1.0, "dequeued": 1.25}}
+        )
+        return "cat", 0.95, "resnet50"
+
+    with patch("app.model.router.utils.save_file", return_value="fakehash123"):
+        with patch(
+            "app.model.router.get_cached_prediction", new_callable=AsyncMock
+        ) as mock_cached_prediction:
+            with patch("app.model.router.model_predict", side_effect=model_predict):
+                mock_cached_prediction.return_value = None
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict",
+                        files={"file": ("cat.png", b"fake-image-data", "image/png")},
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                assert response.status_code == 200
+                stages = [
+                    metric.split(";")[0]
+                    for metric in response.headers["Server-Timing"].split(", ")
+                ]
+                assert stages == [
+                    "receive",
+                    "cache",
+                    "admit",
+                    "queue",
+                    "model",
+                    "total",
+                ]
+                assert "queue;dur=250.0" in response.headers["Server-Timing"]
+                recorded = record_latency.call_args.args[0]
+                assert list(recorded) == stages
+
+
 @pytest.mark.asyncio
 async def test_predict_fails_bad_extension():
     mock_file = AsyncMock(spec=UploadFile)
@@ -71,7 +128,7 @@ async def test_predict_fails_bad_extension():
             "app.model.router.model_predict", new_callable=AsyncMock
         ) as mock_model_predict:
             with patch("app.model.router.os.path.exists", return_value=False):
-                mock_model_predict.return_value = ("cat", 0.95)
+                mock_model_predict.return_value = ("cat", 0.95, "resnet50")
                 with patch("builtins.open", new_callable=MagicMock):
                     async with AsyncClient(app=app, base_url="http://test") as ac:
                         response = await ac.post(
@@ -90,3 +147,292 @@ async def test_predict_fails_bad_extension():
                         assert response.json() == {
                             "detail": "File type is not supported."
                         }
+
+
+@pytest.mark.asyncio
+async def test_predict_cache_hit():
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    with patch(
+        "app.model.router.utils.save_file", return_value="fakehash123"
+    ) as mock_save_file:
+        with patch(
+            "app.model.router.get_cached_prediction", new_callable=AsyncMock
+        ) as mock_cached_prediction:
+            with patch(
+                "app.model.router.model_predict", new_callable=AsyncMock
+            ) as mock_model_predict:
+                mock_cached_prediction.return_value = ("cat", 0.95, "resnet50")
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict",
+                        files={
+                            "file": ("test_image.png", b"fake-image-data", "image/png")
+                        },
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                    assert response.status_code == 200
+                    response_data = response.json()
+                    assert response_data["prediction"] == "cat"
+                    assert response_data["score"] == 0.95
+                    assert response_data["stage"] == "resnet50"
+                    mock_cached_prediction.assert_awaited_once_with("fakehash123")
+                    mock_model_predict.assert_not_called()
+                    # Hashed and stored in a single pass
+                    mock_save_file.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_predict_image_sent_with_job():
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    with patch("app.model.router.config.IMAGE_TRANSPORT", "redis"):
+        with patch("app.model.router.utils.save_file") as mock_save_file:
+            with patch(
+                "app.model.router.get_cached_prediction", new_callable=AsyncMock
+            ) as mock_cached_prediction:
+                with patch(
+                    "app.model.router.model_predict", new_callable=AsyncMock
+                ) as mock_model_predict:
+                    mock_cached_prediction.return_value = None
+                    mock_model_predict.return_value = ("cat", 0.95, "resnet50")
+                    async with AsyncClient(app=app, base_url="http://test") as ac:
+                        response = await ac.post(
+                            "/model/predict",
+                            files={
+                                "file": ("cat.png", b"fake-image-data", "image/png")
+                            },
+                            headers={"Authorization": "Bearer testtoken"},
+                        )
+
+                    assert response.status_code == 200
+                    file_hash = response.json()["image_file_name"]
+                    mock_model_predict.assert_awaited_once_with(
+                        file_hash, b"fake-image-data"
+                    )
+                    mock_save_file.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_predict_image_resized():
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+    with open("tests/dog.jpeg", "rb") as fp:
+        image_data = fp.read()
+
+    with patch("app.model.router.config.IMAGE_TRANSPORT", "redis"), patch(
+        "app.model.router.config.IMAGE_PRERESIZE", True
+    ):
+        with patch(
+            "app.model.router.get_cached_prediction", new_callable=AsyncMock
+        ) as mock_cached_prediction:
+            with patch(
+                "app.model.router.model_predict", new_callable=AsyncMock
+            ) as mock_model_predict:
+                mock_cached_prediction.return_value = None
+                mock_model_predict.return_value = ("Eskimo_dog", 0.93, "resnet50")
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict",
+                        files={"file": ("dog.jpeg", image_data, "image/jpeg")},
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                assert response.status_code == 200
+                file_hash, content = mock_model_predict.call_args.args
+                assert file_hash == "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+                with Image.open(BytesIO(content)) as img:
+                    assert img.size == (224, 224)
+
+
+@pytest.mark.asyncio
+async def test_predict_cache_hit_not_resized():
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+    with open("tests/dog.jpeg", "rb") as fp:
+        image_data = fp.read()
+
+    with patch("app.model.router.config.IMAGE_TRANSPORT", "redis"), patch(
+        "app.model.router.config.IMAGE_PRERESIZE", True
+    ):
+        with patch(
+            "app.model.router.get_cached_prediction", new_callable=AsyncMock
+        ) as mock_cached_prediction:
+            with patch(
+                "app.model.router.utils.read_resized", new_callable=AsyncMock
+            ) as mock_read_resized:
+                mock_cached_prediction.return_value = ("Eskimo_dog", 0.93, "resnet50")
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict",
+                        files={"file": ("dog.jpeg", image_data, "image/jpeg")},
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                assert response.status_code == 200
+                mock_cached_prediction.assert_awaited_once_with(
+                    "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+                )
+                mock_read_resized.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_predict_batch():
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    with patch(
+        "app.model.router.utils.save_file",
+        side_effect=["hash1.png", "hash2.png", "hash1.png"],
+    ) as mock_save_file:
+        with patch(
+            "app.model.router.get_cached_prediction", new_callable=AsyncMock
+        ) as mock_cached_prediction:
+            with patch(
+                "app.model.router.model_predict_batch", new_callable=AsyncMock
+            ) as mock_model_predict_batch:
+                mock_cached_prediction.side_effect = [
+                    None,
+                    ("dog", 0.9, "mobilenet_v2"),
+                ]
+                mock_model_predict_batch.return_value = [("cat", 0.95, "resnet50")]
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict/batch",
+                        files=[
+                            ("files", ("a.png", b"fake-image-a", "image/png")),
+                            ("files", ("b.png", b"fake-image-b", "image/png")),
+                            ("files", ("c.png", b"fake-image-a", "image/png")),
+                        ],
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                    assert response.status_code == 200
+                    response_data = response.json()
+                    assert response_data["success"] is True
+                    assert [
+                        (item["prediction"], item["stage"], item["image_file_name"])
+                        for item in response_data["predictions"]
+                    ] == [
+                        ("cat", "resnet50", "hash1.png"),
+                        ("dog", "mobilenet_v2", "hash2.png"),
+                        ("cat", "resnet50", "hash1.png"),
+                    ]
+                    mock_model_predict_batch.assert_awaited_once_with(["hash1.png"], {})
+                    # Each file is read once, hashed while being stored
+                    assert mock_save_file.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_predict_overloaded(admit):
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+    admit.side_effect = HTTPException(
+        status_code=503,
+        detail="Model service overloaded, try again later.",
+        headers={"Retry-After": "3"},
+    )
+
+    with patch("app.model.router.utils.save_file", return_value="fakehash123"):
+        with patch(
+            "app.model.router.get_cached_prediction", new_callable=AsyncMock
+        ) as mock_cached_prediction:
+            with patch(
+                "app.model.router.model_predict", new_callable=AsyncMock
+            ) as mock_model_predict:
+                mock_cached_prediction.return_value = None
+                async with AsyncClient(app=app, base_url="http://test") as ac:
+                    response = await ac.post(
+                        "/model/predict",
+                        files={"file": ("dog.jpeg", b"fake-image-data", "image/jpeg")},
+                        headers={"Authorization": "Bearer testtoken"},
+                    )
+
+                    assert response.status_code == 503
+                    assert response.headers["Retry-After"] == "3"
+                    mock_model_predict.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_predict_batch_fails_bad_extension():
+    mock_current_user = MagicMock()
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.post(
+            "/model/predict/batch",
+            files=[
+                ("files", ("a.png", b"fake-image-a", "image/png")),
+                ("files", ("b.pdf", b"fake-image-b", "image/png")),
+            ],
+            headers={"Authorization": "Bearer testtoken"},
+        )
+
+        assert response.status_code == 400
+        assert response.json() == {"detail": "File type is not supported."}
+
+
+@pytest.mark.asyncio
+async def test_create_job():
+    mock_current_user = MagicMock()
+    mock_current_user.email = "admin@example.com"
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    with patch("app.model.router.utils.save_file", return_value="fakehash123"):
+        with patch(
+            "app.model.router.submit_job", new_callable=AsyncMock
+        ) as mock_submit_job:
+            mock_submit_job.return_value = "job123"
+            async with AsyncClient(app=app, base_url="http://test") as ac:
+                response = await ac.post(
+                    "/model/jobs",
+                    files={"file": ("test_image.png", b"fake-image-data", "image/png")},
+                    headers={"Authorization": "Bearer testtoken"},
+                )
+
+                assert response.status_code == 202
+                response_data = response.json()
+                assert response_data["job_id"] == "job123"
+                assert response_data["status"] == "queued"
+                mock_submit_job.assert_awaited_once_with(
+                    "fakehash123", "admin@example.com"
+                )
+
+
+@pytest.mark.asyncio
+async def test_read_job():
+    mock_current_user = MagicMock()
+    mock_current_user.email = "admin@example.com"
+    app.dependency_overrides[get_current_user] = lambda: mock_current_user
+
+    job = {"owner": "admin@example.com", "image_file_name": "fakehash123"}
+    with patch("app.model.router.get_job", new_callable=AsyncMock) as mock_get_job:
+        mock_get_job.return_value = (
+            job,
+            {"prediction": "cat", "score": 0.95, "stage": "mobilenet_v2"},
+        )
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.get(
+                "/model/jobs/job123?wait=5",
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+            assert response.status_code == 200
+            response_data = response.json()
+            assert response_data["status"] == "done"
+            assert response_data["prediction"] == "cat"
+            assert response_data["stage"] == "mobilenet_v2"
+            mock_get_job.assert_awaited_once_with("job123", "admin@example.com", 5)
+
+        # Unknown jobs, or jobs of other users
+        mock_get_job.return_value = (None, None)
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.get(
+                "/model/jobs/job123",
+                headers={"Authorization": "Bearer testtoken"},
+            )
+
+            assert response.status_code == 404
@@ -0,0 +1,566 @@
+import asyncio
+import json
+from multiprocessing import shared_memory
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from app.model import services
+from fastapi import HTTPException
+
+# Patched by the live_workers fixture in every other test
+live_workers = services.live_workers
+
+
+def mock_redis():
+    mock_db = AsyncMock()
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(return_value=[1, 1])
+    mock_db.pipeline = MagicMock(return_value=pipe)
+    return mock_db
+
+
+def mock_listener(future):
+    listener = MagicMock()
+    listener.subscribe.return_value = future
+    listener.ready = AsyncMock()
+    return listener
+
+
+@pytest.fixture(autouse=True, name="live_workers")
+def live_workers_fixture():
+    with patch(
+        "app.model.services.live_workers",
+        new_callable=AsyncMock,
+        return_value={"capacity": 16, "throughput": 10.0},
+    ) as mock_live_workers:
+        yield mock_live_workers
+
+
+@pytest.mark.asyncio
+async def test_model_predict():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result({"id": "job", "prediction": "cat", "score": 0.95})
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)) as listener:
+            prediction, score, _ = await services.model_predict("fakehash123.png")
+
+    assert prediction == "cat"
+    assert score == 0.95
+    queue, payload = pipe.lpush.call_args.args
+    assert queue == services.settings.REDIS_QUEUE
+    job_data = json.loads(payload)
+    job_id = job_data["id"]
+    assert job_data["image_name"] == "fakehash123.png"
+    assert job_data["deadline"] == pytest.approx(
+        job_data["enqueued_at"] + services.settings.API_REQUEST_TIMEOUT
+    )
+    assert job_data["timestamps"]["enqueued"] >= job_data["enqueued_at"]
+    listener.unsubscribe.assert_called_once_with(job_id, future)
+    mock_db.set.assert_awaited_once_with(
+        "inflight:fakehash123.png", job_id, nx=True, ex=services.settings.INFLIGHT_TTL
+    )
+
+
+@pytest.mark.asyncio
+async def test_model_predict_falls_back_to_result_key():
+    future = asyncio.get_running_loop().create_future()
+    mock_db = mock_redis()
+    mock_db.get.side_effect = [
+        None,
+        json.dumps({"prediction": "cat", "score": 0.95}).encode("utf-8"),
+        None,
+    ]
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            with patch.object(services.settings, "API_RESULT_FALLBACK_INTERVAL", 0):
+                prediction, score, _ = await services.model_predict("fakehash123.png")
+
+    assert prediction == "cat"
+    assert score == 0.95
+    assert mock_db.get.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_model_predict_coalesces_concurrent_calls():
+    future = asyncio.get_running_loop().create_future()
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            calls = [services.model_predict("fakehash123.png") for _ in range(3)]
+            gathered = asyncio.gather(*calls)
+            await asyncio.sleep(0)
+            future.set_result({"id": "job", "prediction": "cat", "score": 0.95})
+            results = await gathered
+
+    assert results == [("cat", 0.95, None)] * 3
+    pipe.lpush.assert_called_once()
+    assert services.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_model_predict_joins_job_from_other_process():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result({"id": "otherjob", "prediction": "cat", "score": 0.95})
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.set.return_value = None
+    mock_db.get.return_value = b"otherjob"
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)) as listener:
+            prediction, score, _ = await services.model_predict("fakehash123.png")
+
+    assert (prediction, score) == ("cat", 0.95)
+    pipe.lpush.assert_not_called()
+    listener.subscribe.assert_called_once_with("otherjob")
+
+
+@pytest.mark.asyncio
+async def test_model_predict_joined_job_expired():
+    loop = asyncio.get_running_loop()
+    expired, future = loop.create_future(), loop.create_future()
+    expired.set_result({"id": "otherjob", "status": "expired"})
+    future.set_result({"id": "job", "prediction": "cat", "score": 0.95})
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.set.return_value = None
+    mock_db.get.return_value = b"otherjob"
+    listener = MagicMock()
+    listener.ready = AsyncMock()
+    listener.subscribe.side_effect = [expired, future]
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", listener):
+            prediction, score, _ = await services.model_predict("fakehash123.png")
+
+    # The expired job is not an answer, a job of our own is queued instead
+    assert (prediction, score) == ("cat", 0.95)
+    pipe.lpush.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_model_predict_joined_job_timeout():
+    future = asyncio.get_running_loop().create_future()
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.set.return_value = None
+    mock_db.get.side_effect = lambda key: (
+        b"otherjob" if key.startswith("inflight:") else None
+    )
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            with patch.object(services.settings, "API_REQUEST_TIMEOUT", 0.01):
+                with pytest.raises(HTTPException) as error:
+                    await services.model_predict("fakehash123.png")
+
+    # The time spent waiting for the other job counts, none is left for ours
+    assert error.value.status_code == 504
+    pipe.lpush.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_model_predict_batch():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(
+        {
+            "id": "job",
+            "predictions": [
+                {"prediction": "cat", "score": 0.95, "stage": "resnet50"},
+                {"prediction": "dog", "score": 0.9, "stage": "mobilenet_v2"},
+            ],
+        }
+    )
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            results = await services.model_predict_batch(["a.png", "b.png"])
+
+    assert results == [("cat", 0.95, "resnet50"), ("dog", 0.9, "mobilenet_v2")]
+    pipe.lpush.assert_called_once()
+    job_data = json.loads(pipe.lpush.call_args.args[1])
+    assert job_data["image_names"] == ["a.png", "b.png"]
+
+
+@pytest.mark.asyncio
+async def test_model_predict_with_image_in_redis():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result({"id": "job", "prediction": "cat", "score": 0.95})
+    mock_db = AsyncMock()
+    mock_db.get.return_value = None
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(return_value=[1, 1])
+    mock_db.pipeline = MagicMock(return_value=pipe)
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            with patch.object(services.settings, "IMAGE_TRANSPORT", "redis"):
+                await services.model_predict("fakehash123.png", b"image-data")
+
+    job_data = json.loads(pipe.lpush.call_args.args[1])
+    ref = f"image:{job_data['id']}:fakehash123.png"
+    assert job_data["image_transport"] == "redis"
+    assert job_data["image_refs"] == {"fakehash123.png": ref}
+    pipe.set.assert_called_once_with(
+        ref, b"image-data", ex=int(services.settings.API_REQUEST_TIMEOUT)
+    )
+    # Freed once the result arrived
+    mock_db.delete.assert_any_await(ref)
+
+
+@pytest.mark.asyncio
+async def test_stage_images_shared_memory():
+    with patch.object(services.settings, "IMAGE_TRANSPORT", "shm"):
+        job_data = {"id": "job123"}
+        job_data.update(await services.stage_images("job123", {"a.png": b"image-data"}))
+
+    assert job_data["image_transport"] == "shm"
+    ref = job_data["image_refs"]["a.png"]
+    segment = shared_memory.SharedMemory(name=ref)
+    try:
+        size = int.from_bytes(segment.buf[:8], "little")
+        assert bytes(segment.buf[8 : size + 8]) == b"image-data"
+    finally:
+        segment.close()
+
+    await services.release_images(job_data)
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=ref)
+
+
+@pytest.mark.asyncio
+async def test_model_predict_without_workers(live_workers):
+    live_workers.return_value = {"capacity": 0, "throughput": 0.0}
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        with pytest.raises(HTTPException) as error:
+            await services.model_predict("fakehash123.png")
+
+    assert error.value.status_code == 503
+    pipe.lpush.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_model_predict_timeout():
+    future = asyncio.get_running_loop().create_future()
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            with patch.object(services.settings, "API_REQUEST_TIMEOUT", 0.01):
+                with pytest.raises(HTTPException) as error:
+                    await services.model_predict("fakehash123.png")
+
+    assert error.value.status_code == 504
+    # The job is taken back from the queue
+    queue, payload = pipe.lpush.call_args.args
+    mock_db.lrem.assert_awaited_once_with(queue, 1, payload)
+    mock_db.decrby.assert_awaited_once_with(services.settings.QUEUED_IMAGES_KEY, 1)
+
+
+@pytest.mark.asyncio
+async def test_model_predict_expired():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result({"id": "job", "status": "expired"})
+    mock_db = mock_redis()
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            with pytest.raises(HTTPException) as error:
+                await services.model_predict("fakehash123.png")
+
+    assert error.value.status_code == 504
+
+
+@pytest.mark.asyncio
+async def test_live_workers():
+    mock_db = AsyncMock()
+    mock_db.zrange.return_value = [b"worker-1", b"worker-2"]
+    mock_db.mget.return_value = [json.dumps({"capacity": 16, "throughput": 40.0}), None]
+
+    with patch("app.model.services.db", mock_db):
+        with patch.dict(services.worker_stats, value=None):
+            stats = await live_workers()
+
+    assert stats == {"capacity": 16, "throughput": 40.0}
+    mock_db.zrem.assert_awaited_once_with(services.settings.WORKERS_KEY, "worker-2")
+
+
+def test_push_job_stream():
+    pipe = MagicMock()
+
+    with patch.object(services.settings, "QUEUE_TRANSPORT", "stream"):
+        services.push_job(pipe, "payload", 2)
+
+    pipe.xadd.assert_called_once_with(
+        services.settings.REDIS_STREAM,
+        {"job": "payload"},
+        maxlen=services.settings.STREAM_MAXLEN,
+        approximate=True,
+    )
+    pipe.lpush.assert_not_called()
+    # Admission control counts images, not jobs
+    pipe.incrby.assert_called_once_with(services.settings.QUEUED_IMAGES_KEY, 2)
+
+
+@pytest.mark.asyncio
+async def test_admit():
+    mock_db = AsyncMock()
+    mock_db.get.return_value = b"50"
+
+    with patch("app.model.services.db", mock_db):
+        with patch.object(services.settings, "ADMISSION_MAX_WAIT", 10):
+            # 51 images at 10 images/s is within the limit
+            await services.admit()
+
+            # So are 50 queued images and a batch of 50
+            mock_db.get.return_value = b"0"
+            await services.admit(50)
+
+            mock_db.get.return_value = b"120"
+            with pytest.raises(HTTPException) as error:
+                await services.admit()
+
+    assert error.value.status_code == 503
+    assert error.value.headers == {"Retry-After": "3"}
+    mock_db.get.assert_awaited_with(services.settings.QUEUED_IMAGES_KEY)
+
+
+@pytest.mark.asyncio
+async def test_remove_job_stream():
+    mock_db = mock_redis()
+    pipe = mock_db.pipeline.return_value
+
+    with patch("app.model.services.db", mock_db):
+        with patch.object(services.settings, "QUEUE_TRANSPORT", "stream"):
+            # Already read by a worker, which takes its images off the count
+            pipe.execute.return_value = [[{"message_id": b"1-0"}], 1]
+            await services.remove_job("payload", b"1-0", 2)
+            mock_db.decrby.assert_not_awaited()
+
+            pipe.execute.return_value = [[], 1]
+            await services.remove_job("payload", b"1-0", 2)
+
+    pipe.xdel.assert_called_with(services.settings.REDIS_STREAM, b"1-0")
+    mock_db.decrby.assert_awaited_once_with(services.settings.QUEUED_IMAGES_KEY, 2)
+
+
+@pytest.mark.asyncio
+async def test_submit_job():
+    mock_db = MagicMock()
+    mock_db.getex = AsyncMock(return_value=None)
+    pipe = mock_db.pipeline.return_value
+    pipe.execute = AsyncMock()
+
+    with patch("app.model.services.db", mock_db):
+        job_id = await services.submit_job("fakehash123.png", "admin@example.com")
+
+    pipe.set.assert_called_once_with(
+        "job:" + job_id,
+        json.dumps(
+            {"owner": "admin@example.com", "image_file_name": "fakehash123.png"}
+        ),
+        ex=services.settings.RESULT_TTL,
+    )
+    queue, payload = pipe.lpush.call_args.args
+    job_data = json.loads(payload)
+    assert job_data["id"] == job_id
+    assert job_data["image_name"] == "fakehash123.png"
+    assert job_data["deadline"] > job_data["enqueued_at"]
+    pipe.incrby.assert_called_once_with(services.settings.QUEUED_IMAGES_KEY, 1)
+    # The cache miss is counted, then the job queued
+    assert pipe.execute.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_job_long_poll():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result({"id": "job", "prediction": "cat", "score": 0.95})
+    job = {"owner": "admin@example.com", "image_file_name": "fakehash123.png"}
+    mock_db = AsyncMock()
+    mock_db.get.side_effect = [json.dumps(job), None]
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", mock_listener(future)):
+            found, output = await services.get_job("job", "admin@example.com", wait=5)
+
+    assert found == job
+    assert output["prediction"] == "cat"
+
+
+@pytest.mark.asyncio
+async def test_get_job_unknown():
+    mock_db = AsyncMock()
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        assert await services.get_job("job", "admin@example.com") == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_get_job_other_owner():
+    job = {"owner": "other@example.com", "image_file_name": "fakehash123.png"}
+    mock_db = AsyncMock()
+    mock_db.get.return_value = json.dumps(job)
+    listener = mock_listener(asyncio.get_running_loop().create_future())
+
+    with patch("app.model.services.db", mock_db):
+        with patch("app.model.services.listener", listener):
+            found = await services.get_job("job", "admin@example.com", wait=5)
+
+    # Rejected before waiting for the output
+    assert found == (None, None)
+    listener.subscribe.assert_not_called()
+    mock_db.get.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_result_timeout():
+    future = asyncio.get_running_loop().create_future()
+    mock_db = AsyncMock()
+    mock_db.get.return_value = None
+
+    with patch("app.model.services.db", mock_db):
+        output = await services.wait_for_result("job", future, timeout=0.01)
+
+    assert output is None
+
+
+def test_result_listener_dispatch():
+    loop = asyncio.new_event_loop()
+    listener = services.ResultListener("channel")
+    future = loop.create_future()
+    listener.waiters["job"] = {future}
+
+    listener.dispatch(json.dumps({"id": "job", "prediction": "cat", "score": 0.95}))
+    listener.dispatch(json.dumps({"id": "other", "prediction": "dog", "score": 0.5}))
+
+    assert future.result()["prediction"] == "cat"
+    listener.unsubscribe("job", future)
+    assert listener.waiters == {}
+    loop.close()
+
+
+@pytest.mark.asyncio
+async def test_result_listener_ready():
+    mock_db = MagicMock()
+    pubsub = mock_db.pubsub.return_value
+    pubsub.subscribe = AsyncMock()
+    pubsub.reset = AsyncMock()
+
+    async def get_message(**kwargs):
+        await asyncio.sleep(0.01)
+
+    pubsub.get_message = get_message
+    listener = services.ResultListener("channel")
+
+    with patch("app.model.services.db", mock_db):
+        await asyncio.wait_for(listener.ready(), 0.5)
+        # Jobs are only queued once the subscription is active
+        pubsub.subscribe.assert_awaited_once_with("channel")
+        assert listener.subscribed.is_set()
+        listener.task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await listener.task
+
+    assert not listener.subscribed.is_set()
+
+
+@pytest.mark.asyncio
+async def test_get_cached_prediction():
+    mock_db = MagicMock()
+    mock_db.getex = AsyncMock(
+        return_value=json.dumps(
+            {"class": "cat", "score": 0.95, "stage": "mobilenet_v2"}
+        )
+    )
+    pipe = mock_db.pipeline.return_value
+    pipe.execute = AsyncMock()
+
+    with patch("app.model.services.db", mock_db):
+        cached = await services.get_cached_prediction("fakehash123.png")
+
+    assert cached == ("cat", 0.95, "mobilenet_v2")
+    # A hit refreshes the TTL and the last use of the prediction
+    mock_db.getex.assert_awaited_once_with(
+        f"{services.settings.CACHE_PREFIX}:fakehash123.png",
+        ex=services.settings.CACHE_TTL,
+    )
+    pipe.hincrby.assert_called_once_with(services.settings.CACHE_STATS_KEY, "hits", 1)
+    pipe.zadd.assert_called_once()
+    assert pipe.zadd.call_args.kwargs["xx"] is True
+
+
+@pytest.mark.asyncio
+async def test_get_cached_prediction_miss():
+    mock_db = MagicMock()
+    mock_db.getex = AsyncMock(return_value=None)
+    pipe = mock_db.pipeline.return_value
+    pipe.execute = AsyncMock()
+
+    with patch("app.model.services.db", mock_db):
+        cached = await services.get_cached_prediction("fakehash123.png")
+
+    assert cached is None
+    pipe.hincrby.assert_called_once_with(services.settings.CACHE_STATS_KEY, "misses", 1)
+    pipe.zadd.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_record_latency():
+    mock_db = MagicMock()
+    pipe = mock_db.pipeline.return_value
+    pipe.execute = AsyncMock()
+
+    with patch("app.model.services.db", mock_db):
+        await services.record_latency({"decode": 3.5, "total": 60000.0})
+
+    pipe.hincrby.assert_any_call("latency:decode", "5", 1)
+    pipe.hincrby.assert_any_call("latency:total", "+Inf", 1)
+    pipe.hincrbyfloat.assert_any_call("latency:decode", "sum", 3.5)
+    pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_latency_stats():
+    mock_db = MagicMock()
+    pipe = mock_db.pipeline.return_value
+    histograms = {
+        "inference": {
+            b"20": b"90",
+            b"200": b"9",
+            b"+Inf": b"1",
+            b"count": b"100",
+            b"sum": b"3000",
+        }
+    }
+    pipe.execute = AsyncMock(
+        return_value=[histograms.get(stage, {}) for stage in services.timing.STAGES]
+    )
+
+    with patch("app.model.services.db", mock_db):
+        stats = await services.latency_stats()
+
+    assert list(stats) == ["inference"]
+    assert stats["inference"]["count"] == 100
+    assert stats["inference"]["mean_ms"] == 30.0
+    assert stats["inference"]["p50_ms"] == 20.0
+    assert stats["inference"]["p95_ms"] == 200.0
+    assert stats["inference"]["p99_ms"] == 200.0
+    assert stats["inference"]["buckets"]["+Inf"] == 100
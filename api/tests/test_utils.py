@@ -1,9 +1,11 @@
 import os
 from io import BytesIO
+from unittest.mock import AsyncMock, patch
 
 import app.utils as utils
 import pytest
 from fastapi import UploadFile
+from PIL import Image
 from werkzeug.datastructures import FileStorage
 
 
@@ -34,3 +36,66 @@ async def test_get_file_hash():
     new_filename = await utils.get_file_hash(file)
 
     assert md5_filename == new_filename
+
+
+def test_store_stream(tmp_path):
+    filename = "tests/dog.jpeg"
+    md5_filename = "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+
+    stored_path = tmp_path / "0a" / "7c" / md5_filename
+
+    with open(filename, "rb") as fp:
+        new_filename = utils.store_stream(fp, "dog.jpeg", str(tmp_path))
+    assert md5_filename == new_filename
+    assert os.listdir(tmp_path) == ["0a"]
+    assert stored_path.exists()
+
+    # Storing the same content again leaves the existing file untouched
+    mtime = os.path.getmtime(stored_path)
+    with open(filename, "rb") as fp:
+        assert utils.store_stream(fp, "other.jpeg", str(tmp_path)) == md5_filename
+    assert os.listdir(tmp_path) == ["0a"]
+    assert os.path.getmtime(stored_path) == mtime
+
+
+@pytest.mark.asyncio
+async def test_save_file(tmp_path):
+    filename = "tests/dog.jpeg"
+    md5_filename = "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+    with open(filename, "rb") as fp:
+        file = UploadFile(file=BytesIO(fp.read()), filename="dog.jpeg")
+
+    with patch("app.utils.blobstore.touch", new_callable=AsyncMock) as touch:
+        new_filename = await utils.save_file(file, str(tmp_path))
+
+    assert md5_filename == new_filename
+    with open(filename, "rb") as fp:
+        content = fp.read()
+    assert (tmp_path / "0a" / "7c" / md5_filename).read_bytes() == content
+    touch.assert_awaited_once_with(md5_filename, len(content))
+
+
+@pytest.mark.asyncio
+async def test_read_upload():
+    filename = "tests/dog.jpeg"
+    md5_filename = "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+    with open(filename, "rb") as fp:
+        content = fp.read()
+    file = UploadFile(file=BytesIO(content), filename="dog.jpeg")
+
+    assert await utils.read_upload(file, len(content)) == (md5_filename, content)
+    # Too large to be read in memory, left for save_file()
+    assert await utils.read_upload(file, len(content) - 1) is None
+    assert await file.read() == content
+
+
+def test_resize_stream():
+    filename = "tests/dog.jpeg"
+    with open(filename, "rb") as fp:
+        content = utils.resize_stream(fp, (224, 224), 2)
+
+    # Sent as a lossless PNG
+    with Image.open(BytesIO(content)) as img:
+        assert img.format == "PNG"
+        assert img.mode == "RGB"
+        assert img.size == (224, 224)
@@ -0,0 +1,241 @@
+import json
+import os
+
+import numpy as np
+from loguru import logger
+
+import settings
+
+# Mean pixel of ImageNet in BGR order, used by the resnet50 preprocessing
+IMAGENET_MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+_class_index = None
+
+
+def preprocess_input(img_batch):
+    """
+    Same as `tensorflow.keras.applications.resnet50.preprocess_input`
+    ("caffe" mode: RGB to BGR and mean pixel subtraction), without having
+    to import TensorFlow.
+
+    Parameters
+    ----------
+    img_batch : numpy.ndarray
+        float32 array of shape (batch, 224, 224, 3), RGB in [0, 255].
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    return img_batch[..., ::-1] - IMAGENET_MEAN_BGR
+
+
+def preprocess_mobilenet_v2(img_batch):
+    """
+    Same as `tensorflow.keras.applications.mobilenet_v2.preprocess_input`
+    ("tf" mode: pixels scaled to [-1, 1]).
+
+    Parameters
+    ----------
+    img_batch : numpy.ndarray
+        float32 array of shape (batch, 224, 224, 3), RGB in [0, 255].
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    return img_batch / 127.5 - 1.0
+
+
+def decode_predictions(predictions, top=5):
+    """
+    Same as `tensorflow.keras.applications.resnet50.decode_predictions`.
+    Labels are read from `settings.CLASS_INDEX_PATH` (written by
+    export_model.py), falling back to Keras if it is not there.
+
+    Returns
+    -------
+    list(list(tuple(str, str, float)))
+        For each image, its `top` (class_id, class_name, score) tuples.
+    """
+    global _class_index
+    if _class_index is None:
+        if not os.path.exists(settings.CLASS_INDEX_PATH):
+            from tensorflow.keras.applications.resnet50 import decode_predictions
+
+            return decode_predictions(predictions, top=top)
+        with open(settings.CLASS_INDEX_PATH) as f:
+            _class_index = json.load(f)
+
+    results = []
+    for scores in predictions:
+        top_indices = np.argsort(scores)[::-1][:top]
+        results.append([(*_class_index[str(i)], scores[i]) for i in top_indices])
+    return results
+
+
+def load_keras_model(artifact, build):
+    """
+    Load a Keras model saved by export_model.py in `settings.MODEL_DIR`,
+    which needs neither a weights download nor the Keras cache. Falls back
+    to `build()` if the artifact is not there.
+
+    Parameters
+    ----------
+    artifact : str
+        File name of the saved model, e.g. "resnet50.keras".
+    build : callable
+        Builds the model from the Keras applications, downloading its
+        weights if needed.
+    """
+    model_path = os.path.join(settings.MODEL_DIR, artifact)
+    if os.path.exists(model_path):
+        from tensorflow import keras
+
+        return keras.models.load_model(model_path, compile=False)
+    logger.warning(
+        f"{model_path} not found, building the model from the Keras weights. "
+        f"Run `python export_model.py` to save it."
+    )
+    return build()
+
+
+class KerasBackend:
+    """
+    ResNet50 run by Keras.
+    """
+
+    name = "keras"
+
+    def __init__(self):
+        from tensorflow.keras.applications import ResNet50
+
+        self.model = load_keras_model(
+            ARTIFACTS["keras"], lambda: ResNet50(weights="imagenet")
+        )
+
+    def predict(self, img_batch):
+        return np.asarray(self.model.predict_on_batch(img_batch))
+
+
+class MobileNetV2Backend:
+    """
+    MobileNetV2 run by Keras, the fast first stage of the cascade. Takes
+    images preprocessed with `preprocess_mobilenet_v2()`.
+    """
+
+    name = "mobilenet_v2"
+
+    def __init__(self):
+        from tensorflow.keras.applications import MobileNetV2
+
+        self.model = load_keras_model(
+            CASCADE_ARTIFACT, lambda: MobileNetV2(weights="imagenet")
+        )
+
+    def predict(self, img_batch):
+        return np.asarray(self.model.predict_on_batch(img_batch))
+
+
+class TFLiteBackend:
+    """
+    ResNet50 converted to TensorFlow Lite by export_model.py, float16 or
+    dynamic-range (INT8 weights) quantized. Uses the standalone
+    `tflite_runtime` interpreter when installed, so TensorFlow doesn't
+    need to be loaded at all.
+    """
+
+    def __init__(self, name, model_path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        self.name = name
+        self.interpreter = Interpreter(
+            model_path=model_path, num_threads=settings.TF_INTRA_OP_THREADS or None
+        )
+        self.input = self.interpreter.get_input_details()[0]["index"]
+        self.output = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+
+    def predict(self, img_batch):
+        if img_batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input, img_batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = img_batch.shape[0]
+        self.interpreter.set_tensor(self.input, img_batch.astype(np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output)
+
+
+class OnnxBackend:
+    """
+    ResNet50 exported to ONNX by export_model.py, run by ONNX Runtime on
+    CPU.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if settings.TF_INTRA_OP_THREADS:
+            options.intra_op_num_threads = settings.TF_INTRA_OP_THREADS
+        if settings.TF_INTER_OP_THREADS:
+            options.inter_op_num_threads = settings.TF_INTER_OP_THREADS
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input = self.session.get_inputs()[0].name
+
+    def predict(self, img_batch):
+        return self.session.run(None, {self.input: img_batch.astype(np.float32)})[0]
+
+
+# Artifact written by export_model.py for each backend, in settings.MODEL_DIR
+ARTIFACTS = {
+    "keras": "resnet50.keras",
+    "tflite-fp16": "resnet50_fp16.tflite",
+    "tflite-int8": "resnet50_int8.tflite",
+    "onnx": "resnet50.onnx",
+}
+# Artifact of the cascade first stage, see settings.CASCADE_ENABLED
+CASCADE_ARTIFACT = "mobilenet_v2.keras"
+
+
+def load_backend(name=None):
+    """
+    Load the model with the given inference backend.
+
+    Parameters
+    ----------
+    name : str, optional
+        One of "keras", "tflite-fp16", "tflite-int8" or "onnx", defaults
+        to `settings.INFERENCE_BACKEND`.
+
+    Returns
+    -------
+    Backend with a `predict(img_batch)` method taking preprocessed images
+    and returning the class probabilities.
+    """
+    name = name or settings.INFERENCE_BACKEND
+    if name == "keras":
+        backend = KerasBackend()
+    elif name in ARTIFACTS:
+        model_path = os.path.join(settings.MODEL_DIR, ARTIFACTS[name])
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"{model_path} not found, run `python export_model.py {name}` first"
+            )
+        if name == "onnx":
+            backend = OnnxBackend(model_path)
+        else:
+            backend = TFLiteBackend(name, model_path)
+    else:
+        raise ValueError(f"Unknown inference backend: {name}")
+    logger.info(f"Loaded {name} inference backend")
+    return backend
@@ -0,0 +1,99 @@
+"""
+Benchmark and accuracy check of the reduced-resolution decode path
+(`decode.load_image`) against the Keras one used before
+(`image.load_img` + `image.img_to_array`).
+
+Usage:
+    python bench_decode.py [IMAGE ...] [--upscale N] [--repeat N] [--predict]
+
+With --upscale each image is also re-encoded at N times its size, to
+stand in for large phone photos. With --predict both decoded arrays are
+run through ResNet50 and their top-1 predictions compared.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+import decode
+
+TARGET_SIZE = (224, 224)
+
+
+def keras_load(path):
+    from tensorflow.keras.preprocessing import image
+
+    return image.img_to_array(image.load_img(path, target_size=TARGET_SIZE))
+
+
+def timeit(func, path, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(path)
+        times.append(time.perf_counter() - start)
+    return result, 1000 * float(np.median(times))
+
+
+def upscale(path, factor, folder):
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+        big = img.resize((img.width * factor, img.height * factor), Image.BICUBIC)
+    name, _ = os.path.splitext(os.path.basename(path))
+    big_path = os.path.join(folder, f"{name}_x{factor}.jpeg")
+    big.save(big_path, quality=90)
+    return big_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("images", nargs="*", default=["tests/dog.jpeg"])
+    parser.add_argument("--upscale", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--predict", action="store_true")
+    args = parser.parse_args()
+
+    model = None
+    if args.predict:
+        from tensorflow.keras.applications import ResNet50
+        from tensorflow.keras.applications.resnet50 import (
+            decode_predictions,
+            preprocess_input,
+        )
+
+        model = ResNet50(weights="imagenet")
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = list(args.images)
+        if args.upscale > 1:
+            paths += [upscale(path, args.upscale, folder) for path in args.images]
+
+        header = f"{'image':<40} {'size':>11} {'keras ms':>9} {'fast ms':>8} {'speedup':>8} {'mean |diff|':>11}"
+        if model is not None:
+            header += f" {'keras top-1':>24} {'fast top-1':>24}"
+        print(header)
+        for path in paths:
+            with Image.open(path) as img:
+                size = f"{img.width}x{img.height}"
+            reference, keras_ms = timeit(keras_load, path, args.repeat)
+            fast, fast_ms = timeit(decode.load_image, path, args.repeat)
+            diff = float(np.mean(np.abs(reference - fast)))
+            line = (
+                f"{os.path.basename(path):<40} {size:>11} {keras_ms:>9.1f} "
+                f"{fast_ms:>8.1f} {keras_ms / fast_ms:>7.1f}x {diff:>11.2f}"
+            )
+            if model is not None:
+                batch = preprocess_input(np.stack([reference, fast]))
+                tops = decode_predictions(model.predict(batch, verbose=0), top=1)
+                keras_top, fast_top = [
+                    f"{top[0][1]} {float(top[0][2]):.4f}" for top in tops
+                ]
+                line += f" {keras_top:>24} {fast_top:>24}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import os
+import time
+from uuid import uuid4
+
+from loguru import logger
+
+
+def blob_path(folder, image_name):
+    """
+    Sharded location of an image in the upload folder: two levels of
+    folders named after the first hex digits of its hash, e.g.
+    uploads/0a/7c/0a7c757a80f2c5b13fa7a2a47a683593.jpeg. Must match the
+    API (api/app/blobstore.py).
+    """
+    return os.path.join(folder, image_name[:2], image_name[2:4], image_name)
+
+
+def find(folder, image_name):
+    """
+    Returns the path of a stored image, or None if it isn't stored. Images
+    written flat in the upload folder by older versions are found too.
+    """
+    path = blob_path(folder, image_name)
+    if os.path.isfile(path):
+        return path
+    legacy_path = os.path.join(folder, image_name)
+    if os.path.isfile(legacy_path):
+        return legacy_path
+    return None
+
+
+class BlobStore:
+    """
+    Content-addressed store of the uploaded images, on the volume shared
+    with the API which writes them.
+
+    The last access time and size of each image are indexed in Redis, the
+    API recording uploads and the workers every image they load, along
+    with a running total of the sizes, so the garbage collector never has
+    to scan the upload folder nor the whole index. Only the images written
+    flat in the folder by older versions are indexed from a scan, and the
+    total recounted, once per process, see `index_legacy()`.
+
+    Parameters
+    ----------
+    db : redis.Redis
+        Redis connection.
+    folder : str
+        Upload folder.
+    atime_key : str
+        Redis sorted set of image names scored by last access time.
+    size_key : str
+        Redis hash of image sizes in bytes.
+    total_key : str
+        Redis key holding the sum of the sizes in `size_key`.
+    lock_key : str
+        Redis key held by the process running the garbage collector.
+    max_bytes : int
+        Storage budget in bytes, 0 for no limit.
+    max_age : int
+        Seconds since their last access after which images are deleted,
+        0 for no limit.
+    min_age : int
+        Images accessed less than this many seconds ago are never deleted,
+        even over the storage budget, so jobs in flight keep their image.
+    """
+
+    def __init__(
+        self,
+        db,
+        folder,
+        atime_key,
+        size_key,
+        total_key,
+        lock_key,
+        max_bytes,
+        max_age,
+        min_age,
+    ):
+        self.db = db
+        self.folder = folder
+        self.atime_key = atime_key
+        self.size_key = size_key
+        self.total_key = total_key
+        self.lock_key = lock_key
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_age = min_age
+        self.legacy_indexed = False
+
+    def touch(self, image_names):
+        """
+        Records an access to several images at once.
+
+        Parameters
+        ----------
+        image_names : list(str)
+            Names of stored images.
+        """
+        now = time.time()
+        sizes = []
+        pipe = self.db.pipeline(transaction=False)
+        for image_name in image_names:
+            path = find(self.folder, image_name)
+            if path is None:
+                continue
+            sizes.append(os.path.getsize(path))
+            pipe.zadd(self.atime_key, {image_name: now})
+            pipe.hsetnx(self.size_key, image_name, sizes[-1])
+        try:
+            self.add_total(sizes, pipe.execute()[1::2])
+        except Exception as e:
+            logger.error(f"Error indexing uploads: {e}")
+
+    def add_total(self, sizes, added):
+        """
+        Adds to the running total the sizes of the images that were new to
+        the size hash, i.e. for which HSETNX returned 1. Sizes never change,
+        images being named after their content.
+        """
+        total = sum(size for size, new in zip(sizes, added) if new)
+        if total:
+            self.db.incrby(self.total_key, total)
+
+    def index_legacy(self):
+        """
+        Indexes the images written flat in the upload folder by older
+        versions, with their modification time as last access, so they
+        are collected too. Images already indexed keep their access time.
+
+        Returns
+        -------
+        int
+            Number of flat images found.
+        """
+        sizes = []
+        pipe = self.db.pipeline(transaction=False)
+        for entry in os.scandir(self.folder):
+            # Shard folders, and the temporary files the API writes to
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            stat = entry.stat()
+            sizes.append(stat.st_size)
+            pipe.zadd(self.atime_key, {entry.name: stat.st_mtime}, nx=True)
+            pipe.hsetnx(self.size_key, entry.name, stat.st_size)
+        if sizes:
+            self.add_total(sizes, pipe.execute()[1::2])
+        return len(sizes)
+
+    def recount(self):
+        """
+        Sets the running total from the size hash, read in pages. Corrects
+        the drift left by a process that died between updating the hash
+        and the total, and indexes from older versions that had no total.
+        """
+        total = sum(int(size) for _, size in self.db.hscan_iter(self.size_key))
+        self.db.set(self.total_key, total)
+        return total
+
+    def candidates(self, page=500):
+        """
+        Names of the images to delete to meet the age and size budgets,
+        least recently accessed first. The index is read `page` images at
+        a time, only as far as needed.
+        """
+        now = time.time()
+        cutoff = now - self.max_age if self.max_age else None
+        over = 0
+        if self.max_bytes:
+            over = int(self.db.get(self.total_key) or 0) - self.max_bytes
+
+        selected = []
+        start = 0
+        while True:
+            atimes = self.db.zrangebyscore(
+                self.atime_key,
+                "-inf",
+                now - self.min_age,
+                start=start,
+                num=page,
+                withscores=True,
+            )
+            # Sorted by access time, so the expired ones come first
+            expired = 0
+            if cutoff is not None:
+                expired = sum(1 for _, atime in atimes if atime < cutoff)
+            if not atimes or (not expired and over <= 0):
+                return selected
+            names = [name.decode("utf-8") for name, _ in atimes]
+            sizes = [None] * len(names)
+            if self.max_bytes:
+                sizes = self.db.hmget(self.size_key, names)
+            # Then the least recently used ones until back under budget
+            for i, (name, size) in enumerate(zip(names, sizes)):
+                if i >= expired and over <= 0:
+                    return selected
+                selected.append(name)
+                over -= int(size or 0)
+            if len(atimes) < page:
+                return selected
+            start += page
+
+    def delete(self, image_names):
+        """
+        Deletes images and drops them from the index, unless they were
+        accessed since they were picked for deletion.
+
+        Returns
+        -------
+        tuple(int, int)
+            Number of images deleted and bytes freed.
+        """
+        cutoff = time.time() - self.min_age
+        atimes = self.db.zmscore(self.atime_key, image_names)
+        freed = 0
+        deleted = []
+        for image_name, atime in zip(image_names, atimes):
+            if atime is not None and atime > cutoff:
+                continue
+            path = find(self.folder, image_name)
+            if path is not None:
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    # Removed in between, only its index entry is left
+                    pass
+            deleted.append(image_name)
+        if deleted:
+            # In a transaction, so the sizes read are exactly the ones removed
+            pipe = self.db.pipeline()
+            pipe.zrem(self.atime_key, *deleted)
+            pipe.hmget(self.size_key, deleted)
+            pipe.hdel(self.size_key, *deleted)
+            _, sizes, _ = pipe.execute()
+            removed = sum(int(size) for size in sizes if size is not None)
+            if removed:
+                self.db.decrby(self.total_key, removed)
+        return len(deleted), freed
+
+    def collect(self, lock_ttl=600):
+        """
+        Runs the garbage collector once, unless another process is already
+        running it.
+
+        Returns
+        -------
+        tuple(int, int)
+            Number of images deleted and bytes freed.
+        """
+        token = uuid4().hex
+        if not self.db.set(self.lock_key, token, nx=True, ex=lock_ttl):
+            return 0, 0
+        try:
+            if not self.legacy_indexed:
+                count = self.index_legacy()
+                if count:
+                    logger.info(f"Indexed {count} flat uploads from older versions")
+                self.recount()
+                self.legacy_indexed = True
+            names = self.candidates()
+            deleted = freed = 0
+            # In chunks to keep each Redis call short
+            for start in range(0, len(names), 500):
+                count, size = self.delete(names[start : start + 500])
+                deleted += count
+                freed += size
+            if deleted:
+                logger.info(f"Deleted {deleted} uploads, {freed / 2**20:.1f} MiB")
+            return deleted, freed
+        finally:
+            if self.db.get(self.lock_key) == token.encode("utf-8"):
+                self.db.delete(self.lock_key)
+
+    def run_gc(self, interval):
+        """
+        Runs the garbage collector every `interval` seconds.
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                self.collect()
+            except Exception as e:
+                logger.error(f"Error collecting uploads: {e}")
@@ -0,0 +1,210 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class PredictionCache:
+    """
+    Cache of model predictions keyed by image content hash.
+
+    Predictions live in Redis under `<namespace>:<image_name>` with a TTL,
+    where the namespace identifies the model (name, version, backend and
+    cascade), so a model change never serves stale labels. The hottest
+    entries are also kept in a small in-process LRU in front of Redis. The
+    cache can be shared by the threads of a worker.
+
+    The cache bounds itself instead of relying on the Redis eviction
+    policy, which would also evict the other keys with a TTL (worker
+    heartbeats, job records, inline images): predictions are indexed by
+    last use in the sorted set `<namespace>:_index`, and the least
+    recently used ones are deleted once there are more than
+    `max_entries`. Hits refresh both the index and the TTL, here and in
+    the API, so hot images are neither evicted nor expired.
+
+    Hits and misses are counted in the Redis stats hash by the API, which
+    looks every image up before queueing it, so this cache only keeps
+    in-process counters.
+
+    Parameters
+    ----------
+    db : redis.Redis
+        Redis connection.
+    namespace : str
+        Key prefix, e.g. "prediction:resnet50:1:keras".
+    ttl : int
+        Seconds a prediction is kept in Redis.
+    local_size : int
+        Maximum number of predictions kept in process, 0 to disable.
+    max_entries : int
+        Maximum number of predictions kept in Redis, 0 for no limit.
+    """
+
+    def __init__(self, db, namespace, ttl, local_size, max_entries=0):
+        self.db = db
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local_size = local_size
+        self.max_entries = max_entries
+        self.index_key = f"{namespace}:_index"
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.local_hits = 0
+        self.misses = 0
+
+    def key(self, image_name):
+        return f"{self.namespace}:{image_name}"
+
+    def remember(self, image_name, prediction):
+        if self.local_size <= 0:
+            return
+        with self.lock:
+            self.local[image_name] = prediction
+            self.local.move_to_end(image_name)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def get_many(self, image_names):
+        """
+        Looks up several images at once, first in process and then in
+        Redis with a single pipeline of GETEX, refreshing their TTL.
+
+        Parameters
+        ----------
+        image_names : list(str)
+            Image filenames (content hashes).
+
+        Returns
+        -------
+        dict
+            Maps each cached image name to its (class_name, score) tuple,
+            or (class_name, score, stage) if the model stage that answered
+            was recorded. Images without a cached prediction are left out.
+        """
+        found = {}
+        missing = []
+        with self.lock:
+            for image_name in image_names:
+                if image_name in self.local:
+                    self.local.move_to_end(image_name)
+                    found[image_name] = self.local[image_name]
+                else:
+                    missing.append(image_name)
+        local_hits = list(found)
+
+        if missing:
+            try:
+                pipe = self.db.pipeline(transaction=False)
+                for image_name in missing:
+                    pipe.getex(self.key(image_name), ex=self.ttl)
+                values = pipe.execute()
+            except Exception as e:
+                logger.error(f"Error reading prediction cache: {e}")
+                values = [None] * len(missing)
+            for image_name, value in zip(missing, values):
+                if value is None:
+                    continue
+                value = json.loads(value)
+                prediction = (value["class"], value["score"])
+                if "stage" in value:
+                    prediction += (value["stage"],)
+                found[image_name] = prediction
+                self.remember(image_name, prediction)
+
+        self.touch(list(found), local_hits)
+        with self.lock:
+            self.hits += len(found)
+            self.local_hits += len(local_hits)
+            self.misses += len(image_names) - len(found)
+        return found
+
+    def touch(self, image_names, local_names):
+        """
+        Marks predictions as just used: their index entry is moved to now
+        and, for those served in process, their Redis TTL refreshed (GETEX
+        did it for the others).
+        """
+        if not image_names or not (self.max_entries or local_names):
+            return
+        try:
+            pipe = self.db.pipeline(transaction=False)
+            for image_name in local_names:
+                pipe.expire(self.key(image_name), self.ttl)
+            if self.max_entries:
+                # Only entries still indexed, evicted ones are gone
+                now = time.time()
+                pipe.zadd(self.index_key, {name: now for name in image_names}, xx=True)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Error refreshing prediction cache entries: {e}")
+
+    def get(self, image_name):
+        """
+        Returns the cached prediction for an image, or None.
+        """
+        return self.get_many([image_name]).get(image_name)
+
+    def set_many(self, predictions):
+        """
+        Stores predictions in Redis and in process.
+
+        Parameters
+        ----------
+        predictions : dict
+            Maps image names to (class_name, score) or
+            (class_name, score, stage) tuples.
+        """
+        if not predictions:
+            return
+        now = time.time()
+        pipe = self.db.pipeline(transaction=False)
+        for image_name, prediction in predictions.items():
+            self.remember(image_name, prediction)
+            class_name, score, *stage = prediction
+            value = {"class": class_name, "score": score}
+            if stage:
+                value["stage"] = stage[0]
+            pipe.set(self.key(image_name), json.dumps(value), ex=self.ttl)
+        if self.max_entries:
+            pipe.zadd(self.index_key, {name: now for name in predictions})
+            # Predictions whose TTL expired are gone already
+            pipe.zremrangebyscore(self.index_key, "-inf", now - self.ttl)
+            pipe.zcard(self.index_key)
+        try:
+            results = pipe.execute()
+            if self.max_entries and results[-1] > self.max_entries:
+                self.evict(results[-1] - self.max_entries)
+        except Exception as e:
+            logger.error(f"Error storing predictions in Redis: {e}")
+
+    def evict(self, count):
+        """
+        Deletes the `count` least recently used predictions from Redis.
+        """
+        oldest = self.db.zpopmin(self.index_key, count)
+        if oldest:
+            self.db.delete(*[self.key(name.decode("utf-8")) for name, _ in oldest])
+
+
+def configure_memory(db, max_memory, policy):
+    """
+    Sets the Redis memory budget and eviction policy of the whole server,
+    shared with the API. With a `volatile-*` policy every key with a TTL
+    may be evicted, not only predictions: worker heartbeats, job records,
+    in-flight markers and inline images too. The prediction cache bounds
+    itself (see `PredictionCache`), this is only meant as a last resort.
+
+    Some managed Redis deployments don't allow CONFIG SET, so failing
+    here is only logged.
+    """
+    if not max_memory:
+        return
+    try:
+        db.config_set("maxmemory", max_memory)
+        db.config_set("maxmemory-policy", policy)
+        logger.info(f"Redis maxmemory set to {max_memory} ({policy})")
+    except Exception as e:
+        logger.warning(f"Could not configure Redis memory budget: {e}")
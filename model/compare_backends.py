@@ -0,0 +1,165 @@
+"""
+Compare inference backends against the Keras ResNet50 reference.
+
+Usage:
+    python compare_backends.py IMAGE_DIR [--backends NAME ...]
+        [--batch-sizes 1 8 32] [--repeat N] [--output FILE]
+
+Images are loaded with the same decoding and preprocessing as
+ml_service.predict. If IMAGE_DIR has one sub-folder per class (named
+after the ImageNet class, e.g. "Eskimo_dog") the top-1 accuracy of each
+backend is reported too.
+
+For each backend, measured in its own process so memory numbers don't
+mix:
+- top-1 agreement: images whose top-1 class matches the reference;
+- top-5 agreement: images whose reference top-1 class is in the top-5;
+- p50/p95/p99 latency of a batch and throughput, per batch size;
+- peak RSS of the process.
+
+Results are printed as a table and written as JSON to --output.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+import numpy as np
+
+import backends
+import decode
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif"}
+
+
+def find_images(image_dir):
+    """
+    List the images under `image_dir` and their label, the name of their
+    sub-folder (None for images at the top level).
+    """
+    images = []
+    for root, _, files in os.walk(image_dir):
+        label = None if root == image_dir else os.path.basename(root)
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                images.append((os.path.join(root, name), label))
+    return images
+
+
+def evaluate(name, paths, batch_sizes, repeat):
+    """
+    Run in a child process: load the backend, predict every image and time
+    batches of each size.
+    """
+    img_arrays = np.stack([decode.load_image(path) for path in paths])
+    img_arrays = backends.preprocess_input(img_arrays)
+    model = backends.load_backend(name)
+
+    predictions = np.concatenate(
+        [model.predict(img_arrays[i : i + 32]) for i in range(0, len(img_arrays), 32)]
+    )
+
+    latency = {}
+    for batch_size in batch_sizes:
+        indices = np.arange(batch_size) % len(img_arrays)
+        batch = img_arrays[indices]
+        model.predict(batch)  # warm up
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.predict(batch)
+            times.append(time.perf_counter() - start)
+        times = np.array(times) * 1000
+        latency[batch_size] = {
+            "p50_ms": round(float(np.percentile(times, 50)), 2),
+            "p95_ms": round(float(np.percentile(times, 95)), 2),
+            "p99_ms": round(float(np.percentile(times, 99)), 2),
+            "images_per_s": round(float(batch_size * 1000 / np.mean(times)), 1),
+        }
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return predictions, latency, round(peak_rss_mb, 1)
+
+
+def compare(reference, predictions):
+    """
+    Top-1 and top-5 agreement of `predictions` with `reference`.
+    """
+    reference_top1 = reference.argmax(axis=1)
+    top5 = np.argsort(predictions, axis=1)[:, ::-1][:, :5]
+    return {
+        "top1_agreement": round(float(np.mean(top5[:, 0] == reference_top1)), 4),
+        "top5_agreement": round(
+            float(np.mean([ref in row for ref, row in zip(reference_top1, top5)])), 4
+        ),
+    }
+
+
+def accuracy(predictions, labels):
+    decoded = backends.decode_predictions(predictions, top=1)
+    hits = [top[0][1] == label for top, label in zip(decoded, labels) if label]
+    return round(float(np.mean(hits)), 4) if hits else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("image_dir")
+    parser.add_argument("--backends", nargs="+", default=list(backends.ARTIFACTS))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", default="compare_backends.json")
+    args = parser.parse_args()
+
+    images = find_images(args.image_dir)
+    if not images:
+        parser.error(f"no images found in {args.image_dir}")
+    paths = [path for path, _ in images]
+    labels = [label for _, label in images]
+
+    names = ["keras"] + [name for name in args.backends if name != "keras"]
+    context = multiprocessing.get_context("spawn")
+    report = {"images": len(paths), "backends": {}}
+    reference = None
+    for name in names:
+        with context.Pool(1) as pool:
+            try:
+                predictions, latency, peak_rss_mb = pool.apply(
+                    evaluate, (name, paths, args.batch_sizes, args.repeat)
+                )
+            except Exception as e:
+                if name == "keras":
+                    raise SystemExit(f"Could not run the keras reference: {e}")
+                print(f"Skipping {name}: {e}")
+                continue
+        if reference is None:
+            reference = predictions
+        report["backends"][name] = {
+            **compare(reference, predictions),
+            "top1_accuracy": accuracy(predictions, labels),
+            "peak_rss_mb": peak_rss_mb,
+            "latency": latency,
+        }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"{'backend':<12} {'batch':>5} {'top-1 agr':>9} {'top-5 agr':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'img/s':>8} {'RSS MB':>8}"
+    )
+    for name, result in report["backends"].items():
+        for batch_size, stats in result["latency"].items():
+            print(
+                f"{name:<12} {batch_size:>5} {result['top1_agreement']:>9.4f} "
+                f"{result['top5_agreement']:>9.4f} {stats['p50_ms']:>8.2f} "
+                f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+                f"{stats['images_per_s']:>8.1f} {result['peak_rss_mb']:>8.1f}"
+            )
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import numpy as np
+from PIL import Image
+
+import settings
+
+
+def load_image(source, target_size=(224, 224), draft_factor=None):
+    """
+    Decode an image into an RGB array of `target_size`, the same way
+    `tensorflow.keras.preprocessing.image.load_img` + `img_to_array` do
+    (RGB conversion and nearest neighbour resize), but cheaper for large
+    JPEG files.
+
+    JPEG images are decoded at 1/2, 1/4 or 1/8 scale in the DCT domain
+    when that still leaves at least `draft_factor` times the target size
+    in both dimensions, so a 12 megapixel photo is never fully decoded
+    just to be shrunk to 224x224. Other formats (PNG, GIF) are decoded at
+    full resolution.
+
+    Parameters
+    ----------
+    source : str or file-like object
+        Path to the image or binary buffer with its content.
+    target_size : tuple(int, int)
+        Output (height, width).
+    draft_factor : int, optional
+        Minimum ratio between the decoded and the target size, defaults to
+        `settings.DECODE_DRAFT_FACTOR`. 0 disables reduced decoding.
+
+    Returns
+    -------
+    numpy.ndarray
+        float32 array of shape (height, width, 3).
+    """
+    if draft_factor is None:
+        draft_factor = settings.DECODE_DRAFT_FACTOR
+    height, width = target_size
+
+    with Image.open(source) as img:
+        if draft_factor and img.format == "JPEG":
+            # Pillow picks the smallest scale that is still at least as
+            # large as the requested size
+            img.draft("RGB", (width * draft_factor, height * draft_factor))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if img.size != (width, height):
+            img = img.resize((width, height), Image.NEAREST)
+        return np.asarray(img, dtype=np.float32)
@@ -0,0 +1,88 @@
+"""
+Export ResNet50 for the inference backends in backends.py.
+
+Usage:
+    python export_model.py [FORMAT ...] [--output DIR]
+
+FORMAT is any of "keras", "tflite-fp16", "tflite-int8", "onnx" and
+"mobilenet_v2" (the cascade first stage), all of them by default.
+Artifacts are written to settings.MODEL_DIR, together with the ImageNet
+class index so the worker can start and decode predictions without
+downloading anything. ONNX export needs the optional `tf2onnx` package.
+"""
+import argparse
+import os
+import shutil
+
+import settings
+from backends import ARTIFACTS, CASCADE_ARTIFACT
+from loguru import logger
+
+FORMATS = {**ARTIFACTS, "mobilenet_v2": CASCADE_ARTIFACT}
+
+
+def export_tflite(model, path, quantization):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "fp16":
+        converter.target_spec.supported_types = [tf.float16]
+    # Without a representative dataset Optimize.DEFAULT gives dynamic-range
+    # quantization: INT8 weights, activations quantized on the fly
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+
+
+def export_onnx(model, path):
+    import tensorflow as tf
+    from tf2onnx import convert
+
+    spec = [tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input")]
+    convert.from_keras(model, input_signature=spec, output_path=path)
+
+
+def export_class_index(path):
+    from tensorflow.keras.utils import get_file
+
+    source = get_file(
+        "imagenet_class_index.json",
+        "https://storage.googleapis.com/download.tensorflow.org/"
+        "data/imagenet_class_index.json",
+        cache_subdir="models",
+    )
+    shutil.copyfile(source, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("formats", nargs="*", default=list(FORMATS))
+    parser.add_argument("--output", default=settings.MODEL_DIR)
+    args = parser.parse_args()
+    for name in args.formats:
+        if name not in FORMATS:
+            parser.error(f"unknown format {name}, choose from {', '.join(FORMATS)}")
+
+    from tensorflow.keras.applications import MobileNetV2, ResNet50
+
+    os.makedirs(args.output, exist_ok=True)
+    model = ResNet50(weights="imagenet")
+
+    for name in args.formats:
+        path = os.path.join(args.output, FORMATS[name])
+        logger.info(f"Exporting {name} to {path}")
+        if name == "keras":
+            model.save(path)
+        elif name == "mobilenet_v2":
+            MobileNetV2(weights="imagenet").save(path)
+        elif name == "onnx":
+            export_onnx(model, path)
+        else:
+            export_tflite(model, path, name.split("-")[1])
+        logger.info(f"{path}: {os.path.getsize(path) / 2**20:.1f} MiB")
+
+    export_class_index(os.path.join(args.output, "imagenet_class_index.json"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,27 @@
+import io
 import json
 import os
+import socket
+import threading
 import time
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
 import redis
 import settings
-from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.applications.resnet50 import decode_predictions, preprocess_input
-from tensorflow.keras.preprocessing import image
+import blobstore
+from backends import (
+    MobileNetV2Backend,
+    decode_predictions,
+    load_backend,
+    preprocess_input,
+    preprocess_mobilenet_v2,
+)
+from cache import PredictionCache, configure_memory
+from decode import load_image as decode_image
+from pipeline import InferencePipeline
+from tensor_cache import TensorCache
 from loguru import logger
 
 import os
@@ -16,6 +30,22 @@ import os
 
 os.environ['KERAS_HOME'] = '/root/.keras'
 
+# Identifies this worker process in the stats exported to Redis
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+# Seconds taken by each startup phase, logged and advertised with the
+# readiness key
+startup_timings = {}
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    yield
+    startup_timings[phase] = round(time.perf_counter() - start, 3)
+    logger.info(f"Startup: {phase} took {startup_timings[phase]:.2f}s")
+
+
 # TODO
 # Connect to Redis and assign to variable `db``
 # Make use of settings.py module to get Redis settings like host, port, etc.
@@ -37,16 +67,353 @@ def get_redis_connection(max_retries=5, retry_delay=5):
             time.sleep(retry_delay)
             continue
 
-db = get_redis_connection()
+
+with timed("redis connection"):
+    db = get_redis_connection()
+    configure_memory(db, settings.REDIS_MAXMEMORY, settings.REDIS_MAXMEMORY_POLICY)
 logger.info("Connected to Redis")
 
+cache = PredictionCache(
+    db,
+    namespace=settings.CACHE_PREFIX,
+    ttl=settings.CACHE_TTL,
+    local_size=settings.CACHE_LOCAL_SIZE,
+    max_entries=settings.CACHE_MAX_ENTRIES,
+)
+uploads = blobstore.BlobStore(
+    db,
+    folder=settings.UPLOAD_FOLDER,
+    atime_key=settings.UPLOAD_ATIME_KEY,
+    size_key=settings.UPLOAD_SIZE_KEY,
+    total_key=settings.UPLOAD_TOTAL_KEY,
+    lock_key=settings.UPLOAD_GC_LOCK,
+    max_bytes=settings.UPLOAD_MAX_BYTES,
+    max_age=settings.UPLOAD_MAX_AGE,
+    min_age=settings.UPLOAD_MIN_AGE,
+)
+tensors = TensorCache(settings.TENSOR_CACHE_DIR, settings.TENSOR_CACHE_MAX_BYTES)
+
 # TODO
 # Load your ML model and assign to variable `model`
 # See https://drive.google.com/file/d/1ADuBSE4z2ZVIdn66YDSwxKv-58U7WEOn/view?usp=sharing
 # for more information about how to use this model.
-model = ResNet50(weights="imagenet")
+# The backend (Keras, TFLite or ONNX Runtime) is chosen in settings.py
+# and loaded from the artifacts written by export_model.py
+if settings.INFERENCE_BACKEND == "keras" or settings.CASCADE_ENABLED:
+    with timed("tensorflow import"):
+        import tensorflow  # noqa: F401
+with timed("model load"):
+    model = load_backend()
 logger.info("Model loaded")
 
+# Fast first stage of the model cascade, see settings.CASCADE_ENABLED
+cascade_model = None
+if settings.CASCADE_ENABLED:
+    with timed("cascade model load"):
+        cascade_model = MobileNetV2Backend()
+    logger.info(
+        f"Cascade enabled, images below {settings.CASCADE_THRESHOLD} confidence "
+        f"are escalated to {settings.MODEL_NAME}"
+    )
+
+
+def read_shared_memory(name):
+    """
+    Copy an image out of a POSIX shared memory segment written by the API:
+    its size as 8 little-endian bytes followed by the content. The API
+    unlinks the segment once the job is answered.
+    """
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        # Attaching registered the segment with this process' resource
+        # tracker, which would unlink it when the worker exits
+        resource_tracker.unregister(segment._name, "shared_memory")
+        size = int.from_bytes(segment.buf[:8], "little")
+        return bytes(segment.buf[8 : size + 8])
+    finally:
+        segment.close()
+
+
+def read_images(job_data, image_names=None):
+    """
+    Read the images the API sent along with a job instead of storing them
+    in the upload folder, from Redis keys or shared memory segments
+    depending on the job "image_transport".
+
+    Parameters
+    ----------
+    job_data : dict
+        Job data as returned by `parse_job()`.
+    image_names : list(str), optional
+        Only read these images, all of them by default.
+
+    Returns
+    -------
+    dict
+        Image content by image name. Images that can't be read are left
+        out and looked up in the upload folder.
+    """
+    refs = job_data.get("image_refs") or {}
+    if image_names is not None:
+        refs = {name: refs[name] for name in image_names if name in refs}
+    if not refs:
+        return {}
+    contents = {}
+    try:
+        if job_data.get("image_transport") == "shm":
+            for image_name, ref in refs.items():
+                try:
+                    contents[image_name] = read_shared_memory(ref)
+                except FileNotFoundError:
+                    logger.error(f"Shared memory segment {ref} not found")
+        else:
+            for image_name, content in zip(refs, db.mget(list(refs.values()))):
+                if content is None:
+                    logger.error(f"Image {image_name} expired from Redis")
+                else:
+                    contents[image_name] = content
+    except Exception as e:
+        logger.error(f"Error reading images of job {job_data['id']}: {e}")
+    return contents
+
+
+def load_image(image_name, content=None):
+    """
+    Load an image from the upload folder, or from its content if the API
+    sent it with the job, and turn it into a model-ready array (before the
+    resnet50 preprocessing is applied). Decoded images are kept in the
+    tensor cache and read back from there next time.
+
+    Parameters
+    ----------
+    image_name : str
+        Image filename.
+    content : bytes, optional
+        Image content, decoded from memory instead of reading the file.
+
+    Returns
+    -------
+    img_array : numpy.ndarray or None
+        Array of shape (224, 224, 3), or None if the image can't be loaded.
+    """
+    img_array = tensors.get(image_name)
+    if img_array is not None:
+        return img_array
+    return decode_upload(image_name, content)
+
+
+def decode_upload(image_name, content=None):
+    """
+    Decode an image like `load_image()` without looking it up in the
+    tensor cache first, for callers that already did.
+    """
+    if content is not None:
+        source = io.BytesIO(content)
+    else:
+        source = blobstore.find(settings.UPLOAD_FOLDER, image_name)
+        if source is None:
+            logger.error(f"Image {image_name} not found in {settings.UPLOAD_FOLDER}")
+            return None
+        logger.info(f"Loading image from path: {source}")
+
+    try:
+        # Decode straight into a numpy array, batch dimension is added
+        # when stacking
+        img_array = decode_image(source, target_size=(224, 224))
+    except Exception as e:
+        logger.error(f"Error loading image {image_name}: {e}")
+        return None
+    tensors.put(image_name, img_array)
+    return img_array
+
+
+def stack_images(img_arrays):
+    """
+    Copy decoded images into a float32 batch, the model input. Arrays from
+    the tensor cache are uint8 and memory-mapped, they are converted while
+    copied.
+    """
+    img_batch = np.empty((len(img_arrays),) + img_arrays[0].shape, dtype=np.float32)
+    for i, img_array in enumerate(img_arrays):
+        img_batch[i] = img_array
+    return img_batch
+
+
+def run_model(img_arrays):
+    """
+    Run our ML model over a batch of images in a single forward pass.
+
+    Parameters
+    ----------
+    img_arrays : list(numpy.ndarray)
+        Arrays returned by `load_image()`.
+
+    Returns
+    -------
+    list(tuple(str, float))
+        One (class_name, pred_probability) pair per image, (None, None)
+        for all of them if the model failed.
+    """
+    try:
+        # Match model input dimensions (including batch) and use the
+        # resnet50 preprocessing
+        img_batch = preprocess_input(stack_images(img_arrays))
+        logger.info(f"Running model on a batch of {len(img_arrays)} images")
+        return top_predictions(model.predict(img_batch))
+    except Exception as e:
+        logger.error(f"Error predicting batch: {e}")
+        return [(None, None)] * len(img_arrays)
+
+
+def top_predictions(predictions):
+    """
+    Turn the class probabilities returned by a model into one
+    (class_name, pred_probability) pair per image.
+    """
+    results = []
+    for top in decode_predictions(predictions, top=1):
+        _, class_name, pred_probability = top[0]
+        # Convert probabilities to float and round it
+        results.append((class_name, round(float(pred_probability), 4)))
+    return results
+
+
+def run_cascade(img_arrays):
+    """
+    Run the images through the fast cascade model, then send the ones it
+    is less than `settings.CASCADE_THRESHOLD` confident about (or failed
+    on) through ResNet50 with `run_model()`.
+
+    Parameters
+    ----------
+    img_arrays : list(numpy.ndarray)
+        Arrays returned by `load_image()`.
+
+    Returns
+    -------
+    list(tuple(str, float, str))
+        One (class_name, pred_probability, stage) tuple per image, stage
+        being the name of the model that answered.
+    """
+    try:
+        img_batch = preprocess_mobilenet_v2(stack_images(img_arrays))
+        logger.info(f"Running cascade model on a batch of {len(img_arrays)} images")
+        fast = top_predictions(cascade_model.predict(img_batch))
+    except Exception as e:
+        logger.error(f"Error predicting batch with the cascade model: {e}")
+        fast = [(None, None)] * len(img_arrays)
+
+    results = [
+        (class_name, pred_probability, settings.CASCADE_MODEL)
+        for class_name, pred_probability in fast
+    ]
+    escalated = [
+        i
+        for i, (class_name, pred_probability) in enumerate(fast)
+        if class_name is None or pred_probability < settings.CASCADE_THRESHOLD
+    ]
+    if escalated:
+        slow = run_model([img_arrays[i] for i in escalated])
+        for i, (class_name, pred_probability) in zip(escalated, slow):
+            results[i] = (class_name, pred_probability, settings.MODEL_NAME)
+    logger.info(
+        f"Cascade escalated {len(escalated)} of {len(img_arrays)} images "
+        f"to {settings.MODEL_NAME}"
+    )
+    record_cascade(len(img_arrays), len(escalated))
+    return results
+
+
+def record_cascade(images, escalated):
+    """
+    Add to the cascade counters in `settings.CASCADE_STATS_KEY`, the
+    escalation rate being escalated / images.
+    """
+    try:
+        pipe = db.pipeline(transaction=False)
+        pipe.hincrby(settings.CASCADE_STATS_KEY, "images", images)
+        if escalated:
+            pipe.hincrby(settings.CASCADE_STATS_KEY, "escalated", escalated)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error updating cascade stats: {e}")
+
+
+def predict_images(images):
+    """
+    Predict decoded images and store the predictions in the cache that
+    will be used to speed up retrieval in case of a repeated file. Images
+    go through the model in forward passes of at most
+    `settings.BATCH_SIZE` images, the shapes warmed up at startup, however
+    many jobs they come from.
+
+    Parameters
+    ----------
+    images : dict
+        Maps image names to the arrays returned by `load_image()`.
+
+    Returns
+    -------
+    dict
+        Maps image names to (class_name, pred_probability, stage) tuples,
+        stage being the name of the model that answered.
+    """
+    if not images:
+        return {}
+    all_arrays = list(images.values())
+    predictions = []
+    for start in range(0, len(all_arrays), settings.BATCH_SIZE):
+        img_arrays = all_arrays[start : start + settings.BATCH_SIZE]
+        if cascade_model is not None:
+            predictions += run_cascade(img_arrays)
+        else:
+            predictions += [
+                (class_name, pred_probability, settings.MODEL_NAME)
+                for class_name, pred_probability in run_model(img_arrays)
+            ]
+    results = dict(zip(images, predictions))
+    for image_name, (class_name, pred_probability, stage) in results.items():
+        logger.info(
+            f"Prediction for {image_name}: {class_name}, {pred_probability} ({stage})"
+        )
+    cache.set_many({name: result for name, result in results.items() if result[0]})
+    return results
+
+
+def predict_batch(image_names):
+    """
+    Run our ML model over several images at once. Predictions found in
+    the cache are reused, the remaining images are stacked and sent
+    through the model, `settings.BATCH_SIZE` images per forward pass.
+
+    Parameters
+    ----------
+    image_names : list(str)
+        Image filenames.
+
+    Returns
+    -------
+    list(tuple(str, float))
+        One (class_name, pred_probability) pair per image, in the same
+        order as `image_names`. Images that could not be processed get
+        (None, None).
+    """
+    unique_names = list(dict.fromkeys(image_names))
+    results = cache.get_many(unique_names)
+    if results:
+        logger.info(f"Predictions found in cache for {list(results)}")
+
+    images = {}
+    for image_name in unique_names:
+        if image_name not in results:
+            img_array = load_image(image_name)
+            if img_array is not None:
+                images[image_name] = img_array
+    results.update(predict_images(images))
+
+    return [results.get(image_name, (None, None))[:2] for image_name in image_names]
+
+
 def predict(image_name):
     """
     Load image from the corresponding folder based on the image name
@@ -64,107 +431,568 @@ def predict(image_name):
         score as a number.
     """
     logger.info(f"Predicting image: {image_name}")
-    try:    
-        image_path = os.path.join(settings.UPLOAD_FOLDER, image_name)
-        logger.debug(f"Absolute image path: {os.path.abspath(image_path)}")
-        
-        if not os.path.exists(image_path):
-            logger.error(f"Image not found at {image_path}")
-            logger.debug(f"Contents of upload directory: {os.listdir(settings.UPLOAD_FOLDER)}")
-            return None, None
-        # TODO: Implement the code to predict the class of the image_name
+    return predict_batch([image_name])[0]
 
-        try:
-            prediction = db.get(image_name)
-            if prediction:
-                logger.info("Prediction found in Redis, returning results...")
-                prediction = json.loads(prediction)
-                return prediction["class"], prediction["score"]
-        except:
-            logger.info("Prediction not found in Redis, loading from disk...")
-        # Load image
-        image_path = os.path.join(settings.UPLOAD_FOLDER, image_name)
-        logger.info(f"Loading image from path: {image_path}")
-        img = image.load_img(image_path, target_size=(224, 224))
-        logger.info("Image loaded, applying preprocessing...")
-        # Apply preprocessing (convert to numpy array, match model input dimensions (including batch) and use the resnet50 preprocessing)
-        img_array = image.img_to_array(img)
-        logger.info("Image converted to numpy array, expanding dimensions...")
-        img_array = np.expand_dims(img_array, axis=0)
-        logger.info("Dimensions expanded, preprocessing...")
-        img_array = preprocess_input(img_array)
-
-        # Get predictions using model methods and decode predictions using resnet50 decode_predictions
-        predictions = model.predict(img_array)
-        logger.info("Predictions made, decoding predictions...")
-        logger.info(f"Top 5 predictions: {decode_predictions(predictions, top=5)}")
-        _, class_name, pred_probability = decode_predictions(predictions, top=1)[0][0]
-        logger.info(f"Predictions decoded, class name: {class_name}, probability: {pred_probability}")
 
-        # Convert probabilities to float and round it
-        logger.info("Predictions decoded, converting probabilities to float...")
-        pred_probability = round(float(pred_probability), 4)
-        logger.info("Probabilities converted to float, returning results...")
+def get_jobs(count=settings.BATCH_SIZE):
+    """
+    Block until a job arrives on the Redis queue, then keep draining the
+    queue until `count` jobs were collected or `settings.BATCH_MAX_WAIT_MS`
+    milliseconds have passed.
+
+    Parameters
+    ----------
+    count : int
+        Maximum number of jobs to take, no more than the worker has room
+        for so the others stay available to idle workers.
+
+    Returns
+    -------
+    list(tuple(bytes, bytes))
+        Stream message ID (None with the list transport) and raw payload
+        of each job, oldest first.
+    """
+    if settings.QUEUE_TRANSPORT == "stream":
+        return get_stream_jobs(count)
+
+    job = db.brpop(settings.REDIS_QUEUE)
+    if not job:
+        return []
+    jobs = [job[1]]
+    deadline = time.monotonic() + settings.BATCH_MAX_WAIT_MS / 1000
+
+    while len(jobs) < count:
+        # Grab whatever is already waiting without blocking
+        more = db.rpop(settings.REDIS_QUEUE, count - len(jobs))
+        if more:
+            jobs.extend(more)
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        job = db.brpop(settings.REDIS_QUEUE, timeout=remaining)
+        if job:
+            jobs.append(job[1])
+
+    return [(None, job) for job in jobs]
+
+
+def create_consumer_group():
+    """
+    Create the stream consumer group the workers read jobs through, unless
+    another worker already did. Jobs queued before are delivered too.
+    """
+    try:
+        db.xgroup_create(
+            settings.REDIS_STREAM, settings.REDIS_STREAM_GROUP, id="0", mkstream=True
+        )
+        logger.info(f"Created consumer group {settings.REDIS_STREAM_GROUP}")
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+# Last time jobs of dead workers were looked for, see `claim_stale_jobs()`
+last_claim = {"time": 0.0}
+
+
+def claim_stale_jobs(count=settings.BATCH_SIZE):
+    """
+    Take over at most `count` jobs delivered to another worker that stayed
+    pending for more than `settings.STREAM_CLAIM_IDLE_MS`, meaning that
+    worker died before publishing their results. Runs at most every
+    `settings.STREAM_CLAIM_INTERVAL` seconds.
+
+    Returns
+    -------
+    list(tuple(bytes, bytes))
+        Message ID and raw payload of each claimed job.
+    """
+    now = time.monotonic()
+    if now - last_claim["time"] < settings.STREAM_CLAIM_INTERVAL:
+        return []
+    last_claim["time"] = now
+    try:
+        # Only IDs, Redis 6.2 returns deleted entries without theirs
+        message_ids = db.xautoclaim(
+            settings.REDIS_STREAM,
+            settings.REDIS_STREAM_GROUP,
+            WORKER_ID,
+            min_idle_time=settings.STREAM_CLAIM_IDLE_MS,
+            count=count,
+            justid=True,
+        )
+        if not message_ids:
+            return []
+        pipe = db.pipeline(transaction=False)
+        for message_id in message_ids:
+            pipe.xrange(settings.REDIS_STREAM, message_id, message_id)
+        entries = pipe.execute()
+        jobs = []
+        gone = []
+        for message_id, entry in zip(message_ids, entries):
+            if entry:
+                jobs.append((message_id, entry[0][1][b"job"]))
+            else:
+                gone.append(message_id)
+        if gone:
+            # Taken back by the API or trimmed from the stream, acknowledged
+            # so they are not claimed again on every pass
+            db.xack(settings.REDIS_STREAM, settings.REDIS_STREAM_GROUP, *gone)
+    except Exception as e:
+        logger.error(f"Error claiming stale jobs: {e}")
+        return []
+    if jobs:
+        logger.warning(f"Claimed {len(jobs)} jobs left pending by another worker")
+    return jobs
+
+
+def get_stream_jobs(count=settings.BATCH_SIZE):
+    """
+    Stream transport version of `get_jobs()`: jobs of dead workers are
+    claimed first, then new ones are read through the consumer group,
+    several at a time. Jobs stay pending until `publish_results()`
+    acknowledges them.
+    """
+    jobs = claim_stale_jobs(count)
+    deadline = None
+    while len(jobs) < count:
+        if not jobs:
+            # Wake up now and then to claim the jobs of dead workers
+            block = settings.STREAM_CLAIM_INTERVAL * 1000
+        else:
+            if deadline is None:
+                deadline = time.monotonic() + settings.BATCH_MAX_WAIT_MS / 1000
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            block = max(int(remaining * 1000), 1)
+        response = db.xreadgroup(
+            settings.REDIS_STREAM_GROUP,
+            WORKER_ID,
+            {settings.REDIS_STREAM: ">"},
+            count=count - len(jobs),
+            block=block,
+        )
+        if not response:
+            if not jobs:
+                return []
+            continue
+        for message_id, fields in response[0][1]:
+            jobs.append((message_id, fields[b"job"]))
+    return jobs
+
+
+def ack_jobs(message_ids, pipe):
+    """
+    Acknowledge stream jobs so they are not claimed again, on the given
+    Redis pipeline, and delete them: the stream then only holds the jobs
+    not finished yet, and its length is the backlog the API admission
+    control reads. Jobs from the list transport have no message ID.
+    """
+    message_ids = [message_id for message_id in message_ids if message_id]
+    if message_ids:
+        pipe.xack(settings.REDIS_STREAM, settings.REDIS_STREAM_GROUP, *message_ids)
+        pipe.xdel(settings.REDIS_STREAM, *message_ids)
+
+
+def parse_job(raw_job):
+    """
+    Decode a job payload. Jobs are dicts with an "id" and either an
+    "image_name" or, for grouped jobs, a list of "image_names", plus the
+    "enqueued_at" and "deadline" Unix timestamps set by the API. Images
+    sent along with the job come with an "image_transport" and their
+    "image_refs" (see `read_images()`). The "timestamps" of the job, to
+    which the worker adds its own, are returned with its output. The older
+    [job_id, image_name] shape, without deadline, is still accepted.
+
+    Parameters
+    ----------
+    raw_job : bytes
+        Job payload as read from the Redis queue.
+
+    Returns
+    -------
+    dict or None
+        Job data, or None if the payload is malformed.
+    """
+    try:
+        job_data = json.loads(raw_job)
+        if isinstance(job_data, list):
+            job_data = {"id": job_data[0], "image_name": job_data[1]}
+        job_image_names(job_data)
+        return job_data
+    except Exception as e:
+        logger.error(f"Discarding malformed job {raw_job}: {e}")
+        return None
+
+
+def job_image_names(job_data):
+    if "image_names" in job_data:
+        return job_data["image_names"]
+    return [job_data["image_name"]]
+
+
+def job_expired(job_data):
+    """
+    Whether the client gave up on this job, its deadline being passed.
+    """
+    deadline = job_data.get("deadline")
+    return deadline is not None and time.time() > deadline
+
+
+def record_expired(jobs):
+    """
+    Add the jobs dropped because they expired, and their images, to the
+    counters in `settings.JOB_STATS_KEY`.
+    """
+    images = sum(len(job_image_names(job_data)) for job_data in jobs)
+    logger.warning(
+        f"Dropping {len(jobs)} expired jobs: {[job_data['id'] for job_data in jobs]}"
+    )
+    try:
+        pipe = db.pipeline(transaction=False)
+        pipe.hincrby(settings.JOB_STATS_KEY, "expired", len(jobs))
+        pipe.hincrby(settings.JOB_STATS_KEY, "expired_images", images)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error updating job stats: {e}")
+
+
+def job_output(job_data, results):
+    """
+    Build the output sent back for a job from the predictions of its
+    images, with the model stage that answered each of them when known.
+    Grouped jobs get the list of per-image predictions, in order.
+    """
+    outputs = []
+    for class_name, pred_probability, *stage in results:
+        output = {"prediction": class_name, "score": pred_probability}
+        if stage and class_name is not None:
+            output["stage"] = stage[0]
+        outputs.append(output)
+    if "image_names" in job_data:
+        return {"predictions": outputs}
+    return outputs[0]
+
+
+def prepare_job(job_data):
+    """
+    Pipeline decoding stage: look up the job images in the cache and load
+    the ones that need to go through the model. Jobs already expired are
+    not decoded.
+
+    Parameters
+    ----------
+    job_data : dict
+        Job data as returned by `parse_job()`.
+
+    Returns
+    -------
+    dict
+        The job data with the cached predictions and decoded images, or
+        flagged as expired.
+    """
+    if job_expired(job_data):
+        return {"job": job_data, "expired": True}
+    timestamps = job_data.setdefault("timestamps", {})
+    timestamps["decode_start"] = time.time()
+    image_names = list(dict.fromkeys(job_image_names(job_data)))
+    predictions = cache.get_many(image_names)
+    # Cached arrays are read once up front, so an entry evicted meanwhile
+    # can't leave an image without content. Only the misses are read and
+    # decoded.
+    images = {}
+    misses = []
+    for image_name in image_names:
+        if image_name in predictions:
+            continue
+        img_array = tensors.get(image_name)
+        if img_array is None:
+            misses.append(image_name)
+        else:
+            images[image_name] = img_array
+    contents = read_images(job_data, misses)
+    for image_name in misses:
+        img_array = decode_upload(image_name, contents.get(image_name))
+        if img_array is not None:
+            images[image_name] = img_array
+    # Only the images read from the upload folder are indexed there
+    stored = [image_name for image_name in images if image_name not in contents]
+    if stored:
+        uploads.touch(stored)
+    timestamps["decoded"] = time.time()
+    return {
+        "job": job_data,
+        "expired": False,
+        "predictions": predictions,
+        "images": images,
+    }
+
+
+def prepared_images(prepared):
+    """
+    Number of images of a prepared job that go through the model.
+    """
+    return len(prepared.get("images", {}))
+
+
+def infer_jobs(prepared_jobs):
+    """
+    Pipeline inference stage: run the images of all the prepared jobs
+    through the model, see `predict_images()`, and publish the results of
+    each job. Jobs that expired, before or after being decoded, are
+    answered with an "expired" status instead.
+
+    Parameters
+    ----------
+    prepared_jobs : list(dict)
+        Jobs as returned by `prepare_job()`.
+    """
+    expired, live = [], []
+    for prepared in prepared_jobs:
+        if prepared["expired"] or job_expired(prepared["job"]):
+            expired.append(prepared["job"])
+        else:
+            live.append(prepared)
+    outputs = [(job_data, {"status": "expired"}) for job_data in expired]
+    if expired:
+        record_expired(expired)
+    prepared_jobs = live
+
+    images = {}
+    for prepared in prepared_jobs:
+        images.update(prepared["images"])
+    infer_start = time.time()
+    start = time.perf_counter()
+    predictions = predict_images(images)
+    if images:
+        record_inference(len(images), time.perf_counter() - start)
+    inferred = time.time()
+    for prepared in prepared_jobs:
+        prepared["job"]["timestamps"].update(infer_start=infer_start, inferred=inferred)
+
+    for prepared in prepared_jobs:
+        job_predictions = {**prepared["predictions"], **predictions}
+        results = [
+            job_predictions.get(image_name, (None, None))
+            for image_name in job_image_names(prepared["job"])
+        ]
+        outputs.append((prepared["job"], job_output(prepared["job"], results)))
+    publish_results(outputs)
+
+
+def publish_results(outputs):
+    """
+    Push the job results to the API through the results channel, and also
+    store them on Redis using the original job ID as the key for clients
+    that missed the message. Stream jobs are acknowledged, and the images
+    taken off the count read by the API admission control, at the same
+    time. Outputs carry the job timestamps, the API ones and those added
+    at each stage of the worker, for the API latency breakdown.
+
+    Parameters
+    ----------
+    outputs : list(tuple(dict, dict))
+        Job data and output of each job.
+    """
+    pipe = db.pipeline()
+    published = time.time()
+    for job_data, output in outputs:
+        if "timestamps" in job_data:
+            output = {
+                **output,
+                "timestamps": {**job_data["timestamps"], "published": published},
+            }
+        pipe.set(job_data["id"], json.dumps(output), ex=settings.RESULT_TTL)
+        pipe.publish(
+            settings.REDIS_RESULTS_CHANNEL,
+            json.dumps({"id": job_data["id"], **output}),
+        )
+    ack_jobs([job_data.get("message_id") for job_data, _ in outputs], pipe)
+    images = sum(len(job_image_names(job_data)) for job_data, _ in outputs)
+    pipe.decrby(settings.QUEUED_IMAGES_KEY, images)
+    pipe.execute()
+    logger.info(f"Results published for job IDs: {[job['id'] for job, _ in outputs]}")
+
+
+def fetch_jobs(count=settings.BATCH_SIZE):
+    """
+    Pipeline fetching stage: wait for at most `count` new jobs from Redis
+    and parse them.
+    """
+    logger.info("Waiting for new jobs from Redis...")
+    jobs = get_jobs(count)
+    dequeued = time.time()
+    logger.debug(f"Raw job data received: {jobs}")
+    parsed, malformed = [], []
+    for message_id, raw_job in jobs:
+        job_data = parse_job(raw_job)
+        if job_data is None:
+            malformed.append(message_id)
+            continue
+        job_data.setdefault("timestamps", {})["dequeued"] = dequeued
+        if message_id is not None:
+            # Acknowledged once the result is published
+            job_data["message_id"] = message_id
+        parsed.append(job_data)
+    if any(malformed):
+        # Would be claimed again forever otherwise
+        pipe = db.pipeline()
+        ack_jobs(malformed, pipe)
+        pipe.execute()
+    return parsed
+
+
+def report_occupancy(pipeline):
+    """
+    Export the pipeline stage occupancy to Redis every
+    `settings.PIPELINE_STATS_INTERVAL` seconds, under
+    `settings.PIPELINE_STATS_PREFIX` + worker ID.
+    """
+    key = settings.PIPELINE_STATS_PREFIX + WORKER_ID
+    while True:
+        time.sleep(settings.PIPELINE_STATS_INTERVAL)
+        stats = pipeline.occupancy()
+        logger.debug(f"Pipeline occupancy: {stats}")
         try:
-            # store the prediction in Redis in a separate queue that will be used to speed up retrieval in case of a repeated file
-            db.set(image_name, json.dumps({"class": class_name, "score": pred_probability}))
+            pipe = db.pipeline()
+            pipe.hset(key, mapping=stats)
+            pipe.expire(key, 3 * settings.PIPELINE_STATS_INTERVAL)
+            pipe.execute()
         except Exception as e:
-            logger.error(f"Error storing prediction in Redis: {e}")
-            
-        return class_name, pred_probability
-    except Exception as e:
-        logger.error(f"Error predicting image: {e}")
-        return None, None
+            logger.error(f"Error exporting pipeline occupancy: {e}")
 
 
-def classify_process():
+# Images run through the model and seconds spent doing it since the last
+# heartbeat, used to advertise the worker throughput
+inference_stats = {"images": 0, "seconds": 0.0}
+inference_lock = threading.Lock()
+
+
+def record_inference(images, seconds):
+    with inference_lock:
+        inference_stats["images"] += images
+        inference_stats["seconds"] += seconds
+
+
+def measure_throughput(previous):
     """
-    Loop indefinitely asking Redis for new jobs.
-    When a new job arrives, takes it from the Redis queue, uses the loaded ML
-    model to get predictions and stores the results back in Redis using
-    the original job ID so other services can see it was processed and access
-    the results.
+    Images per second of inference since the last call, averaged with the
+    previous measure so a single slow batch doesn't swing it. Time spent
+    idle doesn't count, so this is what the worker can take under load.
 
-    Load image from the corresponding folder based on the image name
-    received, then, run our ML model to get predictions.
+    Parameters
+    ----------
+    previous : float
+        Previous measure, 0 if there is none.
+
+    Returns
+    -------
+    float
+        Throughput in images per second, `previous` if nothing ran.
     """
-    logger.info("Starting classify process...")
+    with inference_lock:
+        images, seconds = inference_stats["images"], inference_stats["seconds"]
+        inference_stats.update(images=0, seconds=0.0)
+    if seconds <= 0:
+        return previous
+    throughput = images / seconds
+    if previous:
+        throughput = (previous + throughput) / 2
+    return throughput
+
+
+def warm_up():
+    """
+    Run the models once at each of `settings.WARMUP_BATCH_SIZES`, so graph
+    tracing and memory allocation happen before the first job and not
+    while a client waits.
+    """
+    for batch_size in settings.WARMUP_BATCH_SIZES:
+        img_batch = np.zeros((batch_size, 224, 224, 3), dtype=np.float32)
+        with timed(f"warm-up batch {batch_size}"):
+            model.predict(preprocess_input(img_batch))
+            if cascade_model is not None:
+                cascade_model.predict(preprocess_mobilenet_v2(img_batch))
+
+    # Once traced, a full batch gives the first throughput measure
+    img_batch = np.zeros((settings.BATCH_SIZE, 224, 224, 3), dtype=np.float32)
+    start = time.perf_counter()
+    model.predict(preprocess_input(img_batch))
+    record_inference(settings.BATCH_SIZE, time.perf_counter() - start)
+
+
+def advertise_ready():
+    """
+    Tell other services this worker is warm and taking jobs: the key
+    `settings.READY_PREFIX` + worker ID, with the number of images the
+    worker takes per forward pass as its capacity and its measured
+    throughput in images per second, is refreshed every
+    `settings.HEARTBEAT_INTERVAL` seconds and expires after
+    `settings.READY_TTL` seconds once the worker stops. The worker is also
+    registered in `settings.WORKERS_KEY`, scored by its last heartbeat.
+    """
+    key = settings.READY_PREFIX + WORKER_ID
+    throughput = 0.0
     while True:
+        throughput = measure_throughput(throughput)
+        info = json.dumps(
+            {
+                "worker": WORKER_ID,
+                "backend": settings.INFERENCE_BACKEND,
+                "cascade": settings.CASCADE_ENABLED,
+                "capacity": settings.BATCH_SIZE,
+                "throughput": round(throughput, 2),
+                "startup": startup_timings,
+            }
+        )
         try:
-            logger.info("Waiting for a new job from Redis...")
-            logger.debug(f"Current contents of upload directory: {os.listdir(settings.UPLOAD_FOLDER)}")
-            
-            job = db.brpop(settings.REDIS_QUEUE)
-            logger.debug(f"Raw job data received: {job}")
-            
-            if not job:
-                logger.warning("No job received from Redis")
-                time.sleep(settings.SERVER_SLEEP)
-                continue
-                
-            job_data = json.loads(job[1])
-            logger.debug(f"Parsed job data: {job_data}")
-            
-            job_id = job_data[0]
-            image_name = job_data[1]
-            logger.info(f"Processing job {job_id} for image {image_name}")
-            
-            # Run the loaded ml model (use the predict() function)
-            class_name, pred_probability = predict(image_name)
-            logger.info(f"Prediction made: {class_name}, {pred_probability}")
-            # Prepare a new JSON with the results
-            output = {"prediction": class_name, "score": pred_probability}
-
-            # Store the job results on Redis using the original
-            # job ID as the key
-            db.set(job_id, json.dumps(output))
-            logger.info(f"Results stored in Redis with job ID: {job_id}")
-            # Sleep for a bit
-            time.sleep(settings.SERVER_SLEEP)
-            logger.info(f"Sleeping for {settings.SERVER_SLEEP} seconds")
+            pipe = db.pipeline()
+            pipe.set(key, info, ex=settings.READY_TTL)
+            pipe.zadd(settings.WORKERS_KEY, {WORKER_ID: time.time()})
+            pipe.execute()
         except Exception as e:
-            logger.exception(f"Error in classify process: {e}")
-            time.sleep(settings.SERVER_SLEEP)
+            logger.error(f"Error refreshing readiness key: {e}")
+        time.sleep(settings.HEARTBEAT_INTERVAL)
+
+
+def classify_process():
+    """
+    Warm up the models, advertise the worker as ready and loop
+    indefinitely asking Redis for new jobs.
+    When new jobs arrive, takes them from the Redis queue, loads their
+    images on a pool of decoder threads and, while the next ones are being
+    decoded, uses the loaded ML model to get predictions for up to
+    `settings.BATCH_SIZE` ready jobs in one go. The results are published
+    on `settings.REDIS_RESULTS_CHANNEL` and also stored in Redis using the
+    original job IDs so other services can still access them if they
+    missed the message.
+    """
+    logger.info("Starting classify process...")
+    if settings.QUEUE_TRANSPORT == "stream":
+        create_consumer_group()
+    warm_up()
+    logger.info(
+        f"Worker ready after {sum(startup_timings.values()):.2f}s: {startup_timings}"
+    )
+    threading.Thread(target=advertise_ready, daemon=True).start()
+    threading.Thread(
+        target=uploads.run_gc, args=(settings.UPLOAD_GC_INTERVAL,), daemon=True
+    ).start()
+
+    pipeline = InferencePipeline(
+        fetch=fetch_jobs,
+        prepare=prepare_job,
+        infer=infer_jobs,
+        batch_size=settings.BATCH_SIZE,
+        max_wait=settings.BATCH_MAX_WAIT_MS / 1000,
+        prefetch_depth=settings.PREFETCH_DEPTH,
+        decoder_threads=settings.DECODER_THREADS,
+        size=prepared_images,
+    )
+    threading.Thread(target=report_occupancy, args=(pipeline,), daemon=True).start()
+    pipeline.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+
+class InferencePipeline:
+    """
+    Staged job processing for the ML service, so image decoding overlaps
+    with inference instead of alternating with it on the same thread.
+
+    - A fetcher thread pulls jobs from Redis with `fetch(count)`.
+    - A pool of decoder threads runs `prepare(job)` on each of them (cache
+      lookups, image decoding and resizing) and puts the prepared jobs on
+      a bounded queue of ready work.
+    - The inference stage takes ready jobs until they hold `batch_size`
+      images, as counted by `size(prepared_job)`, waiting at most
+      `max_wait` seconds after the first one, and hands them to
+      `infer(prepared_jobs)`. A job that would go over the limit waits for
+      the next batch, one larger than the limit makes a batch on its own.
+
+    At most `prefetch_depth` jobs are fetched ahead of inference: slots
+    are taken before fetching and only as many jobs as free slots are
+    pulled from Redis, at most `batch_size`. Once the limit is reached the
+    fetcher stops, leaving jobs in the queue for other workers.
+
+    Parameters
+    ----------
+    fetch : callable
+        Takes the maximum number of jobs to return and returns a list of
+        jobs, blocking until there is at least one.
+    prepare : callable
+        Turns a job into a prepared job, run in the decoder threads.
+    infer : callable
+        Processes a list of prepared jobs.
+    batch_size : int
+        Maximum number of images handed to `infer` at once.
+    max_wait : float
+        Seconds to wait for more ready jobs once the first one is ready.
+    prefetch_depth : int
+        Maximum number of jobs fetched but not yet inferred.
+    decoder_threads : int
+        Number of decoder threads.
+    size : callable, optional
+        Returns the number of images of a prepared job, each job counts as
+        one if not given.
+    """
+
+    def __init__(
+        self,
+        fetch,
+        prepare,
+        infer,
+        batch_size,
+        max_wait,
+        prefetch_depth,
+        decoder_threads,
+        size=None,
+    ):
+        self.fetch = fetch
+        self.prepare = prepare
+        self.infer = infer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.decoder_threads = decoder_threads
+        self.size = size or (lambda prepared: 1)
+        # Ready job left out of the previous batch, for being too large
+        self.held = None
+        self.slots = threading.BoundedSemaphore(prefetch_depth)
+        self.ready = queue.Queue()
+        self.decoders = ThreadPoolExecutor(
+            max_workers=decoder_threads, thread_name_prefix="decoder"
+        )
+        self.lock = threading.Lock()
+        self.decoding = 0
+        self.busy = {"blocked": 0.0, "decode": 0.0, "infer": 0.0}
+        self.started = time.monotonic()
+
+    def add_busy(self, stage, seconds):
+        with self.lock:
+            self.busy[stage] += seconds
+
+    def fetch_loop(self):
+        while True:
+            # Blocks while prefetch_depth jobs are already in the pipeline,
+            # then takes the other free slots, up to a batch
+            start = time.monotonic()
+            self.slots.acquire()
+            self.add_busy("blocked", time.monotonic() - start)
+            free = 1
+            while free < self.batch_size and self.slots.acquire(blocking=False):
+                free += 1
+            try:
+                jobs = self.fetch(free)
+            except Exception as e:
+                logger.exception(f"Error fetching jobs: {e}")
+                jobs = []
+                time.sleep(1)
+            for job in jobs:
+                with self.lock:
+                    self.decoding += 1
+                self.decoders.submit(self.decode, job)
+            for _ in range(free - len(jobs)):
+                self.slots.release()
+
+    def decode(self, job):
+        start = time.monotonic()
+        try:
+            prepared = self.prepare(job)
+        except Exception as e:
+            logger.exception(f"Error preparing job {job}: {e}")
+            prepared = None
+        with self.lock:
+            self.decoding -= 1
+        self.add_busy("decode", time.monotonic() - start)
+        if prepared is None:
+            self.slots.release()
+        else:
+            self.ready.put(prepared)
+
+    def next_batch(self):
+        """
+        Block until a prepared job is ready, then collect more until they
+        hold `batch_size` images, waiting at most `max_wait` seconds.
+        """
+        if self.held is not None:
+            batch = [self.held]
+            self.held = None
+        else:
+            batch = [self.ready.get()]
+        images = self.size(batch[0])
+        deadline = time.monotonic() + self.max_wait
+        while images < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    prepared = self.ready.get(timeout=remaining)
+                else:
+                    prepared = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            if images + self.size(prepared) > self.batch_size:
+                self.held = prepared
+                break
+            batch.append(prepared)
+            images += self.size(prepared)
+        return batch
+
+    def occupancy(self):
+        """
+        Current load of each stage: jobs being decoded and ready for
+        inference, plus the fraction of time since the previous call that
+        the fetcher was blocked by a full pipeline and that the decoders
+        and the inference stage were busy. Decode busy time is relative to
+        all decoder threads.
+
+        Returns
+        -------
+        dict
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.started, 1e-9)
+            stats = {
+                "decoding": self.decoding,
+                "ready": self.ready.qsize(),
+                "fetch_blocked": round(self.busy["blocked"] / elapsed, 3),
+                "decode_busy": round(
+                    self.busy["decode"] / elapsed / self.decoder_threads, 3
+                ),
+                "infer_busy": round(self.busy["infer"] / elapsed, 3),
+            }
+            self.busy = dict.fromkeys(self.busy, 0.0)
+            self.started = now
+        return stats
+
+    def run(self):
+        """
+        Start the fetcher thread and run the inference stage forever on the
+        calling thread.
+        """
+        threading.Thread(target=self.fetch_loop, name="fetcher", daemon=True).start()
+        while True:
+            batch = self.next_batch()
+            start = time.monotonic()
+            try:
+                self.infer(batch)
+            except Exception as e:
+                logger.exception(f"Error running inference: {e}")
+            finally:
+                self.add_busy("infer", time.monotonic() - start)
+                for _ in batch:
+                    self.slots.release()
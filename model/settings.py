@@ -3,6 +3,22 @@ import os
 # We will store images uploaded by the user on this folder
 UPLOAD_FOLDER = "uploads/"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Uploads are sharded by hash prefix (see blobstore.py) and their last
+# access time and size indexed in the Redis sorted set UPLOAD_ATIME_KEY
+# and hash UPLOAD_SIZE_KEY, with their total in UPLOAD_TOTAL_KEY, must
+# match the API settings. Every UPLOAD_GC_INTERVAL seconds one worker
+# deletes the images not accessed for UPLOAD_MAX_AGE seconds, then the
+# least recently used ones until they fit in UPLOAD_MAX_BYTES (0 disables
+# either limit). Images accessed in the last UPLOAD_MIN_AGE seconds are
+# always kept.
+UPLOAD_ATIME_KEY = "uploads:atime"
+UPLOAD_SIZE_KEY = "uploads:size"
+UPLOAD_TOTAL_KEY = "uploads:bytes"
+UPLOAD_GC_LOCK = "uploads:gc_lock"
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 10 * 2**30))
+UPLOAD_MAX_AGE = int(os.getenv("UPLOAD_MAX_AGE", 30 * 24 * 3600))
+UPLOAD_MIN_AGE = int(os.getenv("UPLOAD_MIN_AGE", 3600))
+UPLOAD_GC_INTERVAL = 600
 
 # REDIS
 # Queue name
@@ -13,6 +29,135 @@ REDIS_PORT = 6379
 REDIS_DB_ID = 0
 # Host IP
 REDIS_IP = os.getenv("REDIS_IP", "redis")
+# Job transport between the API and the workers, must match the API
+# settings: "list" (LPUSH/BRPOP on REDIS_QUEUE) or "stream" (Redis Stream
+# REDIS_STREAM read through the consumer group REDIS_STREAM_GROUP). With
+# streams a job stays pending until its result is published, then it is
+# deleted so the stream length is the backlog read by the API, and jobs
+# left pending for STREAM_CLAIM_IDLE_MS by a crashed worker are claimed
+# by another one, checked every STREAM_CLAIM_INTERVAL seconds.
+QUEUE_TRANSPORT = os.getenv("QUEUE_TRANSPORT", "list")
+REDIS_STREAM = "service_stream"
+REDIS_STREAM_GROUP = "ml_service"
+STREAM_CLAIM_IDLE_MS = int(os.getenv("STREAM_CLAIM_IDLE_MS", 60000))
+STREAM_CLAIM_INTERVAL = 5
+# Images of the jobs queued or being processed, counted by the API for its
+# admission control, must match its settings. Subtracted when a job is
+# answered.
+QUEUED_IMAGES_KEY = "queue:images"
+# Channel where job results are published for the API
+REDIS_RESULTS_CHANNEL = "service_results"
+# Seconds a job result is kept under its job ID for clients that
+# missed the published message
+RESULT_TTL = int(os.getenv("RESULT_TTL", 300))
+# Prediction cache. Keys are namespaced by model name and version, and
+# by inference backend and cascade (CACHE_PREFIX, set below with them), so
+# a model change never serves stale labels.
+MODEL_NAME = "resnet50"
+MODEL_VERSION = os.getenv("MODEL_VERSION", "1")
+# Seconds a prediction is kept in Redis
+CACHE_TTL = int(os.getenv("CACHE_TTL", 7 * 24 * 3600))
+# Maximum number of predictions kept in Redis, the least recently stored
+# ones are deleted past it, 0 for no limit
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 100000))
+# Number of predictions also kept in the worker process
+CACHE_LOCAL_SIZE = int(os.getenv("CACHE_LOCAL_SIZE", 1024))
+# Redis hash counting the jobs (and their images) dropped because their
+# deadline passed before they were processed
+JOB_STATS_KEY = "ml_service:jobs:stats"
+# Redis memory budget and eviction policy applied to the whole server at
+# startup, empty (the default) to leave Redis untouched. With
+# "volatile-lru" any key with a TTL may be evicted, including worker
+# heartbeats, job records and inline images, so the prediction cache is
+# bounded to CACHE_MAX_ENTRIES predictions on its own instead.
+REDIS_MAXMEMORY = os.getenv("REDIS_MAXMEMORY", "")
+REDIS_MAXMEMORY_POLICY = os.getenv("REDIS_MAXMEMORY_POLICY", "volatile-lru")
 # Sleep parameters which manages the
 # interval between requests to our redis queue
 SERVER_SLEEP = 0.05
+
+# Micro-batching parameters. The worker drains up to BATCH_SIZE jobs
+# from the queue, waiting at most BATCH_MAX_WAIT_MS milliseconds after
+# the first one arrives, and runs their images in forward passes of at
+# most BATCH_SIZE images.
+# Setting BATCH_SIZE to 1 restores one-job-at-a-time processing.
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 16))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", 10))
+
+# Worker pool started by supervisor.py. Each process loads its own model
+# and consumes from the same queue.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+# TensorFlow thread pools of each worker, 0 leaves TensorFlow's defaults
+# (as many threads as cores, which oversubscribes with several workers)
+TF_INTRA_OP_THREADS = int(os.getenv("TF_INTRA_OP_THREADS", 0))
+TF_INTER_OP_THREADS = int(os.getenv("TF_INTER_OP_THREADS", 0))
+# CPUs each worker is pinned to: empty to not pin, "auto" to split the
+# available CPUs evenly, or one CPU list per worker such as "0-1;2-3"
+WORKER_CPU_AFFINITY = os.getenv("WORKER_CPU_AFFINITY", "")
+# Seconds between checks of the worker processes, and before restarting
+# a crashed one
+SUPERVISOR_INTERVAL = 1
+WORKER_RESTART_DELAY = 1
+
+# Decode/inference pipeline. DECODER_THREADS load and resize images while
+# the model runs, keeping at most PREFETCH_DEPTH jobs fetched ahead of
+# inference: enough to decode the next batch during the current one,
+# without hiding the backlog from admission control and idle workers.
+DECODER_THREADS = int(os.getenv("DECODER_THREADS", 2))
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", 2 * BATCH_SIZE))
+# Per-stage occupancy is exported every PIPELINE_STATS_INTERVAL seconds
+# to the Redis hash PIPELINE_STATS_PREFIX + worker ID
+PIPELINE_STATS_PREFIX = "ml_service:pipeline:"
+PIPELINE_STATS_INTERVAL = 10
+
+# Large JPEG uploads are decoded directly at 1/2, 1/4 or 1/8 scale as long
+# as the decoded image stays at least DECODE_DRAFT_FACTOR times the model
+# input size, 0 always decodes at full resolution
+DECODE_DRAFT_FACTOR = int(os.getenv("DECODE_DRAFT_FACTOR", 2))
+# Decoded images are cached in TENSOR_CACHE_DIR as memory-mapped arrays,
+# up to TENSOR_CACHE_MAX_BYTES (0 disables it), so predicting an image
+# again, e.g. after its prediction expired or the model version changed,
+# skips decoding. Clear the folder when the decoding settings change.
+TENSOR_CACHE_DIR = os.getenv("TENSOR_CACHE_DIR", "tensor_cache/")
+TENSOR_CACHE_MAX_BYTES = int(os.getenv("TENSOR_CACHE_MAX_BYTES", 2**30))
+
+# Inference backend: "keras", "tflite-fp16", "tflite-int8" or "onnx",
+# loaded from the artifacts written by export_model.py to MODEL_DIR (keras
+# falls back to downloading the weights when its artifact is missing).
+# Predictions differ slightly between backends, which get their own
+# prediction cache namespace.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+MODEL_DIR = os.getenv("MODEL_DIR", "artifacts")
+CLASS_INDEX_PATH = os.path.join(MODEL_DIR, "imagenet_class_index.json")
+
+# Model cascade: MobileNetV2 classifies every image first and only the
+# ones it is less than CASCADE_THRESHOLD confident about are sent to
+# ResNet50. Cached predictions record the stage that answered them.
+# Counters of classified and escalated images are kept in the Redis hash
+# CASCADE_STATS_KEY.
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "false").lower() in ("1", "true", "yes")
+CASCADE_MODEL = "mobilenet_v2"
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", 0.9))
+CASCADE_STATS_KEY = "ml_service:cascade:stats"
+
+# Namespace of the prediction cache, must match the API settings
+CACHE_PREFIX = f"prediction:{MODEL_NAME}:{MODEL_VERSION}:{INFERENCE_BACKEND}"
+if CASCADE_ENABLED:
+    CACHE_PREFIX += f":{CASCADE_MODEL}-{CASCADE_THRESHOLD}"
+
+# Startup. Before taking jobs each worker runs the model once at each of
+# WARMUP_BATCH_SIZES (default: powers of two up to BATCH_SIZE) so the
+# first requests don't pay for graph tracing. Once warm it advertises
+# itself in the Redis key READY_PREFIX + worker ID, refreshed every
+# HEARTBEAT_INTERVAL seconds and expiring after READY_TTL seconds if the
+# worker dies, and registers in the sorted set WORKERS_KEY where the API
+# looks for live workers.
+WARMUP_BATCH_SIZES = [
+    int(size) for size in os.getenv("WARMUP_BATCH_SIZES", "").split(",") if size.strip()
+] or [2**i for i in range(BATCH_SIZE.bit_length()) if 2**i < BATCH_SIZE] + [
+    BATCH_SIZE
+]
+READY_PREFIX = "ml_service:ready:"
+WORKERS_KEY = "ml_service:workers"
+HEARTBEAT_INTERVAL = 5
+READY_TTL = 3 * HEARTBEAT_INTERVAL
@@ -0,0 +1,145 @@
+import multiprocessing
+import os
+import signal
+import time
+
+import settings
+from loguru import logger
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a CPU list like "0-3,6" into a set of CPU numbers.
+    """
+    cpus = set()
+    for part in cpu_list.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def get_cpu_affinity(index, workers):
+    """
+    CPUs a worker process should be pinned to, according to
+    `settings.WORKER_CPU_AFFINITY`.
+
+    Parameters
+    ----------
+    index : int
+        Worker number, from 0 to `workers - 1`.
+    workers : int
+        Number of worker processes.
+
+    Returns
+    -------
+    set(int) or None
+        CPU numbers, or None to leave the process unpinned.
+    """
+    affinity = settings.WORKER_CPU_AFFINITY
+    if not affinity:
+        return None
+    if affinity == "auto":
+        # Split the CPUs available to the supervisor evenly among workers
+        available = sorted(os.sched_getaffinity(0))
+        share = max(len(available) // workers, 1)
+        start = (index * share) % len(available)
+        return set(available[start : start + share])
+    groups = affinity.split(";")
+    return parse_cpu_list(groups[index % len(groups)])
+
+
+def configure_process(index, workers):
+    """
+    Pin the worker process to its CPUs and size TensorFlow's thread pools.
+    Must run before the model is loaded.
+    """
+    cpus = get_cpu_affinity(index, workers)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        logger.info(f"Worker {index} pinned to CPUs {sorted(cpus)}")
+
+    if settings.TF_INTRA_OP_THREADS:
+        os.environ["OMP_NUM_THREADS"] = str(settings.TF_INTRA_OP_THREADS)
+
+    # The TFLite and ONNX Runtime backends get their thread counts when
+    # they are loaded
+    if settings.INFERENCE_BACKEND != "keras" and not settings.CASCADE_ENABLED:
+        return
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(settings.TF_INTRA_OP_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(settings.TF_INTER_OP_THREADS)
+    logger.info(
+        f"Worker {index} using {settings.TF_INTRA_OP_THREADS or 'default'} intra-op "
+        f"and {settings.TF_INTER_OP_THREADS or 'default'} inter-op threads"
+    )
+
+
+def run_worker(index, workers):
+    """
+    Entry point of each worker process.
+    """
+    configure_process(index, workers)
+
+    # Importing ml_service connects to Redis and loads the model
+    import ml_service
+
+    ml_service.classify_process()
+
+
+def supervise():
+    """
+    Start `settings.INFERENCE_WORKERS` worker processes consuming from the
+    same Redis queue, and restart any of them that dies.
+    """
+    workers = settings.INFERENCE_WORKERS
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    running = True
+
+    def start(index):
+        process = context.Process(
+            target=run_worker, args=(index, workers), name=f"ml_worker_{index}"
+        )
+        process.start()
+        processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Starting {workers} ML service workers...")
+    for index in range(workers):
+        start(index)
+
+    while running:
+        time.sleep(settings.SUPERVISOR_INTERVAL)
+        for index, process in list(processes.items()):
+            if running and not process.is_alive():
+                logger.error(
+                    f"Worker {index} (pid {process.pid}) exited with code "
+                    f"{process.exitcode}, restarting"
+                )
+                time.sleep(settings.WORKER_RESTART_DELAY)
+                start(index)
+
+    logger.info("Stopping ML service workers...")
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join()
+
+
+if __name__ == "__main__":
+    supervise()
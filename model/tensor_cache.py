@@ -0,0 +1,132 @@
+import os
+import threading
+
+import numpy as np
+from loguru import logger
+
+
+class TensorCache:
+    """
+    Cache of decoded images keyed by image content hash, stored as uint8
+    `.npy` files of shape (224, 224, 3) and read back memory-mapped, so a
+    hit costs neither decoding nor an intermediate copy: pixels go from
+    the page cache straight into the batch. Images are cached before the
+    model preprocessing, so entries stay valid across model versions and
+    serve the cascade model too.
+
+    Files are written atomically and hits refresh their modification
+    time, so the worker processes of a host can share the folder. Once
+    the folder grows past `max_bytes`, the least recently used files are
+    deleted until it is back under 90% of it. Each process only counts its
+    own writes between two scans of the folder, so the budget is
+    approximate when it is shared.
+
+    Parameters
+    ----------
+    folder : str
+        Folder where arrays are stored.
+    max_bytes : int
+        Storage budget in bytes, 0 disables the cache.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Bytes used, scanned at the first write
+        self.size = None
+
+    def path(self, image_name):
+        return os.path.join(self.folder, image_name[:2], image_name + ".npy")
+
+    def __contains__(self, image_name):
+        return self.max_bytes > 0 and os.path.exists(self.path(image_name))
+
+    def get(self, image_name):
+        """
+        Returns the cached array of an image, memory-mapped read-only, or
+        None if it isn't cached.
+        """
+        if not self.max_bytes:
+            return None
+        path = self.path(image_name)
+        try:
+            img_array = np.load(path, mmap_mode="r")
+            os.utime(path)
+            return img_array
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Error reading cached tensor {path}: {e}")
+            return None
+
+    def put(self, image_name, img_array):
+        """
+        Stores the decoded array of an image, as returned by
+        `decode.load_image()`.
+        """
+        if not self.max_bytes:
+            return
+        path = self.path(image_name)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                # Decoded pixels are integers in [0, 255], uint8 is lossless
+                np.save(f, img_array.astype(np.uint8))
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except Exception as e:
+            logger.error(f"Error caching tensor {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self.scan())
+            else:
+                self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        """
+        Lists the cached files as (modification time, path, size) tuples.
+        """
+        entries = []
+        if not os.path.isdir(self.folder):
+            return entries
+        for shard in os.scandir(self.folder):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def evict(self):
+        """
+        Deletes the least recently used files until the cache is under 90%
+        of its budget. Must be called holding `self.lock`.
+        """
+        entries = sorted(self.scan())
+        size = sum(entry_size for _, _, entry_size in entries)
+        target = self.max_bytes * 0.9
+        deleted = 0
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            deleted += 1
+        self.size = size
+        logger.info(f"Evicted {deleted} cached tensors, {size / 2**20:.1f} MiB left")
@@ -0,0 +1,44 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+import backends
+
+
+class TestBackends(unittest.TestCase):
+    def test_preprocess_input(self):
+        img_batch = np.zeros((1, 224, 224, 3), dtype=np.float32)
+        img_batch[..., 0] = 255
+        preprocessed = backends.preprocess_input(img_batch)
+        # RGB to BGR and mean subtraction
+        np.testing.assert_allclose(
+            preprocessed[0, 0, 0], [-103.939, -116.779, 255 - 123.68], rtol=1e-5
+        )
+
+    def test_decode_predictions(self):
+        predictions = np.array([[0.1, 0.7, 0.2]])
+        class_index = {"0": ["n0", "a"], "1": ["n1", "b"], "2": ["n2", "c"]}
+        with patch.object(backends, "_class_index", class_index):
+            decoded = backends.decode_predictions(predictions, top=2)
+        self.assertEqual(
+            [(class_id, name) for class_id, name, _ in decoded[0]],
+            [("n1", "b"), ("n2", "c")],
+        )
+
+    def test_load_keras_model_without_artifact(self):
+        # Falls back to building the model when it wasn't exported
+        with patch.object(backends.settings, "MODEL_DIR", "missing"):
+            model = backends.load_keras_model("resnet50.keras", lambda: "built")
+        self.assertEqual(model, "built")
+
+    def test_load_backend_without_artifact(self):
+        with patch.object(backends.settings, "MODEL_DIR", "missing"):
+            with self.assertRaises(FileNotFoundError):
+                backends.load_backend("tflite-int8")
+        with self.assertRaises(ValueError):
+            backends.load_backend("bogus")
+
+
+if __name__ == "__main__":
+    unittest.main()
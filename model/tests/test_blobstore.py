@@ -0,0 +1,121 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import blobstore
+
+
+class TestBlobStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = MagicMock()
+        self.store = blobstore.BlobStore(
+            self.db,
+            folder=self.folder,
+            atime_key="atime",
+            size_key="size",
+            total_key="total",
+            lock_key="lock",
+            max_bytes=100,
+            max_age=3600,
+            min_age=60,
+        )
+
+    def write(self, path, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+
+    def test_find(self):
+        name = "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+        self.assertIsNone(blobstore.find(self.folder, name))
+        sharded = os.path.join(self.folder, "0a", "7c", name)
+        self.write(sharded, 1)
+        self.assertEqual(blobstore.find(self.folder, name), sharded)
+        # Flat uploads from older versions are still found
+        self.write(os.path.join(self.folder, "dog.jpeg"), 1)
+        self.assertEqual(
+            blobstore.find(self.folder, "dog.jpeg"),
+            os.path.join(self.folder, "dog.jpeg"),
+        )
+
+    def test_index_legacy(self):
+        self.write(os.path.join(self.folder, "dog.jpeg"), 10)
+        self.write(os.path.join(self.folder, ".upload-tmp"), 10)
+        self.write(blobstore.blob_path(self.folder, "aaaa.jpeg"), 10)
+        pipe = self.db.pipeline.return_value
+        pipe.execute.return_value = [1, 1]
+        self.assertEqual(self.store.index_legacy(), 1)
+        (key, atimes), kwargs = pipe.zadd.call_args
+        self.assertEqual((key, list(atimes)), ("atime", ["dog.jpeg"]))
+        self.assertEqual(kwargs, {"nx": True})
+        pipe.hsetnx.assert_called_once_with("size", "dog.jpeg", 10)
+        self.db.incrby.assert_called_once_with("total", 10)
+
+    def test_touch_counts_new_images(self):
+        for name in ("aaaa.jpeg", "bbbb.jpeg"):
+            self.write(blobstore.blob_path(self.folder, name), 10)
+        # "aaaa.jpeg" was already indexed
+        self.db.pipeline.return_value.execute.return_value = [0, 0, 1, 1]
+        self.store.touch(["aaaa.jpeg", "bbbb.jpeg", "missing.jpeg"])
+        self.db.incrby.assert_called_once_with("total", 10)
+
+    def test_candidates(self):
+        now = time.time()
+        self.db.zrangebyscore.return_value = [
+            (b"old", now - 7200),
+            (b"a", now - 600),
+            (b"b", now - 300),
+            (b"c", now - 120),
+        ]
+        self.db.get.return_value = b"170"
+        self.db.hmget.return_value = [b"50", b"40", b"40", b"40"]
+        # "old" is expired, then "a" is deleted to get under 100 bytes
+        self.assertEqual(self.store.candidates(), ["old", "a"])
+        self.db.get.assert_called_once_with("total")
+
+    def test_candidates_pages(self):
+        now = time.time()
+        self.db.zrangebyscore.side_effect = [
+            [(b"a", now - 600), (b"b", now - 300)],
+            [(b"c", now - 200), (b"d", now - 120)],
+        ]
+        self.db.get.return_value = b"160"
+        self.db.hmget.side_effect = [[b"40", b"40"], [b"40", b"40"]]
+        self.assertEqual(self.store.candidates(page=2), ["a", "b"])
+        # The second page is read, but no further
+        self.assertEqual(self.db.zrangebyscore.call_count, 2)
+        self.assertEqual(self.db.zrangebyscore.call_args.kwargs["start"], 2)
+
+    def test_delete_skips_recently_accessed(self):
+        for name in ("aaaa.jpeg", "bbbb.jpeg"):
+            self.write(blobstore.blob_path(self.folder, name), 10)
+        self.db.zmscore.return_value = [time.time() - 600, time.time()]
+        self.db.pipeline.return_value.execute.return_value = [1, [b"10"], 1]
+        self.assertEqual(self.store.delete(["aaaa.jpeg", "bbbb.jpeg"]), (1, 10))
+        self.assertIsNone(blobstore.find(self.folder, "aaaa.jpeg"))
+        self.assertIsNotNone(blobstore.find(self.folder, "bbbb.jpeg"))
+        self.db.pipeline.return_value.zrem.assert_called_once_with("atime", "aaaa.jpeg")
+        self.db.decrby.assert_called_once_with("total", 10)
+
+    def test_delete_missing_file(self):
+        path = blobstore.blob_path(self.folder, "aaaa.jpeg")
+        self.write(path, 10)
+        self.db.zmscore.return_value = [None]
+        self.db.pipeline.return_value.execute.return_value = [1, [b"10"], 1]
+        # Removed by someone else after it was found
+        with patch("os.remove", side_effect=FileNotFoundError):
+            self.assertEqual(self.store.delete(["aaaa.jpeg"]), (1, 0))
+        self.db.decrby.assert_called_once_with("total", 10)
+
+    def test_collect_needs_lock(self):
+        self.db.set.return_value = None
+        with patch.object(self.store, "candidates") as candidates:
+            self.assertEqual(self.store.collect(), (0, 0))
+        candidates.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import json
+import unittest
+from unittest.mock import MagicMock, call
+
+from cache import PredictionCache
+
+
+class TestPredictionCache(unittest.TestCase):
+    def setUp(self):
+        self.db = MagicMock()
+        self.cache = PredictionCache(
+            self.db,
+            namespace="prediction:resnet50:1",
+            ttl=60,
+            local_size=2,
+        )
+
+    def test_get_many_reads_redis_once(self):
+        pipe = self.db.pipeline.return_value
+        pipe.execute.return_value = [
+            json.dumps({"class": "Eskimo_dog", "score": 0.9346}),
+            None,
+        ]
+        found = self.cache.get_many(["dog.jpeg", "cat.jpeg"])
+        self.assertEqual(found, {"dog.jpeg": ("Eskimo_dog", 0.9346)})
+        # Hits get their TTL refreshed
+        self.assertEqual(
+            pipe.getex.call_args_list,
+            [
+                call("prediction:resnet50:1:dog.jpeg", ex=60),
+                call("prediction:resnet50:1:cat.jpeg", ex=60),
+            ],
+        )
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # Second lookup is served in process
+        pipe.reset_mock()
+        self.assertEqual(self.cache.get("dog.jpeg"), ("Eskimo_dog", 0.9346))
+        pipe.getex.assert_not_called()
+        pipe.expire.assert_called_once_with("prediction:resnet50:1:dog.jpeg", 60)
+        self.assertEqual(self.cache.local_hits, 1)
+
+    def test_hits_refresh_index(self):
+        self.cache.max_entries = 10
+        self.cache.local_size = 0
+        pipe = self.db.pipeline.return_value
+        pipe.execute.return_value = [json.dumps({"class": "cat", "score": 0.5})]
+        self.cache.get("cat.jpeg")
+        (key, scores), kwargs = pipe.zadd.call_args
+        self.assertEqual(
+            (key, list(scores)), ("prediction:resnet50:1:_index", ["cat.jpeg"])
+        )
+        self.assertEqual(kwargs, {"xx": True})
+
+    def test_set_many_uses_ttl(self):
+        self.cache.set_many({"dog.jpeg": ("Eskimo_dog", 0.9346)})
+        pipe = self.db.pipeline.return_value
+        pipe.set.assert_called_once_with(
+            "prediction:resnet50:1:dog.jpeg",
+            json.dumps({"class": "Eskimo_dog", "score": 0.9346}),
+            ex=60,
+        )
+
+    def test_set_many_evicts_oldest(self):
+        self.cache.max_entries = 2
+        pipe = self.db.pipeline.return_value
+        pipe.execute.return_value = [True, 1, 0, 3]
+        self.db.zpopmin.return_value = [(b"old.jpeg", 1.0)]
+        self.cache.set_many({"dog.jpeg": ("Eskimo_dog", 0.9346)})
+        pipe.zadd.assert_called_once()
+        self.db.zpopmin.assert_called_once_with("prediction:resnet50:1:_index", 1)
+        self.db.delete.assert_called_once_with("prediction:resnet50:1:old.jpeg")
+
+    def test_stage_is_recorded(self):
+        self.cache.set_many({"dog.jpeg": ("Eskimo_dog", 0.9346, "mobilenet_v2")})
+        pipe = self.db.pipeline.return_value
+        value = {"class": "Eskimo_dog", "score": 0.9346, "stage": "mobilenet_v2"}
+        pipe.set.assert_called_once_with(
+            "prediction:resnet50:1:dog.jpeg", json.dumps(value), ex=60
+        )
+
+        self.cache.local.clear()
+        pipe.execute.return_value = [json.dumps(value)]
+        self.assertEqual(
+            self.cache.get("dog.jpeg"), ("Eskimo_dog", 0.9346, "mobilenet_v2")
+        )
+
+    def test_local_tier_is_lru(self):
+        self.cache.set_many({"a": ("x", 0.1), "b": ("y", 0.2)})
+        self.cache.get("a")
+        self.cache.set_many({"c": ("z", 0.3)})
+        self.assertEqual(list(self.cache.local), ["a", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import io
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import decode
+
+
+def reference_load(source):
+    # Full resolution decode, as tensorflow.keras.preprocessing.image.load_img
+    with Image.open(source) as img:
+        img = img.convert("RGB").resize((224, 224), Image.NEAREST)
+        return np.asarray(img, dtype=np.float32)
+
+
+def encode(img, format):
+    buffer = io.BytesIO()
+    img.save(buffer, format=format)
+    buffer.seek(0)
+    return buffer
+
+
+class TestDecode(unittest.TestCase):
+    def setUp(self):
+        with Image.open("tests/dog.jpeg") as img:
+            self.img = img.convert("RGB")
+
+    def test_small_jpeg_matches_full_decode(self):
+        img_array = decode.load_image("tests/dog.jpeg")
+        self.assertEqual(img_array.shape, (224, 224, 3))
+        np.testing.assert_array_equal(img_array, reference_load("tests/dog.jpeg"))
+
+    def test_large_jpeg_is_close_to_full_decode(self):
+        big = self.img.resize((self.img.width * 6, self.img.height * 6), Image.BICUBIC)
+        img_array = decode.load_image(encode(big, "JPEG"))
+        reference = reference_load(encode(big, "JPEG"))
+        self.assertEqual(img_array.shape, (224, 224, 3))
+        self.assertLess(np.mean(np.abs(img_array - reference)), 5)
+
+    def test_png_and_gif_fall_back_to_full_decode(self):
+        for format in ("PNG", "GIF"):
+            img_array = decode.load_image(encode(self.img, format))
+            np.testing.assert_array_equal(
+                img_array, reference_load(encode(self.img, format))
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
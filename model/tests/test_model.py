@@ -1,15 +1,264 @@
+import json
+import os
+import tempfile
+import time
 import unittest
+from multiprocessing import shared_memory
+from unittest.mock import MagicMock, patch
 
 import ml_service
+import numpy as np
+from PIL import Image
+from tensor_cache import TensorCache
 
 
 class TestMLService(unittest.TestCase):
+    def setUp(self):
+        # Keep decoded images out of the source tree
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        tensors = patch.object(
+            ml_service, "tensors", TensorCache(folder.name, max_bytes=2**30)
+        )
+        tensors.start()
+        self.addCleanup(tensors.stop)
+
     def test_predict(self):
         ml_service.settings.UPLOAD_FOLDER = "tests"
         class_name, pred_probability = ml_service.predict("dog.jpeg")
         self.assertEqual(class_name, "Eskimo_dog")
         self.assertAlmostEqual(pred_probability, 0.9346, 5)
 
+    def test_predict_large_jpeg(self):
+        # Large JPEG files are decoded at reduced resolution, predictions
+        # must agree with the full resolution Keras decode
+        from tensorflow.keras.preprocessing import image
+
+        with tempfile.TemporaryDirectory() as folder:
+            with Image.open("tests/dog.jpeg") as img:
+                big = img.resize((img.width * 6, img.height * 6), Image.BICUBIC)
+            big_path = os.path.join(folder, "big_dog.jpeg")
+            big.save(big_path, quality=90)
+            reference = image.img_to_array(
+                image.load_img(big_path, target_size=(224, 224))
+            )
+            fast = ml_service.decode_image(big_path, target_size=(224, 224))
+        (ref_class, ref_score), (class_name, score) = ml_service.run_model(
+            [reference, fast]
+        )
+        self.assertEqual(class_name, ref_class)
+        self.assertAlmostEqual(score, ref_score, delta=0.1)
+
+    def test_predict_batch(self):
+        ml_service.settings.UPLOAD_FOLDER = "tests"
+        results = ml_service.predict_batch(["dog.jpeg", "missing.jpeg", "dog.jpeg"])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[0][0], "Eskimo_dog")
+        self.assertEqual(results[1], (None, None))
+
+    def test_run_cascade(self):
+        # Only the images the fast model is unsure about go to ResNet50
+        img_arrays = [np.zeros((224, 224, 3), dtype=np.float32)] * 3
+        cascade_model = MagicMock()
+        fast = [("Eskimo_dog", 0.95), ("tabby", 0.4), (None, None)]
+        with patch.object(ml_service, "cascade_model", cascade_model), patch.object(
+            ml_service, "top_predictions", return_value=fast
+        ), patch.object(
+            ml_service, "run_model", return_value=[("tiger_cat", 0.8), ("box", 0.5)]
+        ) as run_model, patch.object(
+            ml_service, "record_cascade"
+        ) as record_cascade, patch.object(
+            ml_service.settings, "CASCADE_THRESHOLD", 0.9
+        ):
+            results = ml_service.run_cascade(img_arrays)
+        self.assertEqual(
+            results,
+            [
+                ("Eskimo_dog", 0.95, "mobilenet_v2"),
+                ("tiger_cat", 0.8, "resnet50"),
+                ("box", 0.5, "resnet50"),
+            ],
+        )
+        self.assertEqual(len(run_model.call_args[0][0]), 2)
+        record_cascade.assert_called_once_with(3, 2)
+
+    def test_predict_images_split_in_batches(self):
+        # However many jobs they come from, images go through the model
+        # at most BATCH_SIZE at a time
+        images = {f"{i}.png": np.zeros((224, 224, 3)) for i in range(5)}
+        with patch.object(ml_service, "cascade_model", None), patch.object(
+            ml_service,
+            "run_model",
+            side_effect=lambda arrays: [("cat", 0.9)] * len(arrays),
+        ) as run_model, patch.object(ml_service, "cache"), patch.object(
+            ml_service.settings, "BATCH_SIZE", 2
+        ):
+            results = ml_service.predict_images(images)
+        self.assertEqual(
+            [len(call.args[0]) for call in run_model.call_args_list], [2, 2, 1]
+        )
+        self.assertEqual(results["4.png"], ("cat", 0.9, ml_service.settings.MODEL_NAME))
+
+    def test_expired_jobs_are_dropped(self):
+        job_data = {"id": "job", "image_name": "dog.jpeg", "deadline": time.time() - 1}
+        prepared = ml_service.prepare_job(job_data)
+        self.assertTrue(prepared["expired"])
+        with patch.object(
+            ml_service, "publish_results"
+        ) as publish_results, patch.object(
+            ml_service, "record_expired"
+        ) as record_expired, patch.object(
+            ml_service, "predict_images", return_value={}
+        ):
+            ml_service.infer_jobs([prepared])
+        publish_results.assert_called_once_with([(job_data, {"status": "expired"})])
+        record_expired.assert_called_once_with([job_data])
+
+    def test_prepare_job_reads_images(self):
+        # Images sent with the job are decoded from memory and not indexed
+        # in the upload folder
+        with open("tests/dog.jpeg", "rb") as f:
+            content = f.read()
+        job_data = {
+            "id": "job",
+            "image_name": "dog.jpeg",
+            "image_transport": "redis",
+            "image_refs": {"dog.jpeg": "image:job:dog.jpeg"},
+        }
+        with patch.object(ml_service, "db") as db, patch.object(
+            ml_service.cache, "get_many", return_value={}
+        ), patch.object(ml_service.uploads, "touch") as touch, patch.object(
+            ml_service, "tensors", TensorCache("", max_bytes=0)
+        ):
+            db.mget.return_value = [content]
+            prepared = ml_service.prepare_job(job_data)
+        db.mget.assert_called_once_with(["image:job:dog.jpeg"])
+        self.assertEqual(prepared["images"]["dog.jpeg"].shape, (224, 224, 3))
+        touch.assert_not_called()
+
+    def test_prepare_job_uses_cached_tensors(self):
+        # Cached arrays are used as read, the image content isn't needed
+        img_array = np.zeros((224, 224, 3), dtype=np.uint8)
+        ml_service.tensors.put("cached.png", img_array)
+        job_data = {"id": "job", "image_names": ["cached.png", "dog.jpeg"]}
+        with patch.object(ml_service.cache, "get_many", return_value={}), patch.object(
+            ml_service, "read_images", return_value={}
+        ) as read_images, patch.object(ml_service.uploads, "touch"), patch.object(
+            ml_service.settings, "UPLOAD_FOLDER", "tests"
+        ):
+            prepared = ml_service.prepare_job(job_data)
+        read_images.assert_called_once_with(job_data, ["dog.jpeg"])
+        self.assertEqual(sorted(prepared["images"]), ["cached.png", "dog.jpeg"])
+        self.assertFalse(prepared["images"]["cached.png"].any())
+
+    def test_read_shared_memory(self):
+        segment = shared_memory.SharedMemory(create=True, size=64)
+        try:
+            segment.buf[:8] = (10).to_bytes(8, "little")
+            segment.buf[8:18] = b"image-data"
+            with patch.object(ml_service, "resource_tracker") as tracker:
+                images = ml_service.read_images(
+                    {
+                        "id": "job",
+                        "image_transport": "shm",
+                        "image_refs": {"a.png": segment.name, "b.png": "missing"},
+                    }
+                )
+        finally:
+            segment.close()
+            segment.unlink()
+        self.assertEqual(images, {"a.png": b"image-data"})
+        # The worker must not unlink segments owned by the API when exiting
+        tracker.unregister.assert_called_once()
+
+    def test_fetch_stream_jobs(self):
+        # Stream jobs keep their message ID to be acknowledged once
+        # answered, malformed ones are acknowledged right away
+        jobs = [(b"1-0", b'{"id": "job", "image_name": "dog.jpeg"}'), (b"2-0", b"x")]
+        with patch.object(ml_service, "get_jobs", return_value=jobs), patch.object(
+            ml_service, "db"
+        ) as db:
+            parsed = ml_service.fetch_jobs()
+        self.assertLessEqual(parsed[0].pop("timestamps")["dequeued"], time.time())
+        self.assertEqual(
+            parsed, [{"id": "job", "image_name": "dog.jpeg", "message_id": b"1-0"}]
+        )
+        db.pipeline.return_value.xack.assert_called_once_with(
+            ml_service.settings.REDIS_STREAM,
+            ml_service.settings.REDIS_STREAM_GROUP,
+            b"2-0",
+        )
+
+    def test_claim_stale_jobs(self):
+        # Entries deleted from the stream are acknowledged instead of
+        # being claimed again on every pass
+        with patch.object(ml_service, "db") as db, patch.dict(
+            ml_service.last_claim, {"time": 0.0}
+        ):
+            db.xautoclaim.return_value = [b"1-0", b"2-0"]
+            db.pipeline.return_value.execute.return_value = [
+                [(b"1-0", {b"job": b"payload"})],
+                [],
+            ]
+            jobs = ml_service.claim_stale_jobs()
+        self.assertEqual(jobs, [(b"1-0", b"payload")])
+        db.xack.assert_called_once_with(
+            ml_service.settings.REDIS_STREAM,
+            ml_service.settings.REDIS_STREAM_GROUP,
+            b"2-0",
+        )
+
+    def test_publish_results(self):
+        # The job timestamps come back with the output
+        job_data = {"id": "job", "image_name": "a", "timestamps": {"enqueued": 1.0}}
+        with patch.object(ml_service, "db") as db:
+            ml_service.publish_results(
+                [(job_data, {"prediction": "cat", "score": 0.9})]
+            )
+        pipe = db.pipeline.return_value
+        key, output = pipe.set.call_args.args
+        output = json.loads(output)
+        self.assertEqual(key, "job")
+        self.assertEqual(output["prediction"], "cat")
+        self.assertEqual(output["timestamps"]["enqueued"], 1.0)
+        self.assertIn("published", output["timestamps"])
+        # Answered, its image no longer counts for the API admission control
+        pipe.decrby.assert_called_once_with(ml_service.settings.QUEUED_IMAGES_KEY, 1)
+        pipe.execute.assert_called_once()
+
+    def test_parse_job(self):
+        self.assertEqual(
+            ml_service.parse_job(b'["job", "dog.jpeg"]'),
+            {"id": "job", "image_name": "dog.jpeg"},
+        )
+        job_data = ml_service.parse_job(b'{"id": "job", "image_names": ["a", "b"]}')
+        self.assertEqual(ml_service.job_image_names(job_data), ["a", "b"])
+        self.assertIsNone(ml_service.parse_job(b"not json"))
+
+    def test_job_output(self):
+        self.assertEqual(
+            ml_service.job_output({"id": "job", "image_name": "a"}, [("cat", 0.9)]),
+            {"prediction": "cat", "score": 0.9},
+        )
+        self.assertEqual(
+            ml_service.job_output(
+                {"id": "job", "image_name": "a"}, [("cat", 0.9, "mobilenet_v2")]
+            ),
+            {"prediction": "cat", "score": 0.9, "stage": "mobilenet_v2"},
+        )
+        self.assertEqual(
+            ml_service.job_output(
+                {"id": "job", "image_names": ["a", "b"]}, [("cat", 0.9), (None, None)]
+            ),
+            {
+                "predictions": [
+                    {"prediction": "cat", "score": 0.9},
+                    {"prediction": None, "score": None},
+                ]
+            },
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,108 @@
+import threading
+import time
+import unittest
+
+from pipeline import InferencePipeline
+
+
+class TestInferencePipeline(unittest.TestCase):
+    def test_jobs_flow_through_stages(self):
+        jobs = [1, 2, 3, 4, 5]
+        batches = []
+        done = threading.Event()
+
+        def fetch(count):
+            if jobs:
+                fetched = jobs[:count]
+                del jobs[:count]
+                return fetched
+            time.sleep(1)
+            return []
+
+        def infer(batch):
+            batches.append(batch)
+            if sum(len(b) for b in batches) == 5:
+                done.set()
+
+        pipeline = InferencePipeline(
+            fetch=fetch,
+            prepare=lambda job: job * 10,
+            infer=infer,
+            batch_size=2,
+            max_wait=0.05,
+            prefetch_depth=3,
+            decoder_threads=2,
+        )
+        threading.Thread(target=pipeline.run, daemon=True).start()
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(
+            sorted(job for b in batches for job in b), [10, 20, 30, 40, 50]
+        )
+        self.assertTrue(all(len(b) <= 2 for b in batches))
+        stats = pipeline.occupancy()
+        self.assertEqual(stats["decoding"], 0)
+        self.assertEqual(stats["ready"], 0)
+
+    def test_batches_count_images(self):
+        pipeline = InferencePipeline(
+            fetch=lambda count: [],
+            prepare=lambda job: job,
+            infer=lambda batch: None,
+            batch_size=4,
+            max_wait=0,
+            prefetch_depth=8,
+            decoder_threads=1,
+            size=len,
+        )
+        for prepared in [[1, 2], [3], [4, 5, 6], [7, 8, 9, 10, 11]]:
+            pipeline.ready.put(prepared)
+        # Jobs going over the limit wait for the next batch
+        self.assertEqual(pipeline.next_batch(), [[1, 2], [3]])
+        self.assertEqual(pipeline.next_batch(), [[4, 5, 6]])
+        self.assertEqual(pipeline.next_batch(), [[7, 8, 9, 10, 11]])
+
+    def test_failed_jobs_release_their_slot(self):
+        pipeline = InferencePipeline(
+            fetch=lambda count: [],
+            prepare=lambda job: None,
+            infer=lambda batch: None,
+            batch_size=1,
+            max_wait=0,
+            prefetch_depth=1,
+            decoder_threads=1,
+        )
+        pipeline.slots.acquire()
+        pipeline.decode("job")
+        self.assertTrue(pipeline.slots.acquire(timeout=1))
+
+    def test_fetch_only_free_slots(self):
+        counts = []
+        fetched = threading.Event()
+
+        def fetch(count):
+            counts.append(count)
+            fetched.set()
+            time.sleep(1)
+            return ["job"]
+
+        pipeline = InferencePipeline(
+            fetch=fetch,
+            prepare=lambda job: job,
+            infer=lambda batch: None,
+            batch_size=4,
+            max_wait=0,
+            prefetch_depth=6,
+            decoder_threads=1,
+        )
+        # Three jobs are already in the pipeline, waiting for inference
+        for _ in range(3):
+            pipeline.slots.acquire()
+        threading.Thread(target=pipeline.fetch_loop, daemon=True).start()
+        self.assertTrue(fetched.wait(5))
+        # Never more jobs than free slots taken from the queue
+        self.assertEqual(counts, [3])
+
+
+if __name__ == "__main__":
+    unittest.main()
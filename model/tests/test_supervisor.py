@@ -0,0 +1,24 @@
+import unittest
+from unittest.mock import patch
+
+import supervisor
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_parse_cpu_list(self):
+        self.assertEqual(supervisor.parse_cpu_list("0-3,6"), {0, 1, 2, 3, 6})
+        self.assertEqual(supervisor.parse_cpu_list(""), set())
+
+    def test_get_cpu_affinity(self):
+        with patch.object(supervisor.settings, "WORKER_CPU_AFFINITY", ""):
+            self.assertIsNone(supervisor.get_cpu_affinity(0, 2))
+        with patch.object(supervisor.settings, "WORKER_CPU_AFFINITY", "0-1;2-3"):
+            self.assertEqual(supervisor.get_cpu_affinity(1, 2), {2, 3})
+            self.assertEqual(supervisor.get_cpu_affinity(2, 3), {0, 1})
+        with patch.object(supervisor.settings, "WORKER_CPU_AFFINITY", "auto"):
+            with patch("supervisor.os.sched_getaffinity", return_value={0, 1, 2, 3}):
+                self.assertEqual(supervisor.get_cpu_affinity(1, 2), {2, 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
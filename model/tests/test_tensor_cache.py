@@ -0,0 +1,58 @@
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from tensor_cache import TensorCache
+
+NAME = "0a7c757a80f2c5b13fa7a2a47a683593.jpeg"
+
+
+class TestTensorCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.img_array = (
+            np.arange(224 * 224 * 3, dtype=np.float32).reshape(224, 224, 3) % 256
+        )
+
+    def test_round_trip(self):
+        tensors = TensorCache(self.folder, max_bytes=2**20)
+        self.assertIsNone(tensors.get(NAME))
+        self.assertNotIn(NAME, tensors)
+
+        tensors.put(NAME, self.img_array)
+        self.assertIn(NAME, tensors)
+        cached = tensors.get(NAME)
+        # Stored as uint8 and read back memory-mapped, without loss
+        self.assertIsInstance(cached, np.memmap)
+        self.assertEqual(cached.dtype, np.uint8)
+        np.testing.assert_array_equal(cached, self.img_array)
+
+    def test_disabled(self):
+        tensors = TensorCache(self.folder, max_bytes=0)
+        tensors.put(NAME, self.img_array)
+        self.assertIsNone(tensors.get(NAME))
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_evicts_least_recently_used(self):
+        # Room for two arrays, even after evicting down to 90%
+        tensors = TensorCache(self.folder, max_bytes=int(2.5 * 224 * 224 * 3))
+        names = [f"{i:02x}{NAME[2:]}" for i in range(3)]
+        tensors.put(names[0], self.img_array)
+        tensors.put(names[1], self.img_array)
+        # A hit makes the first one the most recently used
+        past = time.time() - 60
+        os.utime(tensors.path(names[1]), (past, past))
+        os.utime(tensors.path(names[0]), (past - 60, past - 60))
+        self.assertIsNotNone(tensors.get(names[0]))
+
+        tensors.put(names[2], self.img_array)
+        self.assertIn(names[0], tensors)
+        self.assertNotIn(names[1], tensors)
+        self.assertIn(names[2], tensors)
+        self.assertLessEqual(tensors.size, tensors.max_bytes)
+
+
+if __name__ == "__main__":
+    unittest.main()